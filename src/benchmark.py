@@ -0,0 +1,960 @@
+# benchmark.py:
+
+import argparse
+import asyncio
+import datetime
+import gc
+import itertools
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+from db_manager import DBManager, TagManager, Write
+from embed_manager import EmbedManager
+from fake_firestore import FakeFirestore
+from notification_handler import Notification, NotificationHandler
+import startup_profile
+from sqlite_store import SQLiteClient
+from tag_table import HAS_NUMPY, TagTable
+import utils
+from utils import Tag, Task, percentile
+
+"""
+インメモリのfake(fake_firestore.py)を使ったベンチマーク
+実行例: python benchmark.py event_loop_lag --concurrency 50 --latency 0.02
+        python benchmark.py backends --operations 200 --latency 0.02
+        python benchmark.py stress --concurrency 20 --latency 0.01
+        python benchmark.py suite --users 500 --guilds 10 --threads 50 --tags 5 --seed 1
+        python benchmark.py startup --repeat 10
+        python benchmark.py memory --users 5000 --guilds 10 --threads 200 --tags 10
+        python benchmark.py tag_table --users 100000 --guilds 50 --threads 2000 --tags 10
+結果はJSONで標準出力に出す
+--baselineに以前の結果(JSON)を渡すと、各操作のp50の比(今回/前回)をcomparisonに加える
+"""
+
+
+class BlockingDBManager(DBManager):
+    """比較用: スレッドプールを使わず、イベントループ上で直接RPCを実行する(従来の挙動)"""
+
+    async def _run(self, func, *args, **kwargs):
+        return func(*args, **kwargs)
+
+
+class FakeUser:
+    """discord.Userのうち、TagManagerと埋め込みの作成で使う属性だけを持つ"""
+
+    def __init__(self, user_id: int, name: str):
+        self.id = user_id
+        self.name = name
+        self.bot = False
+
+    @property
+    def mention(self) -> str:
+        return f"<@{self.id}>"
+
+
+class FakeThread:
+    """discord.Threadのうち、埋め込みの作成で使う属性だけを持つ"""
+
+    def __init__(self, thread_id: int, guild: "FakeGuild"):
+        self.id = thread_id
+        self.guild = guild
+        self.name = f"thread{thread_id}"
+
+    @property
+    def mention(self) -> str:
+        return f"<#{self.id}>"
+
+
+class FakeChannel(FakeThread):
+    """通知チャンネル。送信したembedを記録するだけで、実際には送らない"""
+
+    def __init__(self, channel_id: int, guild: "FakeGuild"):
+        super().__init__(channel_id, guild)
+        self.sent = 0
+
+    async def send(self, embed=None, **kwargs):
+        self.sent += 1
+
+
+class FakeGuild:
+    """discord.Guildのうち、通知と埋め込みの作成で使うメソッドだけを真似たもの"""
+
+    def __init__(self, guild_id: int):
+        self.id = guild_id
+        self.name = f"guild{guild_id}"
+        self.threads: dict[int, FakeThread] = {}
+        self.channels: dict[int, FakeChannel] = {}
+
+    def get_thread(self, thread_id: int):
+        return self.threads.get(int(thread_id))
+
+    def get_channel(self, channel_id: int):
+        return self.channels.get(int(channel_id))
+
+
+class FakeClient:
+    """TagManagerと通知の処理が使うdiscord.Clientのメソッドだけを真似たもの"""
+
+    def __init__(self):
+        self.users: dict[int, FakeUser] = {}
+        self.guilds: dict[int, FakeGuild] = {}
+        self.tag_manager: TagManager | None = None
+        self.embed_manager = EmbedManager()
+
+    def get_user(self, user_id: int):
+        return self.users.get(int(user_id))
+
+    def get_guild(self, guild_id: int):
+        return self.guilds.get(int(guild_id))
+
+    def get_channel(self, channel_id: int):
+        for guild in self.guilds.values():
+            channel = guild.get_thread(channel_id) or guild.get_channel(channel_id)
+            if channel:
+                return channel
+        return None
+
+
+def seed_users(db: FakeFirestore, client: FakeClient, count: int):
+    for user_id in range(1, count + 1):
+        client.users[user_id] = FakeUser(user_id, f"user{user_id}")
+        db.collection("users").document(str(user_id)).set(
+            {
+                "user_id": user_id,
+                "name": f"user{user_id}",
+                "notification": True,
+            }
+        )
+
+
+async def _probe_lag(interval: float, lags: list[float], stop: asyncio.Event):
+    # 一定間隔でsleepし、予定より遅れて起きた時間をイベントループの遅延として記録する
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - start - interval)
+
+
+async def _simulate_interaction(
+    tag_manager: TagManager, client: FakeClient, index: int, user_count: int
+):
+    # /tag -> /untag のスレッド選択 -> /toggle_notification 相当の操作
+    user = client.get_user(index % user_count + 1)
+    tag = Tag(
+        client=client,
+        guild_id=1,
+        thread_id=index % 10,
+        users=[user],
+        deadline=datetime.datetime.now(datetime.timezone.utc)
+        + datetime.timedelta(days=3),
+    )
+    await tag_manager.add_tag(tag)
+    await tag_manager.get_users_by_thread(tag)
+    await tag_manager.toggle_notification(user)
+
+
+async def _run_lag(db_manager: DBManager, client: FakeClient, args) -> dict:
+    tag_manager = TagManager(db_manager)
+
+    lags: list[float] = []
+    stop = asyncio.Event()
+    probe = asyncio.create_task(_probe_lag(args.probe_interval, lags, stop))
+
+    start = time.perf_counter()
+    await asyncio.gather(
+        *[
+            _simulate_interaction(tag_manager, client, i, args.users)
+            for i in range(args.concurrency)
+        ]
+    )
+    elapsed = time.perf_counter() - start
+
+    stop.set()
+    await probe
+    return {
+        "elapsed_sec": elapsed,
+        "lag_max_ms": max(lags, default=0.0) * 1000,
+        "lag_p50_ms": percentile(lags, 50) * 1000,
+        "lag_p99_ms": percentile(lags, 99) * 1000,
+        "lag_mean_ms": (statistics.fmean(lags) if lags else 0.0) * 1000,
+        "probes": len(lags),
+    }
+
+
+def bench_event_loop_lag(args) -> dict:
+    db = FakeFirestore(latency=args.latency)
+    client = FakeClient()
+    seed_users(db, client, args.users)
+
+    results = {}
+    for name, db_manager in (
+        ("blocking", BlockingDBManager(db=db)),
+        ("executor", DBManager(db=db, max_workers=args.workers)),
+    ):
+        results[name] = asyncio.run(_run_lag(db_manager, client, args))
+    return results
+
+
+def new_tag_manager(db, args) -> TagManager:
+    """ベンチマーク対象ごとに別のDBManagerを持つTagManager (DBManager()はシングルトンのため直接作る)"""
+    db_manager = type.__call__(
+        DBManager, db=db, max_workers=args.workers, live_mirror=False
+    )
+    db_manager.cache.maxsize = 0  # ストレージ自体の速度を測るため、キャッシュは使わない
+    return TagManager(db_manager)
+
+
+def summarize(values: list[float]) -> dict:
+    return {
+        "count": len(values),
+        "mean_ms": statistics.fmean(values) * 1000,
+        "p50_ms": percentile(values, 50) * 1000,
+        "p99_ms": percentile(values, 99) * 1000,
+    }
+
+
+async def _run_operations(tag_manager: TagManager, client: FakeClient, args) -> dict:
+    timings: dict[str, list[float]] = {}
+
+    async def timed(name: str, coro):
+        start = time.perf_counter()
+        await coro
+        timings.setdefault(name, []).append(time.perf_counter() - start)
+
+    deadline = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=3)
+    for i in range(args.operations):
+        user = client.get_user(i % args.users + 1)
+        tag = Tag(
+            client=client,
+            guild_id=i % 5,
+            thread_id=i % 50,
+            users=[user],
+            deadline=deadline,
+        )
+        task = Task(client=client, user=user, content=f"task{i}")
+        await timed("add_tag", tag_manager.add_tag(tag))
+        await timed("get_users_by_thread", tag_manager.get_users_by_thread(tag))
+        await timed("get_tags", tag_manager.get_tags(user))
+        await timed("add_task", tag_manager.add_task(task))
+        await timed("get_tasks", tag_manager.get_tasks(task))
+        await timed("toggle_notification", tag_manager.toggle_notification(user))
+        if i % 10 == 0:
+            await timed("get_threads_by_users", tag_manager.get_threads_by_users())
+
+    return {name: summarize(values) for name, values in timings.items()}
+
+
+async def _naive_toggle(tag_manager: TagManager, user: FakeUser) -> bool:
+    # 比較用: 従来のread-modify-write (並行して呼ぶと更新を取りこぼす)
+    db_manager = tag_manager.db_manager
+    data = await db_manager.get("users", str(user.id))
+    data["notification"] = not data["notification"]
+    await db_manager.update("users", str(user.id), data)
+    return data["notification"]
+
+
+async def _run_stress(tag_manager: TagManager, client: FakeClient, args) -> dict:
+    user = client.get_user(1)
+    users = [client.get_user(i % args.users + 1) for i in range(args.concurrency)]
+    deadline = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=3)
+
+    async def toggles(toggle) -> dict:
+        before = (await tag_manager.get_user(user))["notification"]
+        returned = await asyncio.gather(
+            *[toggle(user) for _ in range(args.concurrency)]
+        )
+        after = (await tag_manager.get_user(user))["notification"]
+        # 取りこぼしが無ければ、戻り値はTrue/Falseが交互に並んだものと一致する
+        # (切り替えに失敗した(None)場合も取りこぼしとして扱う)
+        return {
+            "returned_true": returned.count(True),
+            "returned_false": returned.count(False),
+            "failed": returned.count(None),
+            "ok": None not in returned
+            and abs(returned.count(True) - returned.count(False)) <= 1
+            and after == (before != (args.concurrency % 2 == 1)),
+        }
+
+    results = {
+        "toggle_naive": await toggles(lambda u: _naive_toggle(tag_manager, u)),
+        "toggle_transaction": await toggles(tag_manager.toggle_notification),
+    }
+
+    # 同じスレッドに、別々のユーザーを同時にタグ付けする
+    tag = Tag(client=client, guild_id=1, thread_id=1, deadline=deadline)
+    await asyncio.gather(
+        *[
+            tag_manager.add_tag(
+                Tag(
+                    client=client,
+                    guild_id=tag.guild_id,
+                    thread_id=tag.thread_id,
+                    users=[u],
+                    deadline=deadline,
+                )
+            )
+            for u in users
+        ]
+    )
+    tagged = await tag_manager.get_users_by_thread(tag)
+    results["add_tag"] = {
+        "expected": len(set(users)),
+        "indexed": len(tagged),
+        "ok": len(tagged) == len(set(users)),
+    }
+
+    # 同じユーザーにタスクを同時に追加する
+    task = Task(client=client, user=user)
+    await asyncio.gather(
+        *[
+            tag_manager.add_task(Task(client=client, user=user, content=f"task{i}"))
+            for i in range(args.concurrency)
+        ]
+    )
+    tasks = await tag_manager.get_tasks(task)
+    results["add_task"] = {
+        "expected": args.concurrency,
+        "stored": len(tasks),
+        "ok": len(tasks) == args.concurrency,
+    }
+    return results
+
+
+def bench_stress(args) -> dict:
+    """
+    並行した更新で取りこぼしが起きないことを、レイテンシ付きのfakeで確認する
+    トランザクションの再試行には、インストールされているgoogle-cloud-firestoreのtransactionalを使う
+    取りこぼしがあった場合はlost_updatesに記録し、mainが終了コード1で終わる (比較用のtoggle_naiveは除く)
+    """
+    db = FakeFirestore(latency=args.latency)
+    client = FakeClient()
+    seed_users(db, client, args.users)
+    tag_manager = new_tag_manager(db, args)
+    results = asyncio.run(_run_stress(tag_manager, client, args))
+    results["aborted_transactions"] = db.aborted_count
+    results["lost_updates"] = [
+        name
+        for name in ("toggle_transaction", "add_tag", "add_task")
+        if not results[name]["ok"]
+    ]
+    return results
+
+
+def bench_backends(args) -> dict:
+    """TagManagerの各操作を、Firestore(latencyを付けたfake)とSQLiteで比較する"""
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for name, db in (
+            ("firestore", FakeFirestore(latency=args.latency)),
+            ("sqlite", SQLiteClient(os.path.join(directory, "bench.sqlite3"))),
+        ):
+            client = FakeClient()
+            seed_users(db, client, args.users)
+            tag_manager = new_tag_manager(db, args)
+            results[name] = asyncio.run(_run_operations(tag_manager, client, args))
+    return results
+
+
+async def seed_dataset(
+    db: FakeFirestore, tag_manager: TagManager, client: FakeClient, args
+) -> dict:
+    """
+    users × guilds × threads のデータセットを作る (同じseedなら同じ構成になる)
+    各ユーザーはランダムなtags件のスレッドにタグ付けされ、tasks件のタスクを持つ
+    各ギルドには通知チャンネルを1つ置く
+    """
+    rng = random.Random(args.seed)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    seed_users(db, client, args.users)
+
+    threads = []
+    for guild_id in range(1, args.guilds + 1):
+        guild = client.guilds[guild_id] = FakeGuild(guild_id)
+        # スレッド・チャンネルのIDはギルドをまたいで重複しないようにする
+        guild.channels[guild_id * 100_000] = FakeChannel(guild_id * 100_000, guild)
+        for thread_id in range(
+            guild_id * 100_000 + 1, guild_id * 100_000 + 1 + args.threads
+        ):
+            guild.threads[thread_id] = FakeThread(thread_id, guild)
+            threads.append((guild_id, thread_id))
+    await tag_manager.add_notify_channel(
+        {
+            guild: guild.get_channel(guild.id * 100_000)
+            for guild in client.guilds.values()
+        }
+    )
+
+    tag_docs, writes = [], []
+    for user_id in client.users:
+        for guild_id, thread_id in rng.sample(threads, min(args.tags, len(threads))):
+            tag_doc = {
+                "user_id": user_id,
+                "guild_id": str(guild_id),
+                "thread_id": str(thread_id),
+                "deadline": now + datetime.timedelta(hours=rng.randint(1, 24 * 30)),
+            }
+            tag_docs.append(tag_doc)
+            writes.append(
+                Write(
+                    "set",
+                    tag_manager.TAGS,
+                    tag_manager.tag_id(guild_id, thread_id, user_id),
+                    tag_doc,
+                )
+            )
+        for i in range(args.tasks):
+            created_at = now + datetime.timedelta(microseconds=i)
+            task_id = utils.generate_task_id(created_at)
+            writes.append(
+                Write(
+                    "set",
+                    tag_manager.tasks_collection(user_id),
+                    task_id,
+                    {
+                        "task_id": task_id,
+                        "content": f"task{i}",
+                        "created_at": created_at,
+                    },
+                )
+            )
+    await tag_manager.db_manager.batch(writes)
+    await tag_manager.rebuild_thread_index(tag_docs)
+    return {
+        "users": len(client.users),
+        "guilds": len(client.guilds),
+        "threads": len(threads),
+        "tags": len(tag_docs),
+        "tasks": len(client.users) * args.tasks,
+    }
+
+
+async def _run_suite(db: FakeFirestore, client: FakeClient, args) -> dict:
+    tag_manager = client.tag_manager
+    handler = NotificationHandler(client)
+    embed_manager = client.embed_manager
+    rng = random.Random(args.seed + 1)  # データセットとは別の系列で対象を選ぶ
+    timings: dict[str, list[float]] = {}
+    rpcs: dict[str, list[int]] = {}
+
+    async def timed(name: str, coro):
+        rpc_count = db.rpc_count
+        start = time.perf_counter()
+        result = await coro
+        timings.setdefault(name, []).append(time.perf_counter() - start)
+        rpcs.setdefault(name, []).append(db.rpc_count - rpc_count)
+        return result
+
+    def timed_sync(name: str, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        timings.setdefault(name, []).append(time.perf_counter() - start)
+        rpcs.setdefault(name, []).append(0)
+        return result
+
+    dataset = await seed_dataset(db, tag_manager, client, args)
+    users = list(client.users.values())
+    threads = [
+        thread for guild in client.guilds.values() for thread in guild.threads.values()
+    ]
+    now = datetime.datetime.now(datetime.timezone.utc)
+    deadline = now + datetime.timedelta(days=3)
+
+    for _ in range(args.repeat):
+        user = rng.choice(users)
+        thread = rng.choice(threads)
+        tag = Tag(
+            client=client,
+            guild_id=thread.guild.id,
+            thread_id=thread.id,
+            users=[user],
+            deadline=deadline,
+        )
+        task = Task(client=client, user=user, content="benchmark")
+        # 前の繰り返しの通知で作ったタグのテーブルは捨て、ストレージから読む場合を計測する
+        tag_manager.db_manager.tag_table = None
+
+        # 読み込み
+        await timed("get_user", tag_manager.get_user(user))
+        await timed("get_all_users", tag_manager.get_all_users())
+        await timed("get_user_ids", tag_manager.get_user_ids())
+        await timed("get_tags", tag_manager.get_tags(user))
+        await timed("get_threads_by_user", tag_manager.get_threads_by_user([user]))
+        await timed("get_threads_by_users", tag_manager.get_threads_by_users())
+        await timed("get_users_by_thread", tag_manager.get_users_by_thread(tag))
+        await timed("get_guild_tags", tag_manager.get_guild_tags(thread.guild.id))
+        await timed("get_upcoming_deadlines", tag_manager.get_upcoming_deadlines(now))
+        await timed("get_tasks", tag_manager.get_tasks(task))
+        await timed("get_task_page", tag_manager.get_task_page(task))
+        await timed("get_notify_channels", tag_manager.get_notify_channels())
+        await timed("get_notify_freqs", tag_manager.get_notify_freqs())
+
+        # 書き込み (データセットが変わらないよう、元に戻す操作と組にする)
+        await timed("add_tag", tag_manager.add_tag(tag))
+        await timed("update_tag", tag_manager.update_tag(tag))
+        await timed("remove_tag", tag_manager.remove_tag(tag))
+        task.task_id = await timed("add_task", tag_manager.add_task(task))
+        await timed("update_task", tag_manager.update_task(task))
+        await timed("delete_task", tag_manager.delete_task(task))
+        await timed("toggle_notification", tag_manager.toggle_notification(user))
+        await tag_manager.toggle_notification(user)
+
+        # 通知の整形・embedの作成 (送信処理と同じく、タグのテーブルから整形する)
+        threads_by_user = await tag_manager.get_threads_by_users()
+        data = [
+            {client.get_user(user_id): user_threads}
+            for user_id, user_threads in threads_by_user.items()
+        ]
+        table = await timed("get_tag_table", tag_manager.get_tag_table())
+        formatted_data = timed_sync(
+            "format_tag_table",
+            handler.format_tag_table,
+            table,
+            list(client.guilds.values()),
+        )
+        tags = formatted_data[rng.choice(list(formatted_data))]
+        notification = {
+            "notification": tags,
+            "result": {"notification": tags, "client": client},
+        }
+        timed_sync("get_embed.notification", embed_manager.get_embed, notification)
+        timed_sync("get_embeds.notification", embed_manager.get_embeds, notification)
+        user_threads = {
+            "get_threads_by_user": tag,
+            "result": {
+                "get_threads_by_user": [
+                    {
+                        "user": user,
+                        "threads": [
+                            {
+                                "thread": client.get_channel(int(thread_id)),
+                                "deadline": thread_deadline,
+                            }
+                            for guild_threads in threads_by_user.get(
+                                user.id, {}
+                            ).values()
+                            for thread_id, thread_deadline in guild_threads
+                        ],
+                    }
+                ]
+            },
+        }
+        timed_sync(
+            "get_embed.get_threads_by_user", embed_manager.get_embed, user_threads
+        )
+        interaction = SimpleNamespace(guild=thread.guild, client=client)
+        get_all = {
+            "get_all": tag,
+            "result": {"get_all": data, "interaction": interaction},
+        }
+        timed_sync("get_embeds.get_all", embed_manager.get_embeds, get_all)
+
+        # 全ギルドへの通知 (通知チャンネルの取得 -> タグのテーブルの作成・整形 -> embedの作成 -> 送信)
+        await timed("notify_sweep", handler.send_digest(list(client.guilds)))
+        # 通知の後はタグのテーブルがあるため、コマンドの読み込みはメモリから返す
+        await timed("get_guild_tags.table", tag_manager.get_guild_tags(thread.guild.id))
+        await timed(
+            "get_threads_by_user.table", tag_manager.get_threads_by_user([user])
+        )
+
+    operations = {}
+    for name, values in timings.items():
+        operations[name] = summarize(values)
+        operations[name]["rpcs"] = statistics.fmean(rpcs[name])
+    return {
+        "dataset": dataset,
+        "notify_sweep": handler.last_dispatch_stats,
+        "operations": operations,
+    }
+
+
+def bench_suite(args) -> dict:
+    """合成したデータセットに対して、TagManagerの各メソッドと通知の処理を計測する"""
+    db = FakeFirestore(latency=args.latency)
+    client = FakeClient()
+    client.tag_manager = new_tag_manager(db, args)
+    return asyncio.run(_run_suite(db, client, args))
+
+
+def compare(result: dict, baseline: dict) -> dict:
+    """両方の結果にある計測について、p50_msの比(今回/前回)を返す。1より大きければ遅くなっている"""
+    comparison = {}
+
+    def walk(current: dict, previous: dict, path: list[str]):
+        for key, value in current.items():
+            if not isinstance(value, dict) or not isinstance(previous.get(key), dict):
+                continue
+            if "p50_ms" in value and "p50_ms" in previous[key]:
+                before, after = previous[key]["p50_ms"], value["p50_ms"]
+                comparison[".".join(path + [key])] = {
+                    "baseline_p50_ms": before,
+                    "p50_ms": after,
+                    "ratio": after / before if before else None,
+                }
+            else:
+                walk(value, previous[key], path + [key])
+
+    walk(result, baseline, [])
+    return comparison
+
+
+def bench_startup(args) -> dict:
+    """
+    main.pyのimportにかかる時間 (起動時間の回帰の確認用)
+    毎回新しいプロセスで計測し、遅延させているパッケージが起動時に読み込まれていないかも確認する
+    """
+    profiles = [startup_profile.profile_imports("main") for _ in range(args.repeat)]
+    return {
+        "import": summarize([p["import_ms"] / 1000 for p in profiles]),
+        "process": summarize([p["wall_sec"] for p in profiles]),
+        "packages_ms": dict(list(profiles[-1]["packages"].items())[:15]),
+        "deferred": profiles[-1]["deferred"],
+    }
+
+
+def synthetic_sweep(client: FakeClient, args) -> list[dict]:
+    """
+    通知の1回分の入力 ([{user: {guild_id: [(thread_id, deadline), ...]}}, ...]) を、DBを使わずに作る
+    IDは実際のDiscordのID(snowflake)と同じ桁数にする
+    """
+    rng = random.Random(args.seed)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    snowflake = 10**18
+    threads = []
+    for g in range(1, args.guilds + 1):
+        guild = client.guilds[snowflake + g] = FakeGuild(snowflake + g)
+        for t in range(args.threads):
+            thread_id = snowflake + g * 100_000 + t
+            guild.threads[thread_id] = FakeThread(thread_id, guild)
+            threads.append((str(guild.id), str(thread_id)))
+
+    data = []
+    for u in range(1, args.users + 1):
+        user = client.users[snowflake + u] = FakeUser(snowflake + u, f"user{u}")
+        user_threads: dict[str, list] = {}
+        for guild_id, thread_id in rng.sample(threads, min(args.tags, len(threads))):
+            deadline = now + datetime.timedelta(hours=rng.randint(1, 24 * 30))
+            user_threads.setdefault(guild_id, []).append((thread_id, deadline))
+        data.append({user: user_threads})
+    return data
+
+
+def sweep_tag_docs(data: list[dict]) -> list[dict]:
+    """synthetic_sweepの結果を、tagsコレクションのドキュメントの形にする"""
+    return [
+        {
+            "user_id": user.id,
+            "guild_id": guild_id,
+            "thread_id": thread_id,
+            "deadline": deadline,
+        }
+        for user_data in data
+        for user, threads in user_data.items()
+        for guild_id, rows in threads.items()
+        for thread_id, deadline in rows
+    ]
+
+
+def legacy_format(client: FakeClient, data: list[dict]) -> list[dict]:
+    """比較用: 以前の通知の整形と同じ形 (ユーザー・ギルドの組ごとのdictに、1行ごとのTagを入れる)"""
+    formatted_data = []
+    for user_data in data:
+        for user, threads in user_data.items():
+            for guild_id, thread_data in threads.items():
+                guild = client.get_guild(int(guild_id))
+                if not guild:
+                    continue
+                guild_data = {guild: []}
+                for thread_id, deadline in thread_data:
+                    if not guild.get_thread(int(thread_id)):
+                        continue
+                    guild_data[guild].append(
+                        Tag(
+                            client=client,
+                            guild_id=guild_id,
+                            thread_id=thread_id,
+                            deadline=deadline,
+                            users=[user],
+                        )
+                    )
+                formatted_data.append(guild_data)
+    return formatted_data
+
+
+def measure_memory(build) -> tuple[object, dict]:
+    """build()の結果が保持しているメモリ(retained)と、作成中の最大(peak)を計測する"""
+    gc.collect()
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    value = build()
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return value, {
+        "retained_bytes": current - base,
+        "peak_bytes": peak - base,
+        "elapsed_sec": elapsed,
+    }
+
+
+def bench_memory(args) -> dict:
+    """
+    通知の1回分(users × tags件)の整形結果のメモリを、Tag(以前の形)とTagRecordで比べる
+    TagRecordは通知と同じくタグのテーブルから整形する (テーブル自体のメモリはtag_tableで計測する)
+    TagRecordはembedを作る時にIDからスレッドを取得するため、その時間(render)も計測する
+    """
+    client = FakeClient()
+    handler = NotificationHandler(client)
+    data = synthetic_sweep(client, args)
+    table = TagTable.build(sweep_tag_docs(data))
+    guilds = list(client.guilds.values())
+    tag_count = len(table)
+
+    result = {"tags": tag_count}
+    for name, build in (
+        ("tag", lambda: legacy_format(client, data)),
+        ("tag_record", lambda: handler.format_tag_table(table, guilds)),
+    ):
+        formatted_data, stats = measure_memory(build)
+        stats["bytes_per_tag"] = stats["retained_bytes"] / tag_count if tag_count else 0
+        result[name] = stats
+        del formatted_data
+
+    formatted_data = handler.format_tag_table(table, guilds)
+    start = time.perf_counter()
+    for guild_tags in formatted_data.values():
+        for _, tags in itertools.groupby(guild_tags, key=lambda tag: tag.user_id):
+            tags = list(tags)
+            client.embed_manager.get_embeds(
+                {
+                    "notification": tags,
+                    "result": {"notification": tags, "client": client},
+                }
+            )
+    result["tag_record"]["render_sec"] = time.perf_counter() - start
+    result["retained_ratio"] = (
+        result["tag_record"]["retained_bytes"] / result["tag"]["retained_bytes"]
+        if result["tag"]["retained_bytes"]
+        else None
+    )
+    return result
+
+
+def bench_tag_table(args) -> dict:
+    """
+    タグのテーブル(TagTable)の作成・メモリと検索の時間を、tagsコレクションの全件から作るdict
+    ({user_id: {guild_id: [(thread_id, deadline), ...]}}、以前の通知と同じ形)をたどる場合と比べる
+    """
+    client = FakeClient()
+    tag_docs = sweep_tag_docs(synthetic_sweep(client, args))
+    rng = random.Random(args.seed)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    soon = now + datetime.timedelta(days=1)
+    guild_id = rng.choice(list(client.guilds))
+    thread = rng.choice(list(client.guilds[guild_id].threads.values()))
+    user_ids = rng.sample(list(client.users), min(25, len(client.users)))
+
+    def repeat(func) -> dict:
+        values = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            func()
+            values.append(time.perf_counter() - start)
+        return summarize(values)
+
+    result = {"tags": len(tag_docs), "numpy": HAS_NUMPY}
+    nested, result["dict"] = measure_memory(
+        lambda: TagManager.threads_from_tag_docs(tag_docs)
+    )
+    table, result["tag_table"] = measure_memory(
+        lambda: TagTable.from_tag_docs(tag_docs)
+    )
+    # インデックスは最初の検索で作るため、作成時間は別に計測する
+    start = time.perf_counter()
+    for name in TagTable.INDEXES:
+        table.index(name)
+    result["tag_table"]["index_sec"] = time.perf_counter() - start
+    result["tag_table"]["nbytes"] = table.nbytes()
+
+    def nested_guild(after=None, before=None) -> list:
+        return sorted(
+            (
+                (user_id, thread_id, deadline)
+                for user_id, threads in nested.items()
+                for thread_id, deadline in threads.get(str(guild_id), [])
+                if (after is None or deadline >= after)
+                and (before is None or deadline < before)
+            ),
+            key=lambda row: row[2],
+        )
+
+    def nested_due() -> list:
+        return [
+            row
+            for user_id, threads in nested.items()
+            for rows in threads.values()
+            for row in rows
+            if now <= row[1] < soon
+        ]
+
+    def nested_thread_users() -> list:
+        return [
+            user_id
+            for user_id, threads in nested.items()
+            for thread_id, _ in threads.get(str(guild_id), [])
+            if thread_id == str(thread.id)
+        ]
+
+    queries = {
+        "guild_tags": (
+            nested_guild,
+            lambda: table.guild_tags(guild_id),
+        ),
+        "guild_due": (
+            lambda: nested_guild(now, soon),
+            lambda: table.guild_records(guild_id, now, soon),
+        ),
+        "due": (nested_due, lambda: table.due(now, soon)),
+        "thread_user_ids": (
+            nested_thread_users,
+            lambda: table.thread_user_ids(guild_id, thread.id),
+        ),
+        "threads_by_users": (
+            lambda: {user_id: nested.get(user_id, {}) for user_id in user_ids},
+            lambda: table.threads_by_users(user_ids),
+        ),
+    }
+    for name, (walk, search) in queries.items():
+        result[name] = {"dict": repeat(walk), "tag_table": repeat(search)}
+        result[name]["speedup"] = (
+            result[name]["dict"]["mean_ms"] / result[name]["tag_table"]["mean_ms"]
+            if result[name]["tag_table"]["mean_ms"]
+            else None
+        )
+
+    # コマンドによるタグの追加・削除 (インデックスは並べ替えずに差し込み・削除の印を付ける)
+    rows = [
+        (user_id, guild_id, thread.id, now + datetime.timedelta(hours=hour))
+        for hour, user_id in enumerate(user_ids)
+    ]
+    result["upsert"] = repeat(lambda: table.upsert(rows))
+    result["delete"] = repeat(lambda: table.delete(row[:3] for row in rows))
+    if HAS_NUMPY:
+        # NumPyで作ったインデックスが、NumPyを使わずに作った場合と同じ並びになるか (追加・削除の後も)
+        # 異なる場合はmismatchesに記録し、mainが終了コード1で終わる
+        pure = TagTable.from_tag_docs(tag_docs, use_numpy=False)
+        pure.upsert(rows)
+        pure.delete(row[:3] for row in rows)
+        result["mismatches"] = [
+            name
+            for name in TagTable.INDEXES
+            if pure.index(name).order != table.index(name).order
+            or pure.alive != table.alive
+        ]
+    result["retained_ratio"] = (
+        result["tag_table"]["retained_bytes"] / result["dict"]["retained_bytes"]
+        if result["dict"]["retained_bytes"]
+        else None
+    )
+    return result
+
+
+async def _run_timezone(tag_manager: TagManager, use_table: bool) -> dict:
+    if use_table:
+        await tag_manager.get_tag_table()
+    deadline = datetime.datetime(2030, 1, 1, 12, tzinfo=datetime.timezone.utc)
+    guild_id, thread_id = 1, 100_001
+    for user_id, days in ((1, 0), (2, 1)):
+        await tag_manager.add_tag(
+            Tag(
+                guild_id=guild_id,
+                thread_id=thread_id,
+                users=[FakeUser(user_id, f"user{user_id}")],
+                deadline=deadline - datetime.timedelta(days=days),
+            )
+        )
+    index = await tag_manager.get_thread_index(guild_id, thread_id)
+    stored = index.get("deadline") if index else None
+    return {
+        "expected": deadline,
+        "stored": stored,
+        "ok": stored is not None and stored.timestamp() == deadline.timestamp(),
+    }
+
+
+def bench_timezone(args) -> dict:
+    """
+    UTC以外のタイムゾーン(--tz)で、add_tagの期限がthread_indexにずれずに保存されることを確認する
+    FakeFirestoreは本物と同じくnaiveなdatetimeをUTCとして保存するため、ローカル時刻で書くとずれる
+    ずれがあった場合はmismatchesに記録し、mainが終了コード1で終わる
+    """
+    os.environ["TZ"] = args.tz
+    time.tzset()
+    results = {
+        name: asyncio.run(
+            _run_timezone(new_tag_manager(FakeFirestore(), args), use_table)
+        )
+        for name, use_table in (("tag_table", True), ("query", False))
+    }
+    results["mismatches"] = [
+        name for name, result in results.items() if not result["ok"]
+    ]
+    return results
+
+
+BENCHMARKS = {
+    "event_loop_lag": bench_event_loop_lag,
+    "backends": bench_backends,
+    "stress": bench_stress,
+    "suite": bench_suite,
+    "startup": bench_startup,
+    "memory": bench_memory,
+    "tag_table": bench_tag_table,
+    "timezone": bench_timezone,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="member_tagger benchmarks")
+    parser.add_argument("benchmark", choices=list(BENCHMARKS.keys()))
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--workers", type=int, default=DBManager.MAX_WORKERS)
+    parser.add_argument("--probe-interval", type=float, default=0.005)
+    parser.add_argument("--operations", type=int, default=200)
+    # suite: データセットの大きさ・繰り返し回数・乱数のseed
+    parser.add_argument("--guilds", type=int, default=5)
+    parser.add_argument("--threads", type=int, default=20, help="threads per guild")
+    parser.add_argument("--tags", type=int, default=5, help="tags per user")
+    parser.add_argument("--tasks", type=int, default=10, help="tasks per user")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    # timezone: 確認に使うタイムゾーン
+    parser.add_argument("--tz", default="Asia/Tokyo")
+    parser.add_argument("--baseline", help="previous result (JSON) to compare with")
+    args = parser.parse_args()
+
+    result = {
+        "benchmark": args.benchmark,
+        "params": vars(args),
+        "result": BENCHMARKS[args.benchmark](args),
+    }
+    if args.baseline:
+        with open(args.baseline) as f:
+            result["comparison"] = compare(result["result"], json.load(f)["result"])
+    print(json.dumps(result, indent=2, default=str))
+    if result["result"].get("lost_updates"):
+        raise SystemExit(f"lost updates: {', '.join(result['result']['lost_updates'])}")
+    if result["result"].get("mismatches"):
+        raise SystemExit(f"mismatches: {', '.join(result['result']['mismatches'])}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,199 +1,1211 @@
 # db_manager.py:
 
+import asyncio
+import copy
 import datetime
+import functools
 import os
+import random
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable
 
 import discord
-import firebase_admin
-import requests
-from firebase_admin import credentials, firestore
 
+import firebase_credentials
 import utils
-from utils import Tag, Task
+from metrics import Metrics, db_call
+from tag_table import TagTable
+from utils import LazyModule, Tag, Task
+
+# Firestore関連のパッケージはimportに時間がかかるため、最初に使う時に読み込む
+# (botではDBManager.connect()が、Discordへの接続と並行してスレッドプールで読み込む)
+firebase_admin = LazyModule("firebase_admin")
+credentials = LazyModule("firebase_admin.credentials")
+firestore = LazyModule("firebase_admin.firestore")
+exceptions = LazyModule("google.api_core.exceptions")
+base_query = LazyModule("google.cloud.firestore_v1.base_query")
+
+
+@dataclass
+class Write:
+    """DBManager.batchに渡す書き込み1件分"""
+
+    op: str  # "set" | "merge" | "update" | "delete"
+    collection: str
+    document: str
+    data: dict | None = None
+
+
+class DocumentCache:
+    """
+    (collection, document) -> data の、TTL付きLRUキャッシュ
+    このプロセスからの書き込みではinvalidateされ、他プロセスからの書き込みはTTLで反映される
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.epoch = (
+            0  # 書き込みのたびに増える。読み込み中に書き込みがあった場合はputしない
+        )
+        self._data: OrderedDict[tuple[str, str], tuple[float, dict | None]] = (
+            OrderedDict()
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.maxsize > 0 and self.ttl > 0
+
+    def get(self, key: tuple[str, str]) -> tuple[bool, dict | None]:
+        """(hit, data)を返す。呼び出し側で書き換えても良いようにコピーを返す"""
+        entry = self._data.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return False, None
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return True, copy.deepcopy(entry[1])
+
+    def put(self, key: tuple[str, str], data: dict | None, epoch: int):
+        if not self.enabled or epoch != self.epoch:
+            return
+        self._data[key] = (time.monotonic() + self.ttl, copy.deepcopy(data))
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key: tuple[str, str]):
+        self.epoch += 1
+        self.invalidations += 1
+        self._data.pop(key, None)
+
+    def clear(self):
+        self.epoch += 1
+        self._data.clear()
+
+    def stats(self) -> dict[str, int | float]:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+class CollectionMirror:
+    """
+    on_snapshotで受け取った変更を適用して、コレクションの内容をメモリ上に保持する
+    初回のスナップショット以降は差分だけが届く
+
+    コールバックはFirestoreのリスナースレッドから呼ばれるため、ロックで保護している
+    on_snapshot(docs, changes, read_time)に変更イベントを渡せば、リスナー無しでも再現できる
+
+    このプロセスからの書き込みは、完了して(コミット時刻 <= 受け取ったスナップショットのread_time)になるまで
+    ミラーから返さない。変更イベントが届かない書き込み(失敗・存在しないドキュメントの削除など)は、完了時に解除する
+    """
+
+    def __init__(self, collection: str):
+        self.collection = collection
+        self.ready = threading.Event()
+        self.hits = 0
+        self._lock = threading.Lock()
+        self._docs: dict[str, dict] = {}
+        # 最後に受け取ったスナップショットの時刻
+        self.read_time = None
+        # このプロセスから書き込み中のドキュメント (ドキュメントごとの書き込み中の数)
+        self._writing: Counter[str] = Counter()
+        # 書き込みは完了したが、まだ変更イベントが届いていないドキュメント {document: コミット時刻}
+        self._pending: dict[str, object] = {}
+
+    def on_snapshot(self, docs, changes, read_time):
+        with self._lock:
+            for change in changes:
+                doc_id = change.document.id
+                if change.type.name == "REMOVED":
+                    self._docs.pop(doc_id, None)
+                else:
+                    self._docs[doc_id] = change.document.to_dict()
+            self.read_time = read_time
+            self._pending = {
+                doc_id: commit_time
+                for doc_id, commit_time in self._pending.items()
+                if commit_time > read_time
+            }
+        self.ready.set()
+
+    def mark_pending(self, document: str | None):
+        with self._lock:
+            if document is None:
+                # ドキュメントを特定できない書き込みは、コレクション全体を待ち状態にする
+                self.ready.clear()
+            else:
+                self._writing[document] += 1
+
+    def finish_write(
+        self, document: str | None, commit_time=None, deleted: bool = False
+    ):
+        """
+        mark_pendingした書き込みが完了した時(失敗した場合も)に呼ぶ
+        commit_time: 書き込みが反映された時刻 (失敗した場合・何も書き込まなかった場合はNone)
+        """
+        with self._lock:
+            if document is not None:
+                self._writing[document] -= 1
+                if self._writing[document] <= 0:
+                    del self._writing[document]
+            # 変更イベントが既に届いている / 届かない(失敗した・もともと無いドキュメントを削除した)場合は待たない
+            applied = (
+                commit_time is None
+                or (self.read_time is not None and commit_time <= self.read_time)
+                or (
+                    deleted
+                    and (
+                        not self._docs
+                        if document is None
+                        else document not in self._docs
+                    )
+                )
+            )
+            if document is None:
+                if applied and self.read_time is not None:
+                    self.ready.set()
+            elif not applied:
+                self._pending[document] = max(
+                    self._pending.get(document, commit_time), commit_time
+                )
+
+    def _is_pending(self, document: str) -> bool:
+        return document in self._writing or document in self._pending
+
+    def get(self, document: str | None = None) -> tuple[bool, dict | list | None]:
+        """(hit, data)を返す。まだ同期できていない場合はhitしない"""
+        if not self.ready.is_set():
+            return False, None
+        with self._lock:
+            if document is None:
+                if self._writing or self._pending:
+                    return False, None
+                self.hits += 1
+                return True, [copy.deepcopy(d) for d in self._docs.values()]
+            if self._is_pending(document):
+                return False, None
+            self.hits += 1
+            return True, copy.deepcopy(self._docs.get(document))
+
+    def query(
+        self,
+        filters: list[tuple[str, str, object]],
+        order_by: str | None = None,
+        limit: int | None = None,
+        descending: bool = False,
+    ) -> tuple[bool, list[dict] | None]:
+        """DBManager.queryと同じ条件をメモリ上で評価する。(hit, data)を返す"""
+        if not self.ready.is_set():
+            return False, None
+        with self._lock:
+            if self._writing or self._pending:
+                return False, None
+            docs = [
+                doc
+                for doc in self._docs.values()
+                if all(utils.match_filter(doc, *f) for f in filters)
+            ]
+            self.hits += 1
+        if order_by:
+            docs = sorted(
+                (doc for doc in docs if order_by in doc),
+                key=lambda doc: utils.comparable(doc[order_by]),
+                reverse=descending,
+            )
+        if limit:
+            docs = docs[:limit]
+        return True, copy.deepcopy(docs)
 
 
 class DBManager(metaclass=utils.Singleton):
-    def __init__(self):
-        url = os.getenv("MEMBER_TAGGER_FIREBASE_CREDENTIALS")
-        self.cred = credentials.Certificate(requests.get(url).json())
+    # Firestoreのクライアントは同期APIのため、専用のスレッドプールで実行する
+    # (イベントループを止めないため。同時に投げるRPCの数もここで制限する)
+    MAX_WORKERS = int(os.getenv("MEMBER_TAGGER_DB_WORKERS", "8"))
+    BATCH_LIMIT = 500  # Firestoreの1バッチあたりの書き込み数の上限
+    BATCH_CONCURRENCY = int(os.getenv("MEMBER_TAGGER_BATCH_CONCURRENCY", "4"))
+    # 競合したトランザクションの再試行 (回数の上限と、指数バックオフの初期値(秒))
+    TRANSACTION_ATTEMPTS = 10
+    TRANSACTION_BACKOFF = 0.01
+    # ドキュメントのキャッシュ (どちらかを0にすると無効)
+    CACHE_SIZE = int(os.getenv("MEMBER_TAGGER_CACHE_SIZE", "1024"))
+    CACHE_TTL = float(os.getenv("MEMBER_TAGGER_CACHE_TTL", "60"))
+    # ストレージ: "firestore" | "sqlite" (sqliteはネットワーク無しで動かす小規模な環境・開発用)
+    STORAGE = os.getenv("MEMBER_TAGGER_STORAGE", "firestore")
+    SQLITE_PATH = os.getenv("MEMBER_TAGGER_SQLITE_PATH", "member_tagger.sqlite3")
+    # スナップショットリスナーでメモリ上に保持するコレクション (opt-in, Firestoreのみ)
+    LIVE_MIRROR = os.getenv("MEMBER_TAGGER_LIVE_MIRROR", "0") == "1"
+    MIRRORED_COLLECTIONS = ("users", "tags", "notify")
+
+    def __init__(
+        self, db=None, max_workers: int | None = None, live_mirror: bool | None = None
+    ):
+        """
+        db: firestore.Clientと同じインターフェースのオブジェクト
+        (SQLiteClient、ベンチマーク用のFakeFirestoreなど。渡さない場合はSTORAGEに従って、最初に使う時に作る)
+        """
+        self._db = db
+        self._db_lock = threading.Lock()
+        # ストレージの接続にかかった時間など (起動時のログに使う)
+        self.startup_times: dict[str, float | str] = {}
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers or self.MAX_WORKERS,
+            thread_name_prefix="firestore",
+        )
+        self.cache = DocumentCache(maxsize=self.CACHE_SIZE, ttl=self.CACHE_TTL)
+        self.mirrors: dict[str, CollectionMirror] = {}
+        self._watches = []
+        # tagsコレクションの列指向のテーブル (TagManager.get_tag_tableが作り、TagManagerの間で共有する)
+        self.tag_table: TagTable | None = None
+        if live_mirror is None:
+            live_mirror = self.LIVE_MIRROR and self.STORAGE == "firestore"
+        self.live_mirror = live_mirror
+        if db is not None and live_mirror:
+            self.start_mirror()
+
+    @property
+    def db(self):
+        """
+        ストレージのクライアント。まだ作られていない場合はここで作る(ブロックする)
+        botではconnect()で、Discordへの接続と並行して先に作っておく
+        """
+        if self._db is None:
+            with self._db_lock:
+                if self._db is None:
+                    self._db = self.create_db()
+                    if self.live_mirror:
+                        self.start_mirror()
+        return self._db
+
+    async def connect(self):
+        """ストレージのクライアントをスレッドプールで作る (イベントループをブロックしない)"""
+        loop = asyncio.get_running_loop()
+        if self._db is None:
+            await loop.run_in_executor(self.executor, lambda: self.db)
+        # タグの書き込みなどで使うモジュールも、最初の書き込みより前に読み込んでおく
+        for module in (firestore, exceptions, base_query, utils.transforms):
+            await loop.run_in_executor(self.executor, module.load)
+        # キャッシュした認証情報を使った場合は、次回の起動に備えて取り直しておく
+        if self.startup_times.get("credentials") == "cache":
+            loop.run_in_executor(None, firebase_credentials.refresh)
+
+    def create_db(self):
+        start = time.perf_counter()
+        if self.STORAGE == "sqlite":
+            from sqlite_store import SQLiteClient
+
+            db = SQLiteClient(self.SQLITE_PATH)
+            self.startup_times["connect_sec"] = time.perf_counter() - start
+            return db
+        if self.STORAGE != "firestore":
+            raise ValueError(f"Invalid storage. (storage: {self.STORAGE})")
+
+        info, source = firebase_credentials.load()
+        self.startup_times["credentials"] = source
+        self.startup_times["credentials_sec"] = time.perf_counter() - start
+        self.cred = credentials.Certificate(info)
         firebase_admin.initialize_app(self.cred)
-        self.db = firestore.client()
+        db = firestore.client()
+        self.startup_times["connect_sec"] = time.perf_counter() - start
+        return db
+
+    def start_mirror(self, collections: tuple[str, ...] = MIRRORED_COLLECTIONS):
+        """collectionsにスナップショットリスナーを登録し、以降の読み込みをメモリから返す"""
+        for collection in collections:
+            if collection in self.mirrors:
+                continue
+            mirror = CollectionMirror(collection)
+            self.mirrors[collection] = mirror
+            self._watches.append(
+                self.db.collection(collection).on_snapshot(mirror.on_snapshot)
+            )
 
-    def set(self, collection: str, document: str | None, data: dict) -> bool:
+    def stop_mirror(self):
+        for watch in self._watches:
+            watch.unsubscribe()
+        self._watches = []
+        self.mirrors = {}
+
+    def _begin_write(self, collection: str, document: str | None):
+        # 変更イベントが届くまでは、ミラーではなくキャッシュ/Firestoreから読む
+        # (イベントは書き込みの完了より先に届くことがあるため、書き込み前に印を付ける)
+        if collection in self.mirrors:
+            self.mirrors[collection].mark_pending(document)
+
+    def _invalidate(self, collection: str, document: str | None):
+        if document is not None:
+            self.cache.invalidate((collection, document))
+
+    def _end_write(
+        self,
+        collection: str,
+        document: str | None,
+        commit_time=None,
+        deleted: bool = False,
+    ):
+        # 書き込みの完了(失敗した場合も)。変更イベントを待たずに、ミラーの待ち状態をここで解除できるようにする
+        self._invalidate(collection, document)
+        if collection in self.mirrors:
+            self.mirrors[collection].finish_write(document, commit_time, deleted)
+
+    @staticmethod
+    def _commit_time(result):
+        """
+        書き込みの戻り値から、書き込みが反映された時刻を取り出す
+        (set/update: WriteResult, add: (時刻, DocumentReference), delete: 時刻)
+        """
+        if isinstance(result, tuple):
+            result = result[0]
+        return getattr(result, "update_time", result)
+
+    async def _run(self, func, *args, **kwargs):
+        # ストレージとの1往復 (キャッシュ・ミラーから返す場合は呼ばれない)
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        try:
+            return await loop.run_in_executor(
+                self.executor, functools.partial(func, *args, **kwargs)
+            )
+        finally:
+            Metrics().record_round_trip(time.perf_counter() - start)
+
+    @db_call
+    async def set(
+        self, collection: str, document: str | None, data: dict, merge: bool = False
+    ) -> bool:
+        self._begin_write(collection, document)
+        commit_time = None
         try:
             if document:
-                self.db.collection(collection).document(document).set(data)
+                result = await self._run(
+                    self.db.collection(collection).document(document).set,
+                    data,
+                    merge=merge,
+                )
             else:
-                self.db.collection(collection).add(data)
+                result = await self._run(self.db.collection(collection).add, data)
+            commit_time = self._commit_time(result)
             return True
         except Exception as e:
             print(e)
             return False
+        finally:
+            self._end_write(collection, document, commit_time)
+
+    @db_call
+    async def get(self, collection: str, document: str | None = None) -> dict:
+        if collection in self.mirrors:
+            hit, data = self.mirrors[collection].get(document)
+            if hit:
+                return data
 
-    def get(self, collection: str, document: str | None = None) -> dict:
+        if document and self.cache.enabled:
+            hit, data = self.cache.get((collection, document))
+            if hit:
+                return data
+
+        epoch = self.cache.epoch
         try:
             doc_ref = (
                 self.db.collection(collection).document(document)
                 if document
                 else self.db.collection(collection)
             )
-            doc = doc_ref.get()
+            doc = await self._run(doc_ref.get)
             if isinstance(doc, list):
+                # コレクション全体を読んだ場合も、各ドキュメントをキャッシュしておく
+                for d in doc:
+                    self.cache.put((collection, d.id), d.to_dict(), epoch)
                 return [d.to_dict() for d in doc]
             else:
+                self.cache.put((collection, document), doc.to_dict(), epoch)
                 return doc.to_dict()
         except Exception as e:
             print(e)
             return {}
 
-    def update(self, collection: str, document: str, data: dict) -> bool:
+    @db_call
+    async def get_many(
+        self, collection: str, documents: list[str]
+    ) -> dict[str, dict | None]:
+        """複数のドキュメントを1回のRPC(get_all)で取得する。{document: data}を返す"""
+        result = {}
+        missing = []
+        mirror = self.mirrors.get(collection)
+        for document in documents:
+            hit, data = mirror.get(document) if mirror else (False, None)
+            if not hit:
+                hit, data = self.cache.get((collection, document))
+            if hit:
+                result[document] = data
+            else:
+                missing.append(document)
+        if not missing:
+            return result
+
+        epoch = self.cache.epoch
+        try:
+            refs = [self.db.collection(collection).document(d) for d in missing]
+            docs = await self._run(lambda: list(self.db.get_all(refs)))
+            for doc in docs:
+                self.cache.put((collection, doc.id), doc.to_dict(), epoch)
+                result[doc.id] = doc.to_dict()
+            return result
+        except Exception as e:
+            print(e)
+            return result
+
+    @db_call
+    async def get_ids(self, collection: str) -> list[str]:
+        """コレクション内のドキュメントIDだけを取得する(フィールドは転送しない)"""
+        try:
+            docs = await self._run(
+                lambda: list(self.db.collection(collection).select([]).stream())
+            )
+            return [doc.id for doc in docs]
+        except Exception as e:
+            print(e)
+            return []
+
+    @db_call
+    async def query(
+        self,
+        collection: str,
+        filters: list[tuple[str, str, object]] | None = None,
+        order_by: str | None = None,
+        limit: int | None = None,
+        start_after: object = None,
+        descending: bool = False,
+    ) -> list[dict]:
+        """
+        filters: [(field, op, value), ...] の条件に一致するドキュメントを取得する
+        start_after: ページング用のカーソル (order_byのフィールドの、前のページの最後の値)
+        descending: order_byのフィールドの降順で取得する (前のページを遡る場合など)
+        """
+        if collection in self.mirrors and start_after is None:
+            hit, data = self.mirrors[collection].query(
+                filters or [], order_by, limit, descending
+            )
+            if hit:
+                return data
+
+        try:
+            query = self.db.collection(collection)
+            for field, op, value in filters or []:
+                query = query.where(filter=base_query.FieldFilter(field, op, value))
+            if order_by:
+                query = query.order_by(
+                    order_by, direction="DESCENDING" if descending else "ASCENDING"
+                )
+            if start_after is not None:
+                query = query.start_after({order_by: start_after})
+            if limit:
+                query = query.limit(limit)
+            docs = await self._run(lambda: list(query.stream()))
+            return [doc.to_dict() for doc in docs]
+        except Exception as e:
+            print(e)
+            return []
+
+    @db_call
+    async def update(self, collection: str, document: str, data: dict) -> bool:
+        self._begin_write(collection, document)
+        commit_time = None
         try:
-            self.db.collection(collection).document(document).update(data)
+            result = await self._run(
+                self.db.collection(collection).document(document).update, data
+            )
+            commit_time = self._commit_time(result)
             return True
         except Exception as e:
             print(e)
             return False
+        finally:
+            self._end_write(collection, document, commit_time)
 
-    def delete(self, collection: str, document: str) -> bool:
+    @db_call
+    async def delete(self, collection: str, document: str) -> bool:
+        self._begin_write(collection, document)
+        commit_time = None
         try:
-            self.db.collection(collection).document(document).delete()
+            result = await self._run(
+                self.db.collection(collection).document(document).delete
+            )
+            commit_time = self._commit_time(result)
             return True
         except Exception as e:
             print(e)
             return False
+        finally:
+            self._end_write(collection, document, commit_time, deleted=True)
+
+    @db_call
+    async def batch(
+        self,
+        writes: list[Write],
+        progress: Callable[[int, int], None] | None = None,
+    ) -> bool:
+        """
+        writesをWriteBatchでまとめて書き込む(BATCH_LIMIT件ごとに1回のコミット)
+        複数のコミットは最大BATCH_CONCURRENCY件まで並行して行い、コミットごとにprogress(完了件数, 全件数)を呼ぶ
+        BATCH_LIMIT件を超える場合、コミット間の原子性はない
+        """
+
+        def _commit(chunk: list[Write]):
+            batch = self.db.batch()
+            for write in chunk:
+                ref = self.db.collection(write.collection).document(write.document)
+                if write.op == "set":
+                    batch.set(ref, write.data)
+                elif write.op == "merge":
+                    batch.set(ref, write.data, merge=True)
+                elif write.op == "update":
+                    batch.update(ref, write.data)
+                elif write.op == "delete":
+                    batch.delete(ref)
+                else:
+                    raise ValueError(f"Invalid write operation. (op: {write.op})")
+            batch.commit()
+            return batch.commit_time
+
+        semaphore = asyncio.Semaphore(self.BATCH_CONCURRENCY)
+        done = 0
+
+        async def _commit_chunk(chunk: list[Write]) -> bool:
+            nonlocal done
+            async with semaphore:
+                commit_time = None
+                try:
+                    commit_time = await self._run(_commit, chunk)
+                except Exception as e:
+                    print(e)
+                    return False
+                finally:
+                    for write in chunk:
+                        self._end_write(
+                            write.collection,
+                            write.document,
+                            commit_time,
+                            deleted=write.op == "delete",
+                        )
+
+            done += len(chunk)
+            if progress:
+                progress(done, len(writes))
+            return True
+
+        for write in writes:
+            self._begin_write(write.collection, write.document)
+        results = await asyncio.gather(
+            *[
+                _commit_chunk(writes[start : start + self.BATCH_LIMIT])
+                for start in range(0, len(writes), self.BATCH_LIMIT)
+            ]
+        )
+        return all(results)
+
+    @staticmethod
+    def _aborted(error: BaseException) -> bool:
+        """
+        競合(Aborted)によるエラーか
+        google-cloud-firestoreのバージョンによって、Abortedがそのまま送出される場合と
+        ValueErrorなどに包まれる場合(__cause__/__context__)があるため、原因を辿って調べる
+        """
+        seen = set()
+        while error is not None and id(error) not in seen:
+            if isinstance(error, exceptions.Aborted):
+                return True
+            seen.add(id(error))
+            error = error.__cause__ or error.__context__
+        return False
+
+    @db_call
+    async def transaction(
+        self,
+        collection: str,
+        document: str,
+        func: Callable[[dict | None], dict | None],
+    ) -> dict | None:
+        """
+        ドキュメントを読み、func(data)が返したフィールドでupdateするまでをトランザクションで行う
+        並行した書き込みと競合した場合は、待機(ジッター付きの指数バックオフ)してから最新のデータでfuncを呼び直す
+        待機はイベントループ上で行うため、スレッドプールのワーカーを占有しない
+        funcの戻り値を返す (Noneを返した場合は書き込まない)。失敗した場合もNoneを返す
+        """
+        ref = self.db.collection(collection).document(document)
+
+        @firestore.transactional
+        def _apply(transaction):
+            fields = func(ref.get(transaction=transaction).to_dict())
+            if fields is not None:
+                transaction.update(ref, fields)
+            return fields
 
-    def add_document(
+        self._begin_write(collection, document)
+        commit_time = None
+        try:
+            for attempt in range(self.TRANSACTION_ATTEMPTS):
+                transaction = self.db.transaction(max_attempts=1)
+                try:
+                    fields = await self._run(_apply, transaction)
+                    # funcがNoneを返した場合は何も書き込んでいない
+                    if fields is not None:
+                        commit_time = transaction.commit_time
+                    return fields
+                except Exception as e:
+                    # 競合(Aborted)以外のエラーは再試行しない
+                    if not self._aborted(e):
+                        raise
+                await asyncio.sleep(
+                    random.uniform(0, self.TRANSACTION_BACKOFF * 2**attempt)
+                )
+            raise RuntimeError(
+                f"Transaction gave up after {self.TRANSACTION_ATTEMPTS} attempts: {collection}/{document}"
+            )
+        except Exception as e:
+            print(e)
+            return None
+        finally:
+            self._end_write(collection, document, commit_time)
+
+    @db_call
+    async def add_document(
         self,
         collection: str,
         document_data: dict,
         document_id: str,
         timeout_sec: int | float = None,
     ) -> bool:
+        self._begin_write(collection, document_id)
+        commit_time = None
         try:
             if not timeout_sec:
-                self.db.collection(collection).add(document_data, document_id)
+                result = await self._run(
+                    self.db.collection(collection).add, document_data, document_id
+                )
             else:
-                self.db.collection(collection).add(
-                    document_data, document_id, timeout_sec
+                result = await self._run(
+                    self.db.collection(collection).add,
+                    document_data,
+                    document_id,
+                    timeout_sec,
                 )
-
+            commit_time = self._commit_time(result)
             return True
         except Exception as e:
             print(e)
             return False
+        finally:
+            self._end_write(collection, document_id, commit_time)
 
-    def delete_collection(self, collection: str, batch_size: int = 10):
+    @db_call
+    async def delete_collection(self, collection: str, batch_size: int = 10):
         # コレクション内のドキュメントを削除
-        docs = self.db.collection(collection).limit(batch_size).stream()
-        deleted = 0
-        for doc in docs:
-            doc.reference.delete()
-            deleted += 1
-        if deleted >= batch_size:
-            return self.delete_collection(collection, batch_size)
+        self._begin_write(collection, None)
+        commit_time = None
+
+        def _delete_batch() -> int:
+            nonlocal commit_time
+            docs = self.db.collection(collection).limit(batch_size).stream()
+            deleted = 0
+            for doc in docs:
+                commit_time = self._commit_time(doc.reference.delete())
+                deleted += 1
+            return deleted
+
+        try:
+            while await self._run(_delete_batch) >= batch_size:
+                pass
+        finally:
+            self.cache.clear()
+            self._end_write(collection, None, commit_time, deleted=True)
         return
 
 
-# TODO: TagManager全体のメソッドにおいて、一度のアクセスで追加・削除・取得を行うように変更
 class TagManager:
-    def __init__(self):
-        self.db_manager = DBManager()
-
-    def add_tag(self, tag: Tag):
-        for user in tag.users:
-            user_id = user.id
-            fetched_user = self.db_manager.get("users", str(user_id))
-            # 存在しないキーの配下に新しいキーを追加するとエラーが発生するため、キーが存在しない場合は追加する
-            if str(tag.guild_id) not in fetched_user["tags"]:
-                fetched_user["tags"][str(tag.guild_id)] = {}
-            if str(tag.thread_id) not in fetched_user["tags"][str(tag.guild_id)]:
-                fetched_user["tags"][str(tag.guild_id)][str(tag.thread_id)] = (
-                    tag.deadline
-                )
-            else:
-                fetched_user["tags"][str(tag.guild_id)][str(tag.thread_id)] = (
-                    tag.deadline
+    # (guild_id, thread_id) -> [user_id, ...] の逆引きインデックス
+    # get_users_by_threadがusersコレクション全体を読まずに済むようにするためのもの
+    THREAD_INDEX = "thread_index"
+    THREAD_INDEX_META = "_meta"
+    # 2: 通知のスケジューリング用にdeadlineを追加, 3: ギルドごとのタグ一覧(GUILD_TAGS)を追加
+    # 4: GUILD_TAGSを廃止 (再構築で削除する)
+    THREAD_INDEX_VERSION = 4
+    # 廃止したギルドごとのタグ一覧 (guild_id -> 全タグの1ドキュメント)
+    # ドキュメントの上限(1MiB)と書き込みの集中があるため、/get_allはtagsコレクションへのクエリで読む
+    GUILD_TAGS = "guild_tags"
+    # タグは(ユーザー, スレッド)ごとに1件のドキュメント
+    # {user_id, guild_id, thread_id, deadline} を持ち、user_id/guild_id/deadlineで検索できる
+    TAGS = "tags"
+    SCHEMA = ("meta", "schema")
+    SCHEMA_VERSION = (
+        2  # 2: タグ・タスクをユーザーのドキュメントから個別のドキュメントに分離
+    )
+    IN_QUERY_LIMIT = 30  # Firestoreのinクエリで渡せる値の上限
+    TASK_PAGE_SIZE = 25  # セレクトメニューに表示できる選択肢の上限
+    # タグのテーブル(TagTable)を作り直す間隔(秒)。他のプロセスからの書き込みは、この間隔で反映される
+    # (このプロセスからの書き込みはすぐに反映する。コマンドは、この間隔以内のテーブルがある場合だけ使う)
+    TAG_TABLE_TTL = float(os.getenv("MEMBER_TAGGER_TAG_TABLE_TTL", "600"))
+
+    def __init__(self, db_manager: DBManager | None = None):
+        # 渡さない場合は、共有のDBManager(STORAGEで選んだストレージ)を使う
+        self.db_manager = db_manager or DBManager()
+
+    @staticmethod
+    def thread_index_id(guild_id: int | str, thread_id: int | str) -> str:
+        return f"{guild_id}-{thread_id}"
+
+    @staticmethod
+    def tag_id(guild_id: int | str, thread_id: int | str, user_id: int | str) -> str:
+        return f"{guild_id}-{thread_id}-{user_id}"
+
+    @staticmethod
+    def tasks_collection(user_id: int | str) -> str:
+        # タスクはユーザーごとのサブコレクション users/<user_id>/tasks に置く
+        return f"users/{user_id}/tasks"
+
+    def _tag_write(self, tag: Tag, user: discord.User, remove: bool = False):
+        document = self.tag_id(tag.guild_id, tag.thread_id, user.id)
+        if remove:
+            return Write("delete", self.TAGS, document)
+        return Write(
+            "set",
+            self.TAGS,
+            document,
+            {
+                "user_id": user.id,
+                "guild_id": str(tag.guild_id),
+                "thread_id": str(tag.thread_id),
+                "deadline": tag.deadline,
+            },
+        )
+
+    def _index_write(
+        self,
+        tag: Tag,
+        user_ids: list[int],
+        deadline: datetime.datetime | None,
+        remove: bool = False,
+    ):
+        # ArrayUnion/ArrayRemoveで書き込むため、インデックスの読み込みは不要
+        transform = firestore.ArrayRemove if remove else firestore.ArrayUnion
+        data = {
+            "guild_id": str(tag.guild_id),
+            "thread_id": str(tag.thread_id),
+            "user_ids": transform(user_ids),
+            # deadlineはスレッドの期限 (_thread_deadlineで求める。通知のスケジューリングに使う)
+            "deadline": firestore.DELETE_FIELD if deadline is None else deadline,
+        }
+        return Write(
+            "merge",
+            self.THREAD_INDEX,
+            self.thread_index_id(tag.guild_id, tag.thread_id),
+            data,
+        )
+
+    async def rebuild_thread_index(self, tag_docs: list[dict] | None = None) -> int:
+        """
+        tagsコレクションから逆引きインデックスを再構築する (廃止したギルドごとのタグ一覧は削除する)
+        作成したインデックスの数を返す
+        """
+        if tag_docs is None:
+            epoch = self.db_manager.cache.epoch
+            tag_docs = await self.db_manager.get(self.TAGS) or []
+            # 全件を読んだついでに、タグのテーブルも作っておく
+            self._share_tag_table(await self._build_tag_table(tag_docs), epoch)
+
+        index: dict[tuple[str, str], dict] = {}
+        for tag_doc in tag_docs:
+            guild_id, thread_id = tag_doc["guild_id"], tag_doc["thread_id"]
+            deadline = tag_doc["deadline"]
+            entry = index.setdefault(
+                (guild_id, thread_id),
+                {
+                    "guild_id": guild_id,
+                    "thread_id": thread_id,
+                    "user_ids": [],
+                    "deadline": None,
+                },
+            )
+            entry["user_ids"].append(tag_doc["user_id"])
+            entry["deadline"] = utils.latest_deadline((entry["deadline"], deadline))
+
+        writes = [
+            Write(
+                "set",
+                self.THREAD_INDEX,
+                self.thread_index_id(guild_id, thread_id),
+                entry,
+            )
+            for (guild_id, thread_id), entry in index.items()
+        ]
+        writes += [
+            Write("delete", self.GUILD_TAGS, guild_id)
+            for guild_id in await self.db_manager.get_ids(self.GUILD_TAGS)
+        ]
+        writes.append(
+            Write(
+                "set",
+                self.THREAD_INDEX,
+                self.THREAD_INDEX_META,
+                {"version": self.THREAD_INDEX_VERSION},
+            )
+        )
+        await self.db_manager.batch(writes)
+        return len(index)
+
+    async def thread_index_ready(self) -> bool:
+        meta = await self.db_manager.get(self.THREAD_INDEX, self.THREAD_INDEX_META)
+        return bool(meta) and meta.get("version") == self.THREAD_INDEX_VERSION
+
+    async def schema_ready(self) -> bool:
+        """migrate.pyによる、タグ・タスクの個別ドキュメントへの移行が済んでいるか"""
+        meta = await self.db_manager.get(*self.SCHEMA)
+        return bool(meta) and meta.get("version") == self.SCHEMA_VERSION
+
+    async def mark_schema(self):
+        await self.db_manager.set(*self.SCHEMA, {"version": self.SCHEMA_VERSION})
+
+    async def _thread_deadline(
+        self,
+        guild_id: int | str,
+        thread_id: int | str,
+        user_ids: list[int],
+        deadline: datetime.datetime | None = None,
+    ) -> datetime.datetime | None:
+        """
+        user_idsのタグを期限deadlineで書き換えた(Noneの場合は削除した)後の、スレッドの期限
+        rebuild_thread_indexと同じく、スレッドのタグの期限のうち最も遅いものとする
+        読み込み済みのタグのテーブルがある場合はそれを、無い場合はスレッドのタグを1回のクエリで読む
+        """
+        table = self.fresh_tag_table()
+        if table is not None:
+            deadlines = table.thread_deadlines(guild_id, thread_id)
+        else:
+            tag_docs = await self.db_manager.query(
+                self.TAGS,
+                [
+                    ("guild_id", "==", str(guild_id)),
+                    ("thread_id", "==", str(thread_id)),
+                ],
+            )
+            deadlines = {
+                tag_doc["user_id"]: tag_doc["deadline"] for tag_doc in tag_docs
+            }
+        return utils.latest_deadline(
+            [
+                other_deadline
+                for user_id, other_deadline in deadlines.items()
+                if user_id not in user_ids
+            ]
+            + [deadline]
+        )
+
+    # タグの追加・削除・更新は、(ユーザー, スレッド)ごとのタグのドキュメントを書き換え、
+    # 逆引きインデックスの更新と合わせて1回のバッチで送る
+    # (事前の読み込みは、スレッドの期限を求めるためのスレッドのタグ(テーブルがある場合は不要)のみ)
+    async def add_tag(self, tag: Tag):
+        user_ids = [user.id for user in tag.users]
+        deadline = await self._thread_deadline(
+            tag.guild_id, tag.thread_id, user_ids, tag.deadline
+        )
+        writes = [self._tag_write(tag, user) for user in tag.users]
+        writes.append(self._index_write(tag, user_ids, deadline))
+        table = self.db_manager.tag_table
+        if await self.db_manager.batch(writes) and table is not None:
+            table.upsert(
+                (user_id, tag.guild_id, tag.thread_id, tag.deadline)
+                for user_id in user_ids
+            )
+
+    async def remove_tag(self, tag: Tag):
+        user_ids = [user.id for user in tag.users]
+        deadline = await self._thread_deadline(tag.guild_id, tag.thread_id, user_ids)
+        writes = [self._tag_write(tag, user, remove=True) for user in tag.users]
+        writes.append(self._index_write(tag, user_ids, deadline, remove=True))
+        table = self.db_manager.tag_table
+        if await self.db_manager.batch(writes) and table is not None:
+            table.delete((user_id, tag.guild_id, tag.thread_id) for user_id in user_ids)
+
+    @staticmethod
+    async def _build_tag_table(tag_docs: list[dict]) -> TagTable:
+        # 全件の並べ替えはイベントループを止めるため、executorで行う
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, TagTable.build, tag_docs)
+
+    def _share_tag_table(self, table: TagTable, epoch: int):
+        # 読み込み中に書き込みがあった場合は、反映されていない可能性があるため共有しない
+        if epoch == self.db_manager.cache.epoch:
+            self.db_manager.tag_table = table
+
+    def fresh_tag_table(self, max_age: float | None = None) -> TagTable | None:
+        """作ってからmax_age秒(デフォルトはTAG_TABLE_TTL)以内のタグのテーブル。無い場合はNone"""
+        table = self.db_manager.tag_table
+        max_age = self.TAG_TABLE_TTL if max_age is None else max_age
+        if table is None or table.age() > max_age:
+            return None
+        return table
+
+    async def get_tag_table(self, max_age: float | None = None) -> TagTable:
+        """
+        全タグの列指向のテーブル (ギルド・ユーザー・スレッド・期限での検索は二分探索)
+        max_age秒(デフォルトはTAG_TABLE_TTL)より古い場合は、tagsコレクションを1回読んで作り直す
+        """
+        table = self.fresh_tag_table(max_age)
+        if table is not None:
+            return table
+
+        epoch = self.db_manager.cache.epoch
+        table = await self._build_tag_table(await self.db_manager.get(self.TAGS) or [])
+        self._share_tag_table(table, epoch)
+        return table
+
+    async def get_guild_tags(
+        self, guild_id: int | str
+    ) -> list[tuple[int, str, datetime.datetime]]:
+        """ギルドのタグを [(user_id, thread_id, deadline), ...] (期限順) で取得する"""
+        # 読み込み済みのタグのテーブルがある場合は、それを使う (読み込みなし)
+        table = self.fresh_tag_table()
+        if table is not None:
+            return table.guild_tags(guild_id)
+
+        # ギルドのタグのドキュメントだけを読む (期限の無いタグも含めるため、並べ替えはここで行う)
+        tag_docs = await self.db_manager.query(
+            self.TAGS, [("guild_id", "==", str(guild_id))]
+        )
+        return [
+            (tag_doc["user_id"], tag_doc["thread_id"], tag_doc["deadline"])
+            for tag_doc in sorted(
+                tag_docs, key=lambda tag_doc: utils.deadline_key(tag_doc["deadline"])
+            )
+        ]
+
+    async def get_tags(self, user: discord.User):
+        """{guild_id: {thread_id: deadline}}"""
+        tags = {}
+        for tag_doc in await self.db_manager.query(
+            self.TAGS, [("user_id", "==", user.id)]
+        ):
+            tags.setdefault(tag_doc["guild_id"], {})[tag_doc["thread_id"]] = tag_doc[
+                "deadline"
+            ]
+        return tags
+
+    async def update_tag(self, tag: Tag):
+        await self.add_tag(tag)
+
+    async def get_thread_index(
+        self, guild_id: int | str, thread_id: int | str
+    ) -> dict | None:
+        return await self.db_manager.get(
+            self.THREAD_INDEX, self.thread_index_id(guild_id, thread_id)
+        )
+
+    async def get_upcoming_deadlines(self, after: datetime.datetime) -> list[dict]:
+        """deadlineがafter以降のスレッドを、インデックスへの範囲クエリで期限順に取得する"""
+        return await self.db_manager.query(
+            self.THREAD_INDEX, [("deadline", ">=", after)], order_by="deadline"
+        )
+
+    async def mark_reminded(
+        self, guild_id: int | str, thread_id: int | str, deadline: datetime.datetime
+    ):
+        """スレッドの期限deadlineのリマインドを送ったことを記録する (再起動後に同じリマインドを送らないため)"""
+        await self.db_manager.set(
+            self.THREAD_INDEX,
+            self.thread_index_id(guild_id, thread_id),
+            {"reminded": deadline},
+            merge=True,
+        )
+
+    async def get_users_by_thread(self, tag: Tag):
+        table = self.fresh_tag_table()
+        if table is not None:
+            user_ids = table.thread_user_ids(tag.guild_id, tag.thread_id)
+        else:
+            # 逆引きインデックスを1件読むだけで済ませる(ユーザー数に依存しない)
+            index = await self.get_thread_index(tag.guild_id, tag.thread_id)
+            if not index:
+                return []
+            user_ids = index["user_ids"]
+
+        users = [tag.client.get_user(user_id) for user_id in user_ids]
+        return [user for user in users if user]
+
+    @staticmethod
+    def threads_from_tag_docs(
+        tag_docs: list[dict],
+    ) -> dict[int, dict[str, list[tuple[str, datetime.datetime]]]]:
+        """タグのドキュメントから {user_id: {guild_id: [(thread_id, deadline), ...]}} を作る (期限順)"""
+        threads_by_user = {}
+        for tag_doc in sorted(
+            tag_docs, key=lambda tag_doc: utils.deadline_key(tag_doc["deadline"])
+        ):
+            threads_by_user.setdefault(tag_doc["user_id"], {}).setdefault(
+                tag_doc["guild_id"], []
+            ).append((tag_doc["thread_id"], tag_doc["deadline"]))
+        return threads_by_user
+
+    async def get_threads_by_users(
+        self, users: list[discord.User] | None = None
+    ) -> dict[int, dict[str, list[tuple[str, datetime.datetime]]]]:
+        """
+        複数ユーザーのスレッドをまとめて取得する。{user_id: {guild_id: [(thread_id, deadline), ...]}}
+        usersを渡さない場合は全ユーザーが対象(tagsコレクションを1回読むだけ)
+        渡した場合はuser_idのinクエリ(IN_QUERY_LIMIT件ずつ、並行して実行)で取得する
+        読み込み済みのタグのテーブルがある場合は、それを使う (読み込みなし)
+        """
+        table = self.fresh_tag_table()
+        if table is not None:
+            return table.threads_by_users(
+                None if users is None else [user.id for user in users]
+            )
+
+        if users is None:
+            return self.threads_from_tag_docs(
+                await self.db_manager.get(self.TAGS) or []
+            )
+
+        user_ids = [user.id for user in users]
+        results = await asyncio.gather(
+            *[
+                self.db_manager.query(
+                    self.TAGS,
+                    [("user_id", "in", user_ids[start : start + self.IN_QUERY_LIMIT])],
                 )
-            self.db_manager.update("users", str(user_id), fetched_user)
-
-    def remove_tag(self, tag: Tag):
-        for user in tag.users:
-            user_id = user.id
-            fetched_user = self.db_manager.get("users", str(user_id))
-            fetched_user["tags"][str(tag.guild_id)].pop(str(tag.thread_id))
-            # もし、guild_id配下にthread_idが存在しなくなった場合は、guild_idを削除
-            if not fetched_user["tags"][str(tag.guild_id)]:
-                fetched_user["tags"].pop(str(tag.guild_id))
-
-            self.db_manager.update("users", str(user_id), fetched_user)
-
-    def get_tags(self, user: discord.User):
-        fetched_user = self.db_manager.get("users", str(user.id))
-        return fetched_user["tags"]
-
-    def update_tag(self, tag: Tag):
-        for user in tag.users:
-            user_id = user.id
-            fetched_user = self.db_manager.get("users", str(user_id))
-            fetched_user["tags"][str(tag.guild_id)][str(tag.thread_id)] = tag.deadline
-            self.db_manager.update("users", str(user_id), fetched_user)
-
-    def get_users_by_thread(self, tag: Tag):
-        guild_id = tag.guild_id
-        thread_id = tag.thread_id
-        user_ids = []
-        fetched_user = self.db_manager.get("users")
-        # ユーザーごとに、ギルドIDとスレッドIDが一致するかを確認し、一致する場合はユーザーIDをリストに追加
-
-        for user in fetched_user:
-            if (
-                str(guild_id) in user["tags"]
-                and str(thread_id) in user["tags"][str(guild_id)]
-            ):
-                user_ids.append(tag.client.get_user(user["user_id"]))
-
-        return user_ids
-
-    def get_threads_by_user(
+                for start in range(0, len(user_ids), self.IN_QUERY_LIMIT)
+            ]
+        )
+        return self.threads_from_tag_docs(
+            [tag_doc for tag_docs in results for tag_doc in tag_docs]
+        )
+
+    async def get_threads_by_user(
         self, users: list[discord.User]
     ) -> dict[str, list[tuple[str, datetime.datetime]]]:
-        for user in users:
-            user_id = user.id
-            fetched_user = self.db_manager.get("users", str(user_id))
-            threads = {}
-            for guild_id in fetched_user["tags"].keys():
-                guild_threads = []
-                for thread_id in fetched_user["tags"][guild_id].items():
-                    guild_threads.append(thread_id)
-                threads[guild_id] = guild_threads
-        return threads
-
-    def add_user(self, user: discord.User):
-        user_data = {
+        # 複数ユーザーを渡された場合は、従来通り最後のユーザーの結果を返す
+        threads_by_user = await self.get_threads_by_users(users)
+        return threads_by_user.get(users[-1].id, {}) if users else {}
+
+    @staticmethod
+    def new_user_data(user: discord.User) -> dict:
+        return {
             "user_id": user.id,
             "name": user.name,
             "notification": True,
-            "tasks": {},
-            "tags": {},
         }
-        self.db_manager.set("users", str(user.id), user_data)
 
-    def remove_user(self, user: discord.User):
-        self.db_manager.delete("users", str(user.id))
+    async def add_user(self, user: discord.User):
+        await self.db_manager.set("users", str(user.id), self.new_user_data(user))
+
+    async def add_users(
+        self,
+        users: list[discord.User],
+        progress: Callable[[int, int], None] | None = None,
+    ) -> bool:
+        """複数のユーザーを、バッチ書き込み(500件ずつ)でまとめて追加する"""
+        return await self.put_users(
+            [self.new_user_data(user) for user in users], progress
+        )
+
+    async def put_users(
+        self,
+        user_data: list[dict],
+        progress: Callable[[int, int], None] | None = None,
+    ) -> bool:
+        """ユーザーのドキュメントをそのまま書き込む (インポートなど、データが揃っている場合に使う)"""
+        return await self.db_manager.batch(
+            [Write("set", "users", str(data["user_id"]), data) for data in user_data],
+            progress,
+        )
+
+    async def remove_user(self, user: discord.User):
+        # ユーザーのドキュメントと合わせて、タグ・タスクのドキュメントも削除する
+        tag_docs, task_ids = await asyncio.gather(
+            self.db_manager.query(self.TAGS, [("user_id", "==", user.id)]),
+            self.db_manager.get_ids(self.tasks_collection(user.id)),
+        )
+        deadlines = await asyncio.gather(
+            *[
+                self._thread_deadline(
+                    tag_doc["guild_id"], tag_doc["thread_id"], [user.id]
+                )
+                for tag_doc in tag_docs
+            ]
+        )
+        writes = [Write("delete", "users", str(user.id))]
+        for tag_doc, deadline in zip(tag_docs, deadlines):
+            tag = Tag(guild_id=tag_doc["guild_id"], thread_id=tag_doc["thread_id"])
+            writes.append(self._tag_write(tag, user, remove=True))
+            writes.append(self._index_write(tag, [user.id], deadline, remove=True))
+        writes.extend(
+            Write("delete", self.tasks_collection(user.id), task_id)
+            for task_id in task_ids
+        )
+        table = self.db_manager.tag_table
+        if await self.db_manager.batch(writes) and table is not None:
+            table.delete(
+                (user.id, tag_doc["guild_id"], tag_doc["thread_id"])
+                for tag_doc in tag_docs
+            )
+
+    async def get_user(self, user: discord.User):
+        return await self.db_manager.get("users", str(user.id))
 
-    def get_user(self, user: discord.User):
-        return self.db_manager.get("users", str(user.id))
+    async def get_all_users(self):
+        return await self.db_manager.get("users")
+
+    async def get_user_ids(self) -> set[int]:
+        return {int(user_id) for user_id in await self.db_manager.get_ids("users")}
+
+    async def get_sync_watermarks(self, guild_ids: list[int]) -> dict[str, dict]:
+        """ギルドごとの、前回メンバーを同期した時点の状態 {guild_id: {member_count, member_digest, synced_at}}"""
+        watermarks = await self.db_manager.get_many(
+            "sync", [str(guild_id) for guild_id in guild_ids]
+        )
+        return {
+            guild_id: data for guild_id, data in watermarks.items() if data is not None
+        }
 
-    def get_all_users(self):
-        return self.db_manager.get("users")
+    async def set_sync_watermarks(self, watermarks: dict[int, tuple[int, str]]):
+        """watermarks: {guild_id: (member_count, member_digest)}"""
+        now = datetime.datetime.now(datetime.timezone.utc)
+        await self.db_manager.batch(
+            [
+                Write(
+                    "set",
+                    "sync",
+                    str(guild_id),
+                    {
+                        "member_count": member_count,
+                        "member_digest": member_digest,
+                        "synced_at": now,
+                    },
+                )
+                for guild_id, (member_count, member_digest) in watermarks.items()
+            ]
+        )
 
-    def update_user(self, user: discord.User, data: dict):
+    async def update_user(self, user: discord.User, data: dict):
         right_data_schema = {
             "user_id": int,
             "name": str,
             "notification": bool,
-            "tasks": dict[str, str | dict],
-            "tags": dict[str, dict[str, datetime.datetime]],
         }
         for key in data.keys():
             if not list(data.keys()) == list(right_data_schema.keys()):
@@ -201,78 +1213,134 @@ class TagManager:
             if not isinstance(data[key], right_data_schema[key]):
                 raise ValueError(f"Invalid data type. (key: {key})")
 
-        self.db_manager.update("users", str(user.id), data)
-
-    def add_task(self, task: Task):
-        # 重複しないtask_idを生成
-        task_id = utils.generate_id()
-        user = task.user
-        user_data = self.db_manager.get("users", str(user.id))
-        user_data["tasks"][task_id] = task.content
-        # 生成したtask_idをused_idsに追加
-        if "used_ids" not in user_data["tasks"]:
-            user_data["tasks"]["used_ids"] = [task_id]
-        else:
-            user_data["tasks"]["used_ids"].append(task_id)
-        self.db_manager.update("users", str(user.id), user_data)
-
-    def delete_task(self, task: Task):
-        user = task.user
-        task_id = task.task_id
-        fetched_user = self.db_manager.get("users", str(user.id))
-        fetched_user["tasks"].pop(task_id)
-        fetched_user["tasks"]["used_ids"].remove(task_id)
-        self.db_manager.update("users", str(user.id), fetched_user)
-
-    def get_tasks(self, task: Task):
-        user = task.user
-        fetched_user = self.db_manager.get("users", str(user.id))
-        return fetched_user["tasks"]
-
-    def update_task(self, task: Task):
-        user = task.user
-        task_id = task.task_id
-        content = task.content
-        fetched_user = self.db_manager.get("users", str(user.id))
-        fetched_user["tasks"][task_id] = content
-        self.db_manager.update("users", str(user.id), fetched_user)
-
-    def toggle_notification(self, user: discord.User) -> bool:
-        fetched_user = self.db_manager.get("users", str(user.id))
-        fetched_user["notification"] = not fetched_user["notification"]
-        self.db_manager.update("users", str(user.id), fetched_user)
-        return fetched_user["notification"]
-
-    def add_notify_channel(
-        self, channel=dict[discord.Guild, discord.TextChannel | discord.Thread | None]
-    ):
-        use_set = False
-        fetched_user = self.db_manager.get("notify", "notify_channels")
+        await self.db_manager.update("users", str(user.id), data)
 
-        if not fetched_user:
-            use_set = True
-            fetched_user = {}
+    # タスクは1件ごとのドキュメント (ユーザーのドキュメントの読み書きは不要)
+    # task_idは作成順に並ぶため、追加・削除は1件の書き込みで済み、並び順はtask_idで決まる
+    async def add_task(self, task: Task) -> str:
+        created_at = datetime.datetime.now(datetime.timezone.utc)
+        task_id = utils.generate_task_id(created_at)
+        await self.db_manager.set(
+            self.tasks_collection(task.user.id),
+            task_id,
+            {"task_id": task_id, "content": task.content, "created_at": created_at},
+        )
+        return task_id
 
-        for guild, ch in channel.items():
-            fetched_user[str(guild.id)] = ch.id if ch else None
+    async def delete_task(self, task: Task):
+        await self.db_manager.delete(self.tasks_collection(task.user.id), task.task_id)
 
-        # 存在しないキーのupdateは使用できないため、そのような場合はsetを使用
-        if use_set:
-            self.db_manager.set("notify", "notify_channels", fetched_user)
-        else:
-            self.db_manager.update("notify", "notify_channels", fetched_user)
+    async def get_task_page(
+        self, task: Task, limit: int = TASK_PAGE_SIZE, start_after: str | None = None
+    ) -> tuple[dict[str, str], str | None]:
+        """
+        start_after(task_id)の次から、最大limit件のタスクを作成順に取得する
+        ({task_id: content}, 次のページのカーソル(次のページが無い場合はNone)) を返す
+        """
+        task_docs = await self.db_manager.query(
+            self.tasks_collection(task.user.id),
+            order_by="task_id",
+            limit=limit + 1,  # 1件多く読んで、次のページがあるかを判定する
+            start_after=start_after,
+        )
+        tasks = {
+            task_doc["task_id"]: task_doc["content"] for task_doc in task_docs[:limit]
+        }
+        next_cursor = (
+            task_docs[limit - 1]["task_id"] if len(task_docs) > limit else None
+        )
+        return tasks, next_cursor
 
-    def get_notify_channel(
+    async def get_previous_task_page(
+        self, task: Task, end_before: str, limit: int = TASK_PAGE_SIZE
+    ) -> tuple[dict[str, str], str | None]:
+        """
+        end_before(task_id)より前の、最大limit件のタスクを作成順に取得する
+        ({task_id: content}, そのページのカーソル(get_task_pageのstart_after。1ページ目はNone)) を返す
+        """
+        # 降順でlimit+1件だけ読む (1件多く読み、その前のページがあるか(カーソル)を判定する)
+        task_docs = await self.db_manager.query(
+            self.tasks_collection(task.user.id),
+            [("task_id", "<", end_before)],
+            order_by="task_id",
+            limit=limit + 1,
+            descending=True,
+        )
+        tasks = {
+            task_doc["task_id"]: task_doc["content"]
+            for task_doc in reversed(task_docs[:limit])
+        }
+        start_after = task_docs[limit]["task_id"] if len(task_docs) > limit else None
+        return tasks, start_after
+
+    async def get_tasks(self, task: Task) -> dict[str, str]:
+        """{task_id: content} (作成順)"""
+        task_docs = await self.db_manager.query(
+            self.tasks_collection(task.user.id), order_by="task_id"
+        )
+        return {task_doc["task_id"]: task_doc["content"] for task_doc in task_docs}
+
+    async def update_task(self, task: Task):
+        await self.db_manager.update(
+            self.tasks_collection(task.user.id),
+            task.task_id,
+            {"content": task.content},
+        )
+
+    async def toggle_notification(self, user: discord.User) -> bool | None:
+        """
+        通知のON/OFFを切り替え、切り替えた後の値を返す
+        同時に切り替えられても取りこぼさないよう、トランザクションで読み書きする
+        再試行を使い切った場合などで切り替えられなかった場合はNoneを返す
+        """
+        fields = await self.db_manager.transaction(
+            "users",
+            str(user.id),
+            lambda data: {"notification": not data["notification"]},
+        )
+        if fields is None:
+            return None
+        return fields["notification"]
+
+    async def add_notify_channel(
+        self, channel=dict[discord.Guild, discord.TextChannel | discord.Thread | None]
+    ):
+        # 他のギルドのエントリを上書きしないよう、読み込まずにmergeで書き込む
+        await self.db_manager.set(
+            "notify",
+            "notify_channels",
+            {str(guild.id): ch.id if ch else None for guild, ch in channel.items()},
+            merge=True,
+        )
+
+    async def get_notify_channel(
         self, guild_id: str
     ) -> dict[
         str, str | None
     ]:  # dict[discord.Guild.id, discord.TextChannel.id | discord.Thread.id | None]
-        return self.db_manager.get("notify", "notify_channels")[guild_id]
+        notify_channels = await self.get_notify_channels()
+        return notify_channels.get(str(guild_id))
+
+    async def get_notify_channels(self) -> dict[str, int | None]:
+        """全ギルドの通知チャンネルを1回の読み込みで取得する"""
+        return await self.db_manager.get("notify", "notify_channels") or {}
+
+    async def get_notify_freqs(self) -> dict[str, int]:
+        """ギルドごとの通知頻度(時間)。設定されていないギルドはデフォルト値を使う"""
+        return await self.db_manager.get("notify", "notify_freqs") or {}
+
+    async def set_notify_freq(self, guild: discord.Guild, hours: int):
+        await self.db_manager.set(
+            "notify", "notify_freqs", {str(guild.id): hours}, merge=True
+        )
 
-    def delete_notify_channel(self, guild: discord.Guild):
-        fetched_user = self.db_manager.get("notify", "notify_channels")
-        fetched_user.pop(str(guild.id))
-        self.db_manager.update("notify", "notify_channels", fetched_user)
+    async def delete_notify_channel(self, guild: discord.Guild):
+        await self.db_manager.set(
+            "notify",
+            "notify_channels",
+            {str(guild.id): firestore.DELETE_FIELD},
+            merge=True,
+        )
 
 
 if __name__ == "__main__":
@@ -1,15 +1,45 @@
 # embed_manager.py:
 
 import datetime
+from typing import Iterable, Iterator
+
 import discord
 
 from utils import Tag, Task
 
 
 class EmbedManager:
+    # Discordの上限 (descriptionの文字数、embed全体の文字数、1メッセージのembedの数)
+    DESCRIPTION_LIMIT = 4096
+    TOTAL_LIMIT = 6000
+    EMBEDS_PER_MESSAGE = 10
+    PAGE_SUFFIX = " ({}/{})"
+
+    # 結果を表示するモードのタイトルと、結果が空の場合のメッセージ
+    RESULT_TITLES = {
+        "get_users_by_thread": "取得結果: ",
+        "get_threads_by_user": "取得結果: ",
+        "get_all": "取得結果: ",
+        "get_tasks": "{}のタスク",
+        "notification": "通知",
+    }
+    EMPTY_MESSAGES = {
+        "get_users_by_thread": "タグ付けされているユーザーは存在しませんでした。",
+        "get_threads_by_user": "タグ付けされているスレッドは存在しませんでした。",
+        "get_all": "タグ付けされているスレッドは存在しませんでした。",
+        "get_tasks": "タスクは存在しませんでした。",
+        "help": "コマンドが存在しませんでした。",
+        "notification": "通知が存在しませんでした。",
+    }
+
     def __init__(self):
         pass
 
+    @staticmethod
+    def format_deadline(deadline: datetime.datetime | None) -> str:
+        # 期限の無いタグ(deadline=None)もあるため、その場合は「期限なし」と表示する
+        return deadline.strftime("%Y/%m/%d") if deadline else "期限なし"
+
     def format_result(
         self,
         result: dict[
@@ -22,125 +52,163 @@ class EmbedManager:
             ],
         ],
     ) -> str:
-        formatted_result = ""
+        # 文字列の結合は最後に1回だけ行う
+        formatted_result = "".join(self.iter_rows(result))
+        if not formatted_result:
+            for mode in result:
+                if mode in self.EMPTY_MESSAGES:
+                    return self.EMPTY_MESSAGES[mode]
+        return formatted_result
+
+    def iter_rows(self, result: dict) -> Iterator[str]:
+        """結果を1行ずつ生成する。行は改行で終わる"""
         for mode, data in result.items():
-            if mode == "get_users_by_thread":
-                if not data:
-                    return "タグ付けされているユーザーは存在しませんでした。"
+            if not data or mode not in self.EMPTY_MESSAGES:
+                continue
 
+            if mode == "get_users_by_thread":
                 thread = data["thread"]  # discord.Thread
                 users = data["users"]  # list[discord.User]
-                formatted_result += f"{thread.mention}にタグ付けされているユーザー:\n"
+                yield f"{thread.mention}にタグ付けされているユーザー:\n"
                 for user in users:
-                    formatted_result += f"  - {user.mention}\n"
-
-                if not formatted_result:
-                    return "タグ付けされているユーザーは存在しませんでした。"
+                    yield f"  - {user.mention}\n"
 
             elif mode == "get_threads_by_user":
-                if not data:
-                    return "タグ付けされているスレッドは存在しませんでした。"
-
                 for user_data in data:
                     user = user_data["user"]
                     threads = user_data["threads"]
-                    formatted_result += f"{user.mention}がタグ付けされているスレッド:\n"
+                    yield f"{user.mention}がタグ付けされているスレッド:\n"
                     for thread_data in threads:
                         thread = thread_data["thread"]  # discord.Thread
                         deadline = thread_data["deadline"]  # datetime.datetime
-                        formatted_result += (
-                            f"  - {thread.mention}: {deadline.strftime('%Y/%m/%d')}\n"
-                        )
-
-                if not formatted_result:
-                    return "タグ付けされているスレッドは存在しませんでした。"
+                        yield f"  - {thread.mention}: {self.format_deadline(deadline)}\n"
 
             elif mode == "get_all":
-                if not data:
-                    return "タグ付けされているスレッドは存在しませんでした。"
-
                 interaction = result["interaction"]  # discord.Interaction
+                # interactionのguild以外のguild配下のスレッドは除外する
+                current_guild_id = str(interaction.guild.id)
 
                 for user_data in data:
                     user = list(user_data.keys())[0]
-                    threads = user_data[user]
-
-                    if not threads:
-                        continue
-
-                    # interactionのguild以外のguild配下のスレッドを除外する
-                    current_guild = interaction.guild
-                    for guild_id in list(threads.keys()):
-                        if int(guild_id) != current_guild.id:
-                            del threads[guild_id]
-
-                    threads = (
-                        threads[str(current_guild.id)]
-                        if str(current_guild.id) in list(threads.keys())
-                        else []
-                    )
-
-                    if not threads:
-                        continue
-
-                    formatted_result += f"{user.mention}がタグ付けされているスレッド:\n"
-
-                    for thread_data in threads:
+                    rows = []
+                    for thread_id, deadline in user_data[user].get(
+                        current_guild_id, []
+                    ):
                         thread = interaction.client.get_channel(
-                            int(thread_data[0])
+                            int(thread_id)
                         )  # discord.Thread
                         if not thread:
                             continue
-                        deadline = thread_data[1]  # datetime.datetime
-                        formatted_result += (
-                            f"  - {thread.mention}: {deadline.strftime('%Y/%m/%d')}\n"
+                        rows.append(
+                            f"  - {thread.mention}: {self.format_deadline(deadline)}\n"
                         )
 
-                    if (
-                        formatted_result
-                        == f"{user.mention}がタグ付けされているスレッド:\n"
-                    ):
-                        return "タグ付けされているスレッドは存在しませんでした。"
-
-                if not formatted_result:
-                    return "タグ付けされているスレッドは存在しませんでした。"
+                    # 存在するスレッドが無いユーザーは表示しない
+                    if rows:
+                        yield f"{user.mention}がタグ付けされているスレッド:\n"
+                        yield from rows
 
             elif mode == "get_tasks":
                 """data: dict[str, str] (id: content)"""
-                if not data:
-                    return "タスクは存在しませんでした。"
-
                 for task in data.values():
-                    formatted_result += f"- {task}\n"
-
-                if not formatted_result:
-                    return "タスクは存在しませんでした。"
+                    yield f"- {task}\n"
 
             elif mode == "help":
-                if not data:
-                    return "コマンドが存在しませんでした。"
-
                 for command, description in data.items():
-                    formatted_result += f"**{command}**: {description}\n"
+                    yield f"**{command}**: {description}\n"
 
             elif mode == "notification":
-                if not data:
-                    return "通知が存在しませんでした。"
-
-                # notificationに限り、dataはlist[Tag]で渡されている
-                client = data[0].client  # discord.Client
+                # notificationに限り、dataはlist[TagRecord]で渡されている (IDからスレッドを取得する)
+                client = result["client"]  # discord.Client
                 for tag in data:
-                    guild = client.get_guild(int(tag.guild_id))
-                    thread = guild.get_thread(int(tag.thread_id))
-                    deadline = tag.deadline
-                    formatted_result += (
-                        f"- {thread.mention} ({deadline.strftime('%Y/%m/%d')})\n"
-                    )
+                    thread = tag.resolve_thread(client)
+                    deadline = tag.deadline_at
+                    yield f"- {thread.mention} ({self.format_deadline(deadline)})\n"
 
-        return formatted_result
+    def build_embeds(
+        self,
+        title: str,
+        rows: Iterable[str],
+        color: discord.Color,
+        empty: str = "",
+    ) -> list[discord.Embed]:
+        """
+        rowsを順に読み、descriptionの上限(とembed全体の上限)に収まるように複数のembedに詰める
+        rowsは全件をメモリに載せる必要はなく、ジェネレーターを渡せる
+        """
+        limit = min(
+            self.DESCRIPTION_LIMIT,
+            self.TOTAL_LIMIT - len(title) - len(self.PAGE_SUFFIX.format(999, 999)),
+        )
+        descriptions = []
+        lines, size = [], 0
+        for row in rows:
+            # 1行だけで上限を超える場合は、行の途中で分割する
+            for start in range(0, len(row), limit):
+                piece = row[start : start + limit]
+                if size + len(piece) > limit:
+                    descriptions.append("".join(lines))
+                    lines, size = [], 0
+                lines.append(piece)
+                size += len(piece)
+        if lines:
+            descriptions.append("".join(lines))
+        if not descriptions:
+            descriptions = [empty]
+
+        total = len(descriptions)
+        return [
+            discord.Embed(
+                title=title + (self.PAGE_SUFFIX.format(i, total) if total > 1 else ""),
+                description=description,
+                color=color,
+            )
+            for i, description in enumerate(descriptions, start=1)
+        ]
+
+    def result_pages(self, data: dict) -> list[discord.Embed] | None:
+        """結果を表示するモードの場合は、上限に収まるように分けたembedを返す。それ以外はNone"""
+        current_mode = list(data.keys())[0]
+        if current_mode not in self.RESULT_TITLES or "result" not in data:
+            return None
+
+        title = self.RESULT_TITLES[current_mode]
+        if current_mode == "get_tasks":
+            title = title.format(data["get_tasks"].user.name)
+        return self.build_embeds(
+            title,
+            self.iter_rows(data["result"]),
+            color=discord.Color.green(),
+            empty=self.EMPTY_MESSAGES[current_mode],
+        )
+
+    def get_embeds(self, data: dict[str, Tag | Task]) -> list[discord.Embed]:
+        """get_embedと同じだが、結果が上限を超える場合は複数のembed(ページ)に分けて返す"""
+        return self.result_pages(data) or [self.get_embed(data)]
+
+    def group_embeds(self, embeds: list[discord.Embed]) -> list[list[discord.Embed]]:
+        """1つのメッセージに収まる(10個・合計6000文字以下)ように、embedをまとめる"""
+        messages = []
+        size = 0
+        for embed in embeds:
+            if (
+                not messages
+                or len(messages[-1]) >= self.EMBEDS_PER_MESSAGE
+                or size + len(embed) > self.TOTAL_LIMIT
+            ):
+                messages.append([])
+                size = 0
+            messages[-1].append(embed)
+            size += len(embed)
+        return messages
 
     def get_embed(self, data: dict[str, Tag | Task]) -> discord.Embed:
         """tag must be like ('tag', Tag)"""
+        # 結果の表示は、上限に収まるように分けたうちの1ページ目を返す (全ページはget_embedsで取得する)
+        pages = self.result_pages(data)
+        if pages is not None:
+            return pages[0]
+
         current_mode = list(data.keys())[0]
         if current_mode == "tag":
             if not data["tag"].thread_id:
@@ -230,13 +298,6 @@ class EmbedManager:
                 )
                 return embed
 
-            elif data["get_threads_by_user"].users:
-                result = self.format_result(data["result"])
-                embed = discord.Embed(
-                    title="取得結果: ", description=result, color=discord.Color.green()
-                )
-                return embed
-
         elif current_mode == "get_users_by_thread":
             if not data["get_users_by_thread"].thread_id:
                 embed = discord.Embed(
@@ -246,22 +307,14 @@ class EmbedManager:
                 )
                 return embed
 
-            elif data["get_users_by_thread"].thread_id:
-                result = self.format_result(data["result"])
-                embed = discord.Embed(
-                    title="取得結果: ", description=result, color=discord.Color.green()
-                )
-                return embed
-
-        elif current_mode == "get_all":
-            result = self.format_result(data["result"])
-            embed = discord.Embed(
-                title="取得結果: ", description=result, color=discord.Color.green()
-            )
-            return embed
-
         elif current_mode == "toggle_notification":
             past_notification = data["current_notification"]
+            if past_notification is None:
+                return discord.Embed(
+                    title="通知設定を変更できませんでした",
+                    description="時間をおいて、もう一度実行してください。",
+                    color=discord.Color.red(),
+                )
             if past_notification:
                 description = "🚫 通知をオフにしました。"
             else:
@@ -282,12 +335,17 @@ class EmbedManager:
             return embed
 
         elif current_mode == "delete_task":
-            if not data["result"]["delete_task"] == "done":
-                total_page = data["result"]["page"]
+            if not data["result"]["delete_task"]:
+                embed = discord.Embed(
+                    title="タスク削除",
+                    description="タスクは存在しませんでした。",
+                    color=discord.Color.yellow(),
+                )
+            elif not data["result"]["delete_task"] == "done":
                 current_page = data["result"]["current_page"]
                 embed = discord.Embed(
                     title="1/2 削除するタスクの選択",
-                    description=f"削除するタスクを選択してください。\npage: (**{current_page} / {total_page}**)",
+                    description=f"削除するタスクを選択してください。\npage: (**{current_page}**)",
                     color=discord.Color.blue(),
                 )
             else:
@@ -298,16 +356,6 @@ class EmbedManager:
                 )
             return embed
 
-        elif current_mode == "get_tasks":
-            result = self.format_result(data["result"])
-            user = data["get_tasks"].user
-            embed = discord.Embed(
-                title=f"{user.name}のタスク",
-                description=result if result else "タスクは存在しませんでした。",
-                color=discord.Color.green(),
-            )
-            return embed
-
         elif current_mode == "help":
             result = self.format_result(data["result"])
 
@@ -319,16 +367,58 @@ class EmbedManager:
             )
             return embed
 
+        elif current_mode == "expired":
+            embed = discord.Embed(
+                title="期限切れ",
+                description="この操作は期限切れです。もう一度コマンドを実行してください。",
+                color=discord.Color.yellow(),
+            )
+            return embed
+
+        elif current_mode == "not_owner":
+            embed = discord.Embed(
+                title="操作できません",
+                description="この操作は、コマンドを実行したユーザーのみ行えます。",
+                color=discord.Color.red(),
+            )
+            return embed
+
         elif current_mode == "invite":
             embed = discord.Embed(
                 title="リダイレクトが完了しました", color=discord.Color.green()
             )
             return embed
 
-        elif current_mode == "notification":
-            result = self.format_result(data["result"])
+        elif current_mode == "notify_freq":
+            freq = data["notify_freq_hours"]
+            if not freq:
+                embed = discord.Embed(
+                    title="入力エラー",
+                    description="通知頻度は数字(時間)で入力してください。",
+                    color=discord.Color.red(),
+                )
+                return embed
+
+            embed = discord.Embed(
+                title="完了しました",
+                description=f"通知頻度を**{freq}時間**ごとに変更しました。",
+                color=discord.Color.green(),
+            )
+            return embed
+
+        elif current_mode == "reminder":
+            tag = data["reminder"]
+            thread = tag.client.get_guild(int(tag.guild_id)).get_thread(
+                int(tag.thread_id)
+            )
+            description = (
+                f"{thread.mention}の期限 ({tag.deadline.strftime('%Y/%m/%d')}) が近づいています。\n"
+                + " ".join([user.mention for user in tag.users])
+            )
             embed = discord.Embed(
-                title="通知", description=result, color=discord.Color.green()
+                title="リマインド",
+                description=description,
+                color=discord.Color.orange(),
             )
             return embed
 
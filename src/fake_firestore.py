@@ -0,0 +1,357 @@
+# fake_firestore.py:
+
+import copy
+import datetime
+import operator
+import threading
+import time
+import uuid
+from types import SimpleNamespace
+
+from google.api_core.exceptions import Aborted, NotFound
+
+from utils import comparable, match_filter, merge_fields, update_fields
+
+"""
+ベンチマーク用の、firestore.Clientの必要な部分だけを真似たインメモリ実装
+DBManager(db=FakeFirestore(latency=...))のように渡して使う
+
+latencyを指定すると、RPCごとにその秒数だけ(同期的に)待機する
+実際のFirestoreクライアントと同じく、呼び出したスレッドをブロックする
+Firestoreと同じく、naiveなdatetimeはUTCとして保存する (読み込むとUTCのawareなdatetimeになる)
+"""
+
+
+class FakeDocumentSnapshot:
+    def __init__(self, reference: "FakeDocumentReference", data: dict | None):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+
+    @property
+    def exists(self) -> bool:
+        return self._data is not None
+
+    def to_dict(self) -> dict | None:
+        return copy.deepcopy(self._data)
+
+
+class FakeDocumentReference:
+    def __init__(self, client: "FakeFirestore", collection: str, document: str):
+        self._client = client
+        self.collection_name = collection
+        self.id = document
+
+    def get(self, transaction: "FakeTransaction | None" = None) -> FakeDocumentSnapshot:
+        self._client._rpc()
+        with self._client._lock:
+            data = self._client._read(self)
+            if transaction is not None:
+                transaction._reads[(self.collection_name, self.id)] = data
+            return FakeDocumentSnapshot(self, data)
+
+    # 戻り値は実際のクライアントと同じく、set/updateはWriteResult、deleteはコミット時刻
+    def set(self, data: dict, merge: bool = False):
+        self._client._rpc()
+        with self._client._lock:
+            commit_time = self._client._apply(
+                [("merge" if merge else "set", self, data)]
+            )
+        return SimpleNamespace(update_time=commit_time)
+
+    def update(self, data: dict):
+        self._client._rpc()
+        with self._client._lock:
+            commit_time = self._client._apply([("update", self, data)])
+        return SimpleNamespace(update_time=commit_time)
+
+    def delete(self):
+        self._client._rpc()
+        with self._client._lock:
+            return self._client._apply([("delete", self, None)])
+
+
+class FakeCollectionReference:
+
+    def __init__(
+        self,
+        client: "FakeFirestore",
+        name: str,
+        limit: int | None = None,
+        filters: tuple = (),
+        order_by: str | None = None,
+        start_after: dict | None = None,
+        direction: str = "ASCENDING",
+    ):
+        self._client = client
+        self.name = name
+        self._limit = limit
+        self._filters = filters
+        self._order_by = order_by
+        self._start_after = start_after
+        self._direction = direction
+
+    def document(self, document: str | None = None) -> FakeDocumentReference:
+        return FakeDocumentReference(self._client, self.name, document or _new_id())
+
+    def add(self, data: dict, document_id: str | None = None, timeout=None):
+        ref = self.document(document_id)
+        return ref.set(data).update_time, ref
+
+    def on_snapshot(self, callback) -> "FakeWatch":
+        """登録時に全ドキュメントをADDEDとして、以降は書き込みのたびに差分を通知する"""
+        with self._client._lock:
+            watch = FakeWatch(self._client, self.name, callback)
+            self._client._watches.append(watch)
+            docs = self.get()
+            watch.emit([_change("ADDED", doc) for doc in docs])
+        return watch
+
+    def _query(self, **kwargs) -> "FakeCollectionReference":
+        params = {
+            "limit": self._limit,
+            "filters": self._filters,
+            "order_by": self._order_by,
+            "start_after": self._start_after,
+            "direction": self._direction,
+        }
+        params.update(kwargs)
+        return FakeCollectionReference(self._client, self.name, **params)
+
+    def where(self, filter) -> "FakeCollectionReference":
+        return self._query(filters=self._filters + (filter,))
+
+    def order_by(
+        self, field: str, direction: str = "ASCENDING"
+    ) -> "FakeCollectionReference":
+        return self._query(order_by=field, direction=direction)
+
+    def start_after(self, document_fields: dict) -> "FakeCollectionReference":
+        # order_byのフィールドの値を渡す形式のみ対応
+        return self._query(start_after=document_fields)
+
+    def select(self, field_paths: list[str]) -> "FakeCollectionReference":
+        # 射影は転送量の最適化なので、fakeでは何もしない
+        return self
+
+    def limit(self, count: int) -> "FakeCollectionReference":
+        return self._query(limit=count)
+
+    def stream(self):
+        yield from self.get()
+
+    def get(self) -> list[FakeDocumentSnapshot]:
+        self._client._rpc()
+        with self._client._lock:
+            docs = list(self._client._collections.get(self.name, {}).items())
+            for field_filter in self._filters:
+                docs = [
+                    (doc_id, data)
+                    for doc_id, data in docs
+                    if _match(data, field_filter)
+                ]
+            if self._order_by is not None:
+                # Firestoreと同じく、order_byのフィールドを持たないドキュメントは除外される
+                descending = self._direction == "DESCENDING"
+                docs = sorted(
+                    (d for d in docs if self._order_by in d[1]),
+                    key=lambda d: comparable(d[1][self._order_by]),
+                    reverse=descending,
+                )
+                if self._start_after is not None:
+                    # 降順の場合は、カーソルより小さい値が続きになる
+                    cursor = comparable(self._start_after[self._order_by])
+                    after = operator.lt if descending else operator.gt
+                    docs = [
+                        d
+                        for d in docs
+                        if after(comparable(d[1][self._order_by]), cursor)
+                    ]
+            if self._limit is not None:
+                docs = docs[: self._limit]
+            return [
+                FakeDocumentSnapshot(self.document(doc_id), copy.deepcopy(data))
+                for doc_id, data in docs
+            ]
+
+
+class FakeWatch:
+    def __init__(self, client: "FakeFirestore", collection: str, callback):
+        self._client = client
+        self.collection = collection
+        self.callback = callback
+
+    def emit(self, changes: list):
+        self.callback([change.document for change in changes], changes, time.time())
+
+    def unsubscribe(self):
+        with self._client._lock:
+            self._client._watches.remove(self)
+
+
+class FakeWriteBatch:
+    def __init__(self, client: "FakeFirestore"):
+        self._client = client
+        self._writes: list[tuple[str, FakeDocumentReference, dict | None]] = []
+        self.commit_time = None
+
+    def set(self, ref: FakeDocumentReference, data: dict, merge: bool = False):
+        self._writes.append(("merge" if merge else "set", ref, data))
+
+    def update(self, ref: FakeDocumentReference, data: dict):
+        self._writes.append(("update", ref, data))
+
+    def delete(self, ref: FakeDocumentReference):
+        self._writes.append(("delete", ref, None))
+
+    def commit(self):
+        # 1回のRPCで、全ての書き込みをアトミックに適用する
+        self._client._rpc()
+        with self._client._lock:
+            self.commit_time = self._client._apply(self._writes)
+        results = [SimpleNamespace(update_time=self.commit_time) for _ in self._writes]
+        self._writes = []
+        return results
+
+
+class FakeTransaction(FakeWriteBatch):
+    """
+    firestore.transactionalから使えるトランザクション
+    楽観的に実行し、読んだドキュメントがコミットまでに変更されていた場合はAbortedを送出する
+    (transactionalがfuncを呼び直して再試行する)
+    """
+
+    def __init__(self, client: "FakeFirestore", max_attempts: int = 5):
+        super().__init__(client)
+        self._max_attempts = max_attempts
+        self._read_only = False
+        self._id = None
+        self._reads: dict[tuple[str, str], dict | None] = {}
+
+    def _clean_up(self):
+        self._writes = []
+        self._reads = {}
+        self._id = None
+
+    def _begin(self, retry_id=None):
+        self._id = _new_id()
+
+    def _rollback(self):
+        self._clean_up()
+
+    def _commit(self):
+        self._client._rpc()
+        with self._client._lock:
+            for (collection, document), data in self._reads.items():
+                ref = FakeDocumentReference(self._client, collection, document)
+                if self._client._read(ref) != data:
+                    self._client.aborted_count += 1
+                    raise Aborted(f"Transaction aborted: {collection}/{document}")
+            self.commit_time = self._client._apply(self._writes)
+        self._clean_up()
+
+
+class FakeFirestore:
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.rpc_count = 0
+        self.aborted_count = 0  # 競合によって中断されたトランザクションの数
+        self._lock = threading.RLock()
+        self._collections: dict[str, dict[str, dict]] = {}
+        self._watches: list[FakeWatch] = []
+
+    def collection(self, name: str) -> FakeCollectionReference:
+        return FakeCollectionReference(self, name)
+
+    def batch(self) -> FakeWriteBatch:
+        return FakeWriteBatch(self)
+
+    def transaction(self, max_attempts: int = 5) -> FakeTransaction:
+        return FakeTransaction(self, max_attempts)
+
+    def get_all(self, references: list[FakeDocumentReference]):
+        self._rpc()
+        with self._lock:
+            snapshots = [
+                FakeDocumentSnapshot(ref, self._read(ref)) for ref in references
+            ]
+        yield from snapshots
+
+    ########## internal ##########
+
+    def _rpc(self):
+        with self._lock:
+            self.rpc_count += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _apply(
+        self, writes: list[tuple[str, FakeDocumentReference, dict | None]]
+    ) -> float:
+        """writesをアトミックに適用し、コミット時刻を返す (変更イベントのread_timeと比べられる時刻)"""
+        for op, ref, _ in writes:
+            if op == "update" and self._read(ref) is None:
+                raise NotFound(f"No document to update: {ref.collection_name}/{ref.id}")
+        commit_time = time.time()
+        for op, ref, data in writes:
+            if op == "delete":
+                self._delete(ref)
+            elif op == "update":
+                self._update(ref, data)
+            else:
+                self._set(ref, data, merge=op == "merge")
+        return commit_time
+
+    def _read(self, ref: FakeDocumentReference) -> dict | None:
+        return copy.deepcopy(self._collections.get(ref.collection_name, {}).get(ref.id))
+
+    def _set(self, ref: FakeDocumentReference, data: dict, merge: bool):
+        docs = self._collections.setdefault(ref.collection_name, {})
+        current = docs.get(ref.id) if merge else None
+        docs[ref.id] = merge_fields(copy.deepcopy(current) or {}, _stored(data))
+        self._notify(ref, "ADDED" if current is None else "MODIFIED")
+
+    def _update(self, ref: FakeDocumentReference, data: dict):
+        docs = self._collections.setdefault(ref.collection_name, {})
+        if ref.id not in docs:
+            raise NotFound(f"No document to update: {ref.collection_name}/{ref.id}")
+        update_fields(docs[ref.id], _stored(data))
+        self._notify(ref, "MODIFIED")
+
+    def _delete(self, ref: FakeDocumentReference):
+        if self._collections.get(ref.collection_name, {}).pop(ref.id, None):
+            self._notify(ref, "REMOVED")
+
+    def _notify(self, ref: FakeDocumentReference, change_type: str):
+        watches = [w for w in self._watches if w.collection == ref.collection_name]
+        if not watches:
+            return
+        snapshot = FakeDocumentSnapshot(ref, self._read(ref))
+        for watch in watches:
+            watch.emit([_change(change_type, snapshot)])
+
+
+def _stored(value):
+    # Firestoreはタイムゾーンの無いdatetimeをUTCとして保存する (ローカル時刻としては扱わない)
+    if isinstance(value, datetime.datetime) and value.tzinfo is None:
+        return value.replace(tzinfo=datetime.timezone.utc)
+    if isinstance(value, dict):
+        return {key: _stored(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_stored(item) for item in value]
+    return value
+
+
+def _new_id() -> str:
+    return uuid.uuid4().hex[:20]
+
+
+def _change(change_type: str, snapshot: FakeDocumentSnapshot) -> SimpleNamespace:
+    # google.cloud.firestore_v1.watch.DocumentChangeと同じ属性を持つ変更イベント
+    return SimpleNamespace(type=SimpleNamespace(name=change_type), document=snapshot)
+
+
+def _match(data: dict, field_filter) -> bool:
+    return match_filter(
+        data, field_filter.field_path, field_filter.op_string, field_filter.value
+    )
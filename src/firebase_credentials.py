@@ -0,0 +1,97 @@
+# firebase_credentials.py:
+
+import json
+import logging
+import os
+import tempfile
+
+from utils import INFO, WARN, LazyModule
+
+"""
+Firebaseのサービスアカウントの認証情報の読み込み
+
+MEMBER_TAGGER_FIREBASE_CREDENTIALSには、ローカルのファイルのパスかURLを指定する
+URLの場合は、ダウンロードしたものをCACHE_PATHに保存し、次回の起動からはそれを使う
+(起動時に認証情報のホストを待たず、ホストに繋がらなくても起動できる)
+キャッシュを使った場合は、refresh()で取り直して次回の起動に備える
+"""
+
+requests = LazyModule("requests")  # URLからダウンロードする場合のみ使う
+
+SOURCE = os.getenv("MEMBER_TAGGER_FIREBASE_CREDENTIALS")
+CACHE_PATH = os.getenv(
+    "MEMBER_TAGGER_CREDENTIALS_CACHE", ".member_tagger_credentials.json"
+)
+TIMEOUT = float(os.getenv("MEMBER_TAGGER_CREDENTIALS_TIMEOUT", "10"))
+
+
+def is_url(source: str) -> bool:
+    return source.startswith(("http://", "https://"))
+
+
+def load() -> tuple[dict, str]:
+    """認証情報と、その取得元 ("file" | "cache" | "download") を返す"""
+    if not SOURCE:
+        raise RuntimeError("MEMBER_TAGGER_FIREBASE_CREDENTIALS is not set.")
+
+    if not is_url(SOURCE):
+        with open(SOURCE) as f:
+            return json.load(f), "file"
+
+    cached = read_cache()
+    if cached is not None:
+        return cached, "cache"
+
+    try:
+        info = download()
+    except (requests.RequestException, ValueError) as e:
+        raise RuntimeError(
+            f"Failed to download Firebase credentials and no cache exists. ({e})"
+        ) from e
+    save_cache(info)
+    return info, "download"
+
+
+def download() -> dict:
+    response = requests.get(SOURCE, timeout=TIMEOUT)
+    response.raise_for_status()
+    return response.json()
+
+
+def read_cache() -> dict | None:
+    try:
+        with open(CACHE_PATH) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_cache(info: dict):
+    # 書き込み途中のファイルを読まないよう、一時ファイルに書いてから置き換える
+    directory = os.path.dirname(os.path.abspath(CACHE_PATH))
+    fd, path = tempfile.mkstemp(dir=directory, prefix=".credentials-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(info, f)
+        os.chmod(path, 0o600)
+        os.replace(path, CACHE_PATH)
+    except OSError as e:
+        logging.warning(WARN + f"Failed to cache Firebase credentials: {e}")
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def refresh() -> bool:
+    """URLから取り直し、キャッシュと異なる場合は書き換える。書き換えた場合はTrue"""
+    if not SOURCE or not is_url(SOURCE):
+        return False
+    try:
+        info = download()
+    except (requests.RequestException, ValueError) as e:
+        logging.warning(WARN + f"Failed to refresh Firebase credentials: {e}")
+        return False
+    if info == read_cache():
+        return False
+    save_cache(info)
+    logging.info(INFO + "Firebase credentials refreshed (used from next startup).")
+    return True
@@ -1,7 +1,14 @@
 # main.py:
 
+import time
+
+# 起動時間の内訳の起点 (importの時間も含めるため、最初に記録する)
+STARTED_AT = time.perf_counter()
+
+import argparse
 import asyncio
 import datetime
+import json
 import logging
 from os import getenv
 
@@ -12,17 +19,21 @@ from discord.ext import tasks as discord_tasks
 
 from db_manager import TagManager
 from embed_manager import EmbedManager
+from metrics import Metrics, respond
 from notification_handler import NotificationHandler, Notification
 from view_manager import (
+    DYNAMIC_ITEMS,
     TagView1,
     UntagView1,
     GetThreadsView1,
     GetUsersView1,
     TaskContentInputModal,
-    DeleteTaskViewNext,
-    DeleteTaskViewOnly,
+    result_message,
+    task_page_message,
     NotifyView1,
+    NotifyFreqInputModal,
 )
+from view_state import ViewState
 from utils import (
     INFO,
     ERROR,
@@ -41,35 +52,76 @@ from utils import (
     green,
     cyan,
     bold,
+    member_digest,
 )
 
-
 # intents(権限のようなもの)を全て有効化
 intents = discord.Intents.all()
 
 logging.basicConfig(level=logging.INFO, format=FORMAT, datefmt=DATEFORMAT)
 
 
+class StartupTimer:
+    """起動の段階ごとに、前の段階からの経過時間を記録する (finish()の後は記録しない)"""
+
+    def __init__(self, started_at: float):
+        self.started_at = self.last = started_at
+        self.phases: dict[str, float] = {}
+        self.finished = False
+
+    def mark(self, phase: str):
+        if self.finished:
+            return
+        now = time.perf_counter()
+        self.phases[phase] = now - self.last
+        self.last = now
+
+    def finish(self) -> float:
+        self.finished = True
+        return self.last - self.started_at
+
+
 class Client(discord.Client):
     def __init__(self):
+        self.startup = StartupTimer(STARTED_AT)
+        self.startup.mark("imports")
         super().__init__(intents=intents)
         self.synced = False
+        self.scheduler_started = False
+        self.synced_guild_ids: set[int] = set()
+        self.known_user_ids: set[int] | None = None
         self.tag_manager = TagManager()
         self.embed_manager = EmbedManager()
         self.notification_handler = NotificationHandler(self)
+        self.db_connect: asyncio.Task | None = None
 
     ########## discord.py events ##########
 
     async def on_ready(self):
+        self.startup.mark("gateway")
         # treeコマンドを同期
         if not self.synced:
             await self.sync_commands()
+        self.startup.mark("sync_commands")
+
+        # ログインと並行して始めたストレージへの接続を待つ
+        try:
+            await self.db_connect
+        except Exception as e:
+            logging.error(ERROR + f"Failed to connect to the storage: {e}")
+            await self.close()
+            return
+        self.startup.mark("storage_wait")
 
         guilds = self.guilds
         # ギルドメンバーを同期
         await self.guild_member_sync(guilds)
+        self.startup.mark("member_sync")
 
-        self.set_presence.start()
+        if not self.set_presence.is_running():
+            self.set_presence.start()
+        if not self.log_metrics.is_running():
+            self.log_metrics.start()
 
         # logging
         logging.info(
@@ -78,17 +130,62 @@ class Client(discord.Client):
         logging.info(INFO + f"Connected to {green(len(guilds))} guilds")
         logging.info(INFO + bold("Bot is ready."))
 
-        # 毎日0時に通知
-        until_notify = await self.calc_until_notify()
-        await asyncio.sleep(until_notify)
-        self.notify.start()
+        # 通知のキューを復元してスケジューラーを開始 (再接続時は復元しない)
+        if not self.scheduler_started:
+            if not await self.tag_manager.schema_ready():
+                logging.warning(
+                    WARN
+                    + "Storage schema is outdated. Run migrate.py to move tags and tasks out of user documents."
+                )
+            # 逆引きインデックスが未作成(または古い)場合は作成する
+            if not await self.tag_manager.thread_index_ready():
+                index_count = await self.tag_manager.rebuild_thread_index()
+                logging.info(
+                    INFO + f"Thread index rebuilt: {blue(index_count)} threads"
+                )
+            await self.notification_handler.scheduler.restore()
+            self.notification_handler.scheduler.start()
+            self.scheduler_started = True
+            self.startup.mark("scheduler")
+            self.log_startup()
 
     async def on_guild_join(self, guild: discord.Guild):
         # ギルドメンバーを同期
         await self.guild_member_sync([guild])
+        self.notification_handler.scheduler.schedule_digest(guild.id)
+
+    async def on_member_join(self, member: discord.Member):
+        if member.bot or member.guild.id not in self.synced_guild_ids:
+            return
+
+        if member.id not in await self.get_known_user_ids():
+            await self.tag_manager.add_user(member)
+            self.known_user_ids.add(member.id)
+            logging.info(INFO + bold("New user: ") + green(member.name))
+        await self.update_sync_watermark(member.guild)
+
+    async def on_member_remove(self, member: discord.Member):
+        # 他のギルドに所属している可能性があるため、ユーザーのデータは削除しない
+        if member.bot or member.guild.id not in self.synced_guild_ids:
+            return
+        await self.update_sync_watermark(member.guild)
 
     ########## my functions ##########
 
+    def log_startup(self):
+        total = self.startup.finish()
+        phases = ", ".join(
+            f"{phase} {blue(round(sec, 2))}s"
+            for phase, sec in self.startup.phases.items()
+        )
+        logging.info(INFO + f"Startup took {green(round(total, 2))}s ({phases})")
+        storage = self.tag_manager.db_manager.startup_times
+        logging.info(
+            INFO
+            + f"Storage connected in {blue(round(storage.get('connect_sec', 0.0), 2))}s "
+            + f"in parallel with login (credentials: {storage.get('credentials', '-')})"
+        )
+
     async def sync_commands(self):
         if self.synced:
             return
@@ -99,23 +196,46 @@ class Client(discord.Client):
         return
 
     async def setup_hook(self) -> None:
+        # ストレージへの接続は、Discordのゲートウェイへの接続と並行して行う
+        self.startup.mark("login")
+        self.db_connect = asyncio.create_task(self.tag_manager.db_manager.connect())
         await tree.set_translator(CommandsTranslator())
+        # 送信済みのビューの部品を、再起動後もcustom_idから作り直して処理する
+        self.add_dynamic_items(*DYNAMIC_ITEMS)
+        await Metrics().start_server()
 
     async def guild_member_sync(self, guilds: list[discord.Guild]):
-        all_members = []
+        # 再接続時は、このプロセスで同期済みのギルドはスキップ (以降はon_member_join/removeで追従)
+        guilds = [guild for guild in guilds if guild.id not in self.synced_guild_ids]
+        if not guilds:
+            return
 
+        # Intents.all()によりメンバーはキャッシュされているため、REST APIでの取得は行わない
+        guild_members: dict[int, dict[int, discord.Member]] = {}
         for guild in guilds:
-            # ギルドメンバーを取得してタグマネージャーにセット
-            guild_members = guild.fetch_members(limit=None)
-            guild_members = [member async for member in guild_members if not member.bot]
-            all_members.extend(guild_members)
-
-        # memberのidからMemberをUserに変換してタグマネージャーにセット
-        current_users_raw = self.tag_manager.get_all_users()
-        current_users_id = [user["user_id"] for user in current_users_raw]
-        current_users = [self.get_user(user_id) for user_id in current_users_id]
-        all_members = [self.get_user(member.id) for member in all_members]
-        target_users = [member for member in all_members if member not in current_users]
+            if not guild.chunked:
+                await guild.chunk()
+            guild_members[guild.id] = {
+                member.id: member for member in guild.members if not member.bot
+            }
+
+        # 前回の同期からメンバー構成が変わっていないギルドは、DBとの比較を省略する
+        watermarks = await self.tag_manager.get_sync_watermarks(list(guild_members))
+        changed = {}
+        for guild_id, members in guild_members.items():
+            digest = member_digest(set(members))
+            watermark = watermarks.get(str(guild_id))
+            if not watermark or watermark["member_digest"] != digest:
+                changed[guild_id] = (len(members), digest)
+
+        target_users = []
+        if changed:
+            known_user_ids = await self.get_known_user_ids()
+            new_members: dict[int, discord.Member] = {}
+            for guild_id in changed:
+                new_members.update(guild_members[guild_id])
+            target_ids = new_members.keys() - known_user_ids
+            target_users = [new_members[user_id] for user_id in target_ids]
 
         # logging
         msg = (
@@ -127,22 +247,31 @@ class Client(discord.Client):
         )
         logging.info(msg)
 
-        # タグマネージャーにセット
-        for user in target_users:
-            self.tag_manager.add_user(user)
-
-    # 通知までの時間を計算
-    async def calc_until_notify(self) -> float:
-        tz = datetime.timezone(datetime.timedelta(hours=9))  # JST
-        today = datetime.datetime.now(tz).date()
-        now = datetime.datetime.now(tz)
-        midnight = datetime.datetime.combine(today, datetime.time(0, 0, 0, 0), tz)
-        until_notify = (
-            midnight + datetime.timedelta(days=1) - now
-        )  # 今日の0時からの残り時間
-        total_seconds = until_notify.total_seconds()
-        logging.info(INFO + f"Until notify: {blue(int(total_seconds))}seconds")
-        return total_seconds
+        # タグマネージャーにセット (500件ずつのバッチ書き込み)
+        if target_users:
+            await self.tag_manager.add_users(
+                target_users,
+                progress=lambda done, total: logging.info(
+                    INFO + f"Adding users: {blue(done)}/{blue(total)}"
+                ),
+            )
+            self.known_user_ids.update(user.id for user in target_users)
+
+        if changed:
+            await self.tag_manager.set_sync_watermarks(changed)
+        self.synced_guild_ids.update(guild_members)
+
+    async def get_known_user_ids(self) -> set[int]:
+        # DBに登録済みのユーザーIDは、プロセスごとに1回だけ(IDのみ)読み込む
+        if self.known_user_ids is None:
+            self.known_user_ids = await self.tag_manager.get_user_ids()
+        return self.known_user_ids
+
+    async def update_sync_watermark(self, guild: discord.Guild):
+        members = {member.id for member in guild.members if not member.bot}
+        await self.tag_manager.set_sync_watermarks(
+            {guild.id: (len(members), member_digest(members))}
+        )
 
     # コマンド実行時のログ
     async def on_app_command_completion(
@@ -177,45 +306,56 @@ class Client(discord.Client):
         now = magenta(now)
         logging.info(INFO + "Presence set at " + now)
 
-    ########## notify ##########
-    notify_freq = 24  # 通知頻度(時間) (将来的にはdiscord上で変更できるようにする(?)) <- guildごとにループを回すのは現実的でないのでなし？
-
-    @discord_tasks.loop(hours=notify_freq)
-    async def notify(self):
-        guilds = self.guilds
-
-        for guild in guilds:
-            notify_ch_id = self.tag_manager.get_notify_channel(guild.id)
-            notify_ch = guild.get_channel(notify_ch_id)
-
-            if not notify_ch:
-                continue
-
-            await self.notification_handler.send_notification(
-                Notification(
-                    client=self,
-                    interaction=None,
-                    send_to_ch={guild: notify_ch},
-                    message=None,  # 未実装
-                    target_tags=[],
-                )
+        # ドキュメントキャッシュのヒット率
+        stats = self.tag_manager.db_manager.cache.stats()
+        logging.info(
+            INFO
+            + f"Cache: {green(stats['hits'])} hits / {yellow(stats['misses'])} misses "
+            + f"({blue(round(stats['hit_rate'] * 100, 1))}%), size {stats['size']}"
+        )
+        for collection, mirror in self.tag_manager.db_manager.mirrors.items():
+            logging.info(
+                INFO + f"Mirror {collection}: {green(mirror.hits)} local reads"
             )
 
-        logging.info(INFO + "Notification sent.")
+    # コマンド・ビューごとの処理時間とDBの呼び出し回数を、構造化ログ(JSON)で出力
+    @discord_tasks.loop(minutes=Metrics.LOG_INTERVAL_MINUTES)
+    async def log_metrics(self):
+        Metrics().log_snapshot()
+
+
+class CommandTree(app_commands.CommandTree):
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        # コマンドの処理時間・DBの呼び出しを、command:<コマンド名>として計測する
+        # 応答を全員に表示するコマンドは、extras={"ephemeral": False}を指定する
+        command = interaction.command
+        Metrics().track(
+            f"command:{command.name if command else 'unknown'}",
+            interaction,
+            ephemeral=command.extras.get("ephemeral", True) if command else True,
+        )
+        return True
+
+    async def on_error(
+        self, interaction: discord.Interaction, error: app_commands.AppCommandError
+    ):
+        if Metrics().current():
+            Metrics().current().failed = True
+        await super().on_error(interaction, error)
 
 
 client = Client()
-tree = discord.app_commands.CommandTree(client)
+tree = CommandTree(client)
 
 
 @tree.command(name=locale_str("ping"), description="for testing")
 async def ping(interaction: discord.Interaction):
-    await interaction.response.send_message("**pong!** 🏓", ephemeral=True)
+    await respond(interaction).send_message("**pong!** 🏓", ephemeral=True)
 
 
 @tree.command(name=locale_str("change_notify_freq"), description="通知頻度を変更します")
 async def change_notify_freq(interaction: discord.Interaction):
-    await interaction.response.send_message("このコマンドは未実装です", ephemeral=True)
+    await respond(interaction).send_modal(NotifyFreqInputModal())
 
 
 @tree.command(
@@ -223,20 +363,22 @@ async def change_notify_freq(interaction: discord.Interaction):
     description="ユーザーを指定したスレッドにタグ付けします",
 )
 async def tag(interaction: discord.Interaction):
+    state = ViewState("tag", guild_id=interaction.guild_id)
     extras = {"tag": Tag(client=client, guild_id=interaction.guild_id)}
-    await interaction.response.send_message(
+    await respond(interaction).send_message(
         ephemeral=True,
-        view=TagView1(extras=extras),
+        view=TagView1(state),
         embed=client.embed_manager.get_embed(extras),
     )
 
 
 @tree.command(name=locale_str("untag"), description="ユーザーからタグ付けを解除します")
 async def untag(interaction: discord.Interaction):
+    state = ViewState("untag", guild_id=interaction.guild_id)
     extras = {"untag": Tag(client=client, guild_id=interaction.guild_id)}
-    await interaction.response.send_message(
+    await respond(interaction).send_message(
         ephemeral=True,
-        view=UntagView1(extras=extras),
+        view=UntagView1(state),
         embed=client.embed_manager.get_embed(extras),
     )
 
@@ -246,10 +388,11 @@ async def untag(interaction: discord.Interaction):
     description="指定したユーザーがタグ付けされているスレッドを取得します",
 )
 async def get_threads_by_user(interaction: discord.Interaction):
+    state = ViewState("get_threads_by_user", guild_id=interaction.guild_id)
     extras = {"get_threads_by_user": Tag(client=client)}
-    await interaction.response.send_message(
+    await respond(interaction).send_message(
         ephemeral=True,
-        view=GetThreadsView1(extras=extras),
+        view=GetThreadsView1(state),
         embed=client.embed_manager.get_embed(extras),
     )
 
@@ -259,98 +402,81 @@ async def get_threads_by_user(interaction: discord.Interaction):
     description="指定したスレッドにタグ付けされているユーザーを取得します",
 )
 async def get_users_by_thread(interaction: discord.Interaction):
+    state = ViewState("get_users_by_thread", guild_id=interaction.guild_id)
     extras = {"get_users_by_thread": Tag(client=client)}
-    await interaction.response.send_message(
+    await respond(interaction).send_message(
         ephemeral=True,
-        view=GetUsersView1(extras=extras),
+        view=GetUsersView1(state),
         embed=client.embed_manager.get_embed(extras),
     )
 
 
 @tree.command(name=locale_str("get_all"), description="全てのタグを取得します")
 async def get_all(interaction: discord.Interaction):
-    result = []
-    for user in client.tag_manager.get_all_users():
-        user_obj = client.get_user(user["user_id"])
-        if not user_obj:
-            continue
-
-        threads = client.tag_manager.get_threads_by_user([user_obj])
-
-        result.append({user_obj: threads})
-
-    extras = {
-        "get_all": Tag(client=client),
-        "result": {"get_all": result, "interaction": interaction},
-    }
-    await interaction.response.send_message(
-        ephemeral=True, embed=client.embed_manager.get_embed(extras)
-    )
+    # 上限を超える場合は複数のページに分け、ボタンで切り替えて表示する
+    # (ページの移動時は、ボタンのcustom_idのViewStateから取得し直す)
+    state = ViewState("get_all", guild_id=interaction.guild.id)
+    message = await result_message(interaction, state)
+    await respond(interaction).send_message(ephemeral=True, **message)
 
 
 @tree.command(
     name=locale_str("toggle_notification"), description="通知のON/OFFを切り替えます"
 )
 async def toggle_notification(interaction: discord.Interaction):
-    current_notification = client.tag_manager.toggle_notification(interaction.user)
+    current_notification = await client.tag_manager.toggle_notification(
+        interaction.user
+    )
     extras = {
         "toggle_notification": Tag(client=client),
         "current_notification": current_notification,
     }
-    await interaction.response.send_message(
+    await respond(interaction).send_message(
         ephemeral=True, embed=client.embed_manager.get_embed(extras)
     )
 
 
 @tree.command(name=locale_str("add_task"), description="タスクを追加します")
 async def add_task(interaction: discord.Interaction):
-    extras = {"add_task": Task(client=client, user=interaction.user)}
-    await interaction.response.send_modal(TaskContentInputModal(extras=extras))
+    state = ViewState("add_task", user_id=interaction.user.id)
+    await respond(interaction).send_modal(TaskContentInputModal(state))
 
 
 @tree.command(name=locale_str("delete_task"), description="タスクを削除します")
 async def delete_task(interaction: discord.Interaction):
-    extras = {"delete_task": Task(client=client, user=interaction.user)}
-    tasks = client.tag_manager.get_tasks(extras["delete_task"])
-    del tasks["used_ids"]
-
-    page = (len(tasks) + 24) // 25
-
-    extras["result"] = {
-        "delete_task": tasks,
-        "interaction": interaction,
-        "page": page,
-        "current_page": 1,
-    }
-
-    view = DeleteTaskViewNext if page > 1 else DeleteTaskViewOnly
-
-    await interaction.response.send_message(
-        ephemeral=True,
-        view=view(extras=extras),
-        embed=client.embed_manager.get_embed(extras),
-    )
+    # 表示するページのタスクだけを取得し、ページの移動時は続きをカーソルで取得する
+    # (カーソルはボタンのcustom_idのViewStateに持つ)
+    state = ViewState("delete_task", user_id=interaction.user.id, page=1)
+    message = await task_page_message(interaction, state)
+    await respond(interaction).send_message(ephemeral=True, **message)
 
 
-@tree.command(name=locale_str("get_tasks"), description="タスクを取得します")
+@tree.command(
+    name=locale_str("get_tasks"),
+    description="タスクを取得します",
+    extras={"ephemeral": False},
+)
 async def get_tasks(interaction: discord.Interaction):
     extras = {"get_tasks": Task(client=client, user=interaction.user)}
-    tasks = client.tag_manager.get_tasks(extras["get_tasks"])
-    del tasks["used_ids"]
+    tasks = await client.tag_manager.get_tasks(extras["get_tasks"])
 
     extras["result"] = {"get_tasks": tasks, "interaction": interaction}
 
     # get_taskだけは全員に表示
-    await interaction.response.send_message(
-        embed=client.embed_manager.get_embed(extras)
+    # 1つのメッセージに収まらない場合は、分割したembedを続けて送る
+    messages = client.embed_manager.group_embeds(
+        client.embed_manager.get_embeds(extras)
     )
+    await respond(interaction).send_message(embeds=messages[0])
+    for embeds in messages[1:]:
+        await interaction.followup.send(embeds=embeds)
 
 
 @tree.command(name=locale_str("help"), description="ヘルプを表示します")
 async def help(interaction: discord.Interaction):
     all_commmands = tree.walk_commands()
 
-    await interaction.response.send_message(
+    await respond(interaction).send_message(
         ephemeral=True, embed=client.embed_manager.get_embed({"result": all_commmands})
     )
 
@@ -358,7 +484,7 @@ async def help(interaction: discord.Interaction):
 @tree.command(name=locale_str("invite"), description="招待リンクを表示します")
 async def invite(interaction: discord.Interaction):
     embed = discord.Embed(title="招待リンク")
-    await interaction.response.send_message(ephemeral=True, embed=embed)
+    await respond(interaction).send_message(ephemeral=True, embed=embed)
 
 
 @tree.command(
@@ -366,10 +492,11 @@ async def invite(interaction: discord.Interaction):
     description="通知を送るチャンネルを設定します",
 )
 async def set_notify_channel(interaction: discord.Interaction):
+    state = ViewState("notify", guild_id=interaction.guild_id)
     extras = {"notify": Tag(client=client, guild_id=interaction.guild_id)}
-    await interaction.response.send_message(
+    await respond(interaction).send_message(
         ephemeral=True,
-        view=NotifyView1(extras=extras),
+        view=NotifyView1(state),
         embed=client.embed_manager.get_embed(extras),
     )
 
@@ -379,13 +506,27 @@ async def set_notify_channel(interaction: discord.Interaction):
     description="通知を送るチャンネルを削除します",
 )
 async def delete_notify_channel(interaction: discord.Interaction):
-    client.tag_manager.delete_notify_channel(interaction.guild)
+    await client.tag_manager.delete_notify_channel(interaction.guild)
     embed = discord.Embed(
         title="削除完了",
         description="通知チャンネルを削除しました。\n通知を受け取るには再度設定を行ってください。",
     )
-    await interaction.response.send_message(ephemeral=True, embed=embed)
+    await respond(interaction).send_message(ephemeral=True, embed=embed)
 
 
 if __name__ == "__main__":
-    client.run(getenv("DISCORD_BOT_TOKEN_MT"))
+    parser = argparse.ArgumentParser(description="member_tagger bot")
+    parser.add_argument(
+        "--profile-startup",
+        action="store_true",
+        help="print per-module import cost (measured in a fresh process) and exit",
+    )
+    args = parser.parse_args()
+
+    if args.profile_startup:
+        import startup_profile
+
+        print(json.dumps(startup_profile.profile_imports("main"), indent=2))
+    else:
+        client.startup.mark("setup")
+        client.run(getenv("DISCORD_BOT_TOKEN_MT"))
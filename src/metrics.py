@@ -0,0 +1,467 @@
+# metrics.py:
+
+import asyncio
+import bisect
+import contextlib
+import contextvars
+import functools
+import json
+import logging
+import os
+import time
+
+import discord
+
+from utils import INFO, WARN, Singleton
+
+"""
+コマンド・ビューごとの処理時間と、DBManagerの呼び出し回数・時間の計測
+
+スラッシュコマンドやビューのコールバックは、interaction_checkでtrack()を呼ぶと
+そのinteractionの処理(タスク)が終わるまでを1つのspanとして計測する
+spanの実行中に呼ばれたDBManagerのメソッドは、spanのラベル(command:tag, view:TagView2など)で集計される
+spanの外(通知の送信、メンバーの同期など)での呼び出しはBACKGROUNDとして集計する
+
+応答が遅いinteractionは自動で保留(defer)する
+- elapsed: AUTO_DEFER_SEC経過しても応答していない場合
+- projected: そのラベルの過去の処理時間(p95)がAUTO_DEFER_SEC以上の場合は、開始直後に
+保留した後の処理はそのまま続け、send_message/edit_messageは元の応答の編集(またはフォローアップ)に置き換える
+(保留の状態を反映するため、ハンドラーはinteraction.responseではなくrespond(interaction)で応答する)
+(Discordは3秒以内に応答しないinteractionを失敗として扱うため)
+
+集計結果はsnapshot()で取得でき、main.pyが定期的に構造化ログ(JSON)として出力する
+MEMBER_TAGGER_METRICS_PORTを指定した場合は、http://127.0.0.1:<port>/metrics でも取得できる
+"""
+
+BACKGROUND = "background"
+ACK_WINDOW_SEC = 3.0  # Discordがinteractionの応答を待つ時間
+# edit_original_responseに渡せる引数 (send_message/edit_messageの引数から選ぶ)
+EDIT_KWARGS = ("content", "embed", "embeds", "attachments", "view", "allowed_mentions")
+
+
+class Histogram:
+    """固定の境界(ミリ秒)で数えるヒストグラム。値そのものは保持しない"""
+
+    BOUNDS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+    __slots__ = ("counts", "count", "total_ms", "max_ms")
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS_MS) + 1)  # 最後は上限を超えたもの
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, seconds: float):
+        value = seconds * 1000
+        self.counts[bisect.bisect_left(self.BOUNDS_MS, value)] += 1
+        self.count += 1
+        self.total_ms += value
+        self.max_ms = max(self.max_ms, value)
+
+    def percentile(self, percent: float) -> float:
+        """percentが含まれる区間の上限 (上限を超えた区間の場合は最大値)"""
+        if not self.count:
+            return 0.0
+        rank = percent / 100 * self.count
+        seen = 0
+        for bound, count in zip(self.BOUNDS_MS, self.counts):
+            seen += count
+            if seen >= rank:
+                return float(bound)
+        return self.max_ms
+
+    def snapshot(self) -> dict:
+        buckets = {
+            f"le_{bound}": count for bound, count in zip(self.BOUNDS_MS, self.counts)
+        }
+        buckets["inf"] = self.counts[-1]
+        return {
+            "count": self.count,
+            "mean_ms": self.total_ms / self.count if self.count else 0.0,
+            "p50_ms": self.percentile(50),
+            "p95_ms": self.percentile(95),
+            "max_ms": self.max_ms,
+            "buckets": buckets,
+        }
+
+
+class Span:
+    """1回のinteraction(または通知などのバックグラウンド処理)の計測中の値"""
+
+    __slots__ = (
+        "label",
+        "start",
+        "response_at",
+        "db_sec",
+        "db_calls",
+        "failed",
+        "deferred",
+        "modal",
+        "responder",
+    )
+
+    def __init__(self, label: str):
+        self.label = label
+        self.start = time.perf_counter()
+        self.response_at: float | None = None
+        # DBManagerの呼び出しにかかった時間の合計 (並行した呼び出しは重複して数える)
+        self.db_sec = 0.0
+        self.db_calls = 0
+        self.failed = False
+        self.deferred: str | None = None  # 自動で保留した理由 ("projected" | "elapsed")
+        self.modal = False  # モーダルで応答したか (モーダルは保留後に送れない)
+        self.responder: "Responder | None" = None  # track()したinteractionへの応答
+
+    def mark_response(self):
+        if self.response_at is None:
+            self.response_at = time.perf_counter()
+
+
+class LabelStats:
+    __slots__ = (
+        "calls",
+        "failures",
+        "db_calls",
+        "deferred_projected",
+        "deferred_elapsed",
+        "late_responses",
+        "modal_responses",
+        "total",
+        "response",
+        "db",
+        "render",
+    )
+
+    def __init__(self):
+        self.calls = 0
+        self.failures = 0
+        self.db_calls = 0
+        self.deferred_projected = 0
+        self.deferred_elapsed = 0
+        self.late_responses = 0  # ACK_WINDOW_SECを過ぎてから応答したもの
+        self.modal_responses = 0
+        self.total = Histogram()  # 処理全体
+        self.response = Histogram()  # interaction.responseで応答するまで
+        self.db = Histogram()  # DBManagerの呼び出しにかかった時間
+        # 処理全体からDBの時間を除いたもの(embed・viewの作成、送信など)
+        self.render = Histogram()
+
+    def snapshot(self) -> dict:
+        return {
+            "calls": self.calls,
+            "failures": self.failures,
+            "db_calls": self.db_calls,
+            "db_calls_per_call": self.db_calls / self.calls if self.calls else 0.0,
+            "deferred_projected": self.deferred_projected,
+            "deferred_elapsed": self.deferred_elapsed,
+            "late_responses": self.late_responses,
+            "total": self.total.snapshot(),
+            "response": self.response.snapshot(),
+            "db": self.db.snapshot(),
+            "render": self.render.snapshot(),
+        }
+
+
+class Responder:
+    """
+    interactionへの応答 (ハンドラーはinteraction.responseの代わりにrespond(interaction)を使う)
+    最初に応答した時刻をspanに記録し、auto_defer()で保留した後は
+    send_message/edit_messageを元の応答の編集(またはフォローアップ)として送る
+    discord.pyの公開APIだけを使い、interaction.response自体は置き換えない
+    """
+
+    __slots__ = ("interaction", "_span", "_ephemeral", "_lock", "_auto_deferred")
+
+    def __init__(
+        self,
+        interaction: discord.Interaction,
+        span: Span | None = None,
+        ephemeral: bool = True,
+    ):
+        self.interaction = interaction
+        self._span = span
+        # コマンドを保留する場合の「考え中」のメッセージの公開範囲
+        self._ephemeral = ephemeral
+        self._lock = asyncio.Lock()
+        self._auto_deferred: str | None = None  # "thinking" | "update"
+
+    def is_done(self) -> bool:
+        return self.interaction.response.is_done()
+
+    def _mark_response(self):
+        if self._span is not None:
+            self._span.mark_response()
+
+    async def auto_defer(self, reason: str) -> bool:
+        async with self._lock:
+            if self.is_done():
+                return False
+            # コマンド(とコマンドから開いたモーダル)は「考え中」のメッセージ、
+            # コンポーネントはメッセージの更新として保留する
+            thinking = (
+                self.interaction.type == discord.InteractionType.application_command
+                or self.interaction.message is None
+            )
+            try:
+                await self.interaction.response.defer(
+                    ephemeral=self._ephemeral, thinking=thinking
+                )
+            except discord.HTTPException as e:
+                label = self._span.label if self._span else BACKGROUND
+                logging.warning(WARN + f"Auto defer failed ({label}): {e}")
+                return False
+            self._auto_deferred = "thinking" if thinking else "update"
+            if self._span is not None:
+                self._span.deferred = reason
+            self._mark_response()
+            return True
+
+    async def defer(self, *args, **kwargs):
+        async with self._lock:
+            if self._auto_deferred:
+                return
+            result = await self.interaction.response.defer(*args, **kwargs)
+            self._mark_response()
+            return result
+
+    async def send_message(self, content=None, **kwargs):
+        async with self._lock:
+            if self._auto_deferred == "thinking":
+                # 「考え中」のメッセージを、送るはずだったメッセージに置き換える
+                return await self.interaction.edit_original_response(
+                    **_edit_kwargs(content, kwargs)
+                )
+            if self._auto_deferred == "update":
+                kwargs.pop("delete_after", None)
+                return await self.interaction.followup.send(content, **kwargs)
+            result = await self.interaction.response.send_message(content, **kwargs)
+            self._mark_response()
+            return result
+
+    async def edit_message(self, **kwargs):
+        async with self._lock:
+            if self._auto_deferred:
+                return await self.interaction.edit_original_response(
+                    **_edit_kwargs(kwargs.pop("content", None), kwargs)
+                )
+            result = await self.interaction.response.edit_message(**kwargs)
+            self._mark_response()
+            return result
+
+    async def send_modal(self, *args, **kwargs):
+        if self._span is not None:
+            self._span.modal = True
+        async with self._lock:
+            result = await self.interaction.response.send_modal(*args, **kwargs)
+            self._mark_response()
+            return result
+
+
+def _edit_kwargs(content, kwargs: dict) -> dict:
+    edit_kwargs = {key: kwargs[key] for key in EDIT_KWARGS if key in kwargs}
+    if content is not None:
+        edit_kwargs["content"] = content
+    return edit_kwargs
+
+
+class Metrics(metaclass=Singleton):
+    LOG_INTERVAL_MINUTES = float(os.getenv("MEMBER_TAGGER_METRICS_INTERVAL", "10"))
+    # 0の場合はエンドポイントを開かない
+    PORT = int(os.getenv("MEMBER_TAGGER_METRICS_PORT", "0"))
+    # 応答せずにこの秒数が経過したら自動で保留する (0の場合は保留しない)
+    AUTO_DEFER_SEC = float(os.getenv("MEMBER_TAGGER_AUTO_DEFER_SEC", "2.0"))
+    # 過去の処理時間から保留を判断するのに必要な回数
+    PROJECTION_MIN_CALLS = 5
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.labels: dict[str, LabelStats] = {}
+        # {(label, DBManagerのメソッド名): Histogram}
+        self.db_calls: dict[tuple[str, str], Histogram] = {}
+        # 実際にストレージとやり取りした回数 (キャッシュ・ミラーから返したものは含まない)
+        self.round_trips: dict[str, Histogram] = {}
+        self._span: contextvars.ContextVar[Span | None] = contextvars.ContextVar(
+            "metrics_span", default=None
+        )
+        self._server = None
+
+    def current(self) -> Span | None:
+        return self._span.get()
+
+    def label(self) -> str:
+        span = self._span.get()
+        return span.label if span else BACKGROUND
+
+    def track(
+        self, label: str, interaction: discord.Interaction, ephemeral: bool = True
+    ) -> Span:
+        """
+        interactionを処理している現在のタスクを、終了するまで計測する
+        interaction_checkから呼ぶ(コマンド・ビューのコールバックと同じタスクで実行されるため)
+        ephemeral: 自動で保留する場合に、応答を本人にだけ表示するか (コマンドのみ)
+        """
+        span = Span(label)
+        self._span.set(span)
+        response = span.responder = Responder(interaction, span, ephemeral)
+
+        timer = None
+        if self.AUTO_DEFER_SEC > 0 and not self.sends_modal(label):
+            if self.projected_sec(label) >= self.AUTO_DEFER_SEC:
+                reason, delay = "projected", 0
+            else:
+                reason, delay = "elapsed", self.AUTO_DEFER_SEC
+            # 保留はハンドラーとは別のタスクで送り、ハンドラーの処理はそのまま続ける
+            timer = asyncio.get_running_loop().call_later(
+                delay, lambda: asyncio.ensure_future(response.auto_defer(reason))
+            )
+
+        def _done(_):
+            if timer is not None:
+                timer.cancel()
+            self.finish(span)
+
+        task = asyncio.current_task()
+        if task is not None:
+            task.add_done_callback(_done)
+        return span
+
+    def projected_sec(self, label: str) -> float:
+        """labelの過去の処理時間のp95 (回数が少ない場合は0)"""
+        stats = self.labels.get(label)
+        if stats is None or stats.calls < self.PROJECTION_MIN_CALLS:
+            return 0.0
+        return stats.total.percentile(95) / 1000
+
+    def sends_modal(self, label: str) -> bool:
+        # モーダルは保留した後に送れないため、モーダルで応答したことのあるラベルは保留しない
+        stats = self.labels.get(label)
+        return stats is not None and stats.modal_responses > 0
+
+    @contextlib.contextmanager
+    def span(self, label: str):
+        """interactionを伴わない処理(通知など)を、withの間だけ計測する"""
+        span = Span(label)
+        token = self._span.set(span)
+        try:
+            yield span
+        except Exception:
+            span.failed = True
+            raise
+        finally:
+            self._span.reset(token)
+            self.finish(span)
+
+    def finish(self, span: Span):
+        elapsed = time.perf_counter() - span.start
+        stats = self.labels.setdefault(span.label, LabelStats())
+        stats.calls += 1
+        stats.failures += span.failed
+        stats.db_calls += span.db_calls
+        stats.total.observe(elapsed)
+        stats.db.observe(span.db_sec)
+        stats.render.observe(max(0.0, elapsed - span.db_sec))
+        if span.response_at is not None:
+            stats.response.observe(span.response_at - span.start)
+            stats.late_responses += span.response_at - span.start > ACK_WINDOW_SEC
+        if span.deferred == "projected":
+            stats.deferred_projected += 1
+        elif span.deferred == "elapsed":
+            stats.deferred_elapsed += 1
+        stats.modal_responses += span.modal
+
+    def record_db(self, method: str, seconds: float):
+        span = self._span.get()
+        if span is not None:
+            span.db_sec += seconds
+            span.db_calls += 1
+        key = (span.label if span else BACKGROUND, method)
+        self.db_calls.setdefault(key, Histogram()).observe(seconds)
+
+    def record_round_trip(self, seconds: float):
+        self.round_trips.setdefault(self.label(), Histogram()).observe(seconds)
+
+    def snapshot(self) -> dict:
+        db_calls: dict[str, dict] = {}
+        for (label, method), histogram in sorted(self.db_calls.items()):
+            db_calls.setdefault(label, {})[method] = histogram.snapshot()
+        return {
+            "uptime_sec": time.time() - self.started_at,
+            "labels": {
+                label: stats.snapshot() for label, stats in sorted(self.labels.items())
+            },
+            "db_calls": db_calls,
+            "round_trips": {
+                label: histogram.snapshot()
+                for label, histogram in sorted(self.round_trips.items())
+            },
+        }
+
+    def log_snapshot(self):
+        # ラベルごとのDBの呼び出し回数が多い順に、1行のJSONで出力する
+        snapshot = self.snapshot()
+        summary = sorted(
+            (
+                {
+                    "label": label,
+                    "calls": stats["calls"],
+                    "db_calls": stats["db_calls"],
+                    "deferred": stats["deferred_projected"] + stats["deferred_elapsed"],
+                    "late_responses": stats["late_responses"],
+                    "round_trips": snapshot["round_trips"]
+                    .get(label, {})
+                    .get("count", 0),
+                    "response_p95_ms": stats["response"]["p95_ms"],
+                    "total_p95_ms": stats["total"]["p95_ms"],
+                    "db_p95_ms": stats["db"]["p95_ms"],
+                }
+                for label, stats in snapshot["labels"].items()
+            ),
+            key=lambda row: row["db_calls"],
+            reverse=True,
+        )
+        logging.info(INFO + "Metrics: " + json.dumps(summary, ensure_ascii=False))
+
+    async def start_server(self, port: int | None = None):
+        """snapshot()をJSONで返すエンドポイントをローカルに開く"""
+        from aiohttp import web  # discord.pyの依存パッケージ
+
+        port = port or self.PORT
+        if not port or self._server is not None:
+            return
+
+        async def handle(request):
+            return web.json_response(self.snapshot())
+
+        app = web.Application()
+        app.router.add_get("/metrics", handle)
+        self._server = web.AppRunner(app)
+        await self._server.setup()
+        await web.TCPSite(self._server, "127.0.0.1", port).start()
+        logging.info(INFO + f"Metrics endpoint: http://127.0.0.1:{port}/metrics")
+
+
+def respond(interaction: discord.Interaction) -> Responder:
+    """
+    interactionに応答するResponder (interaction.responseの代わりに使う)
+    track()で計測中のinteractionの場合は、自動の保留の状態を共有するspanのResponderを返す
+    """
+    span = Metrics().current()
+    if span is not None and span.responder is not None:
+        if span.responder.interaction is interaction:
+            return span.responder
+    return Responder(interaction)
+
+
+def db_call(func):
+    """DBManagerのメソッドの呼び出し回数と時間を、現在のspanのラベルで記録する"""
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            Metrics().record_db(func.__name__, time.perf_counter() - start)
+
+    return wrapper
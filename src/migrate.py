@@ -0,0 +1,155 @@
+# migrate.py:
+
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+
+from firebase_admin import firestore
+
+from db_manager import DBManager, TagManager, Write
+from utils import INFO, ERROR, FORMAT, DATEFORMAT, blue
+
+"""
+ユーザーのドキュメントに埋め込まれていたタグ・タスクを、個別のドキュメントに移行するツール
+    users/<user_id>.tags.<guild_id>.<thread_id> -> tags/<guild_id>-<thread_id>-<user_id>
+    users/<user_id>.tasks.<task_id>              -> users/<user_id>/tasks/<task_id>
+
+usersコレクションをuser_id順にpage_size件ずつ読み、ページごとにバッチで書き込む(全件をメモリに載せない)
+途中で止まっても、再実行すれば旧フィールドが残っているユーザーから移行を続けられる
+新しいドキュメントの書き込みに成功したページだけ、ユーザーのドキュメントから旧フィールドを削除する
+
+実行例: python migrate.py --page-size 200 --dry-run
+"""
+
+logging.basicConfig(level=logging.INFO, format=FORMAT, datefmt=DATEFORMAT)
+
+
+def legacy_writes(
+    tag_manager: TagManager, user_data: dict, now: datetime.datetime
+) -> list[Write]:
+    """1ユーザー分の、旧形式のタグ・タスクを新しいドキュメントに書き込むWrite"""
+    user_id = user_data["user_id"]
+    writes = []
+
+    for guild_id, threads in (user_data.get("tags") or {}).items():
+        for thread_id, deadline in threads.items():
+            writes.append(
+                Write(
+                    "set",
+                    tag_manager.TAGS,
+                    tag_manager.tag_id(guild_id, thread_id, user_id),
+                    {
+                        "user_id": user_id,
+                        "guild_id": guild_id,
+                        "thread_id": thread_id,
+                        "deadline": deadline,
+                    },
+                )
+            )
+
+    tasks = dict(user_data.get("tasks") or {})
+    # 旧形式のtask_id(UUID)は作成順に並ばないため、used_ids(追加順)の順番で振り直す
+    # 先頭を追加順の番号にして、新しく作られるタスクより前に並べる
+    # (再実行しても同じIDになるよう、残りは旧IDから取る)
+    used_ids = tasks.pop("used_ids", [])
+    legacy_ids = [task_id for task_id in used_ids if task_id in tasks]
+    legacy_ids += [task_id for task_id in tasks if task_id not in legacy_ids]
+    for order, legacy_id in enumerate(legacy_ids):
+        task_id = f"{order:016x}{legacy_id.replace('-', '')[:8]}"
+        writes.append(
+            Write(
+                "set",
+                tag_manager.tasks_collection(user_id),
+                task_id,
+                {
+                    "task_id": task_id,
+                    "content": tasks[legacy_id],
+                    "created_at": now,
+                },
+            )
+        )
+    return writes
+
+
+async def migrate(
+    tag_manager: TagManager,
+    page_size: int = 200,
+    keep_legacy: bool = False,
+    dry_run: bool = False,
+) -> dict[str, int]:
+    db_manager = tag_manager.db_manager
+    await db_manager.connect()
+    stats = {"users": 0, "migrated_users": 0, "writes": 0, "failed_pages": 0}
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cursor = None
+
+    while True:
+        page = await db_manager.query(
+            "users", order_by="user_id", limit=page_size, start_after=cursor
+        )
+        if not page:
+            break
+        cursor = page[-1]["user_id"]
+        stats["users"] += len(page)
+
+        writes, cleanup = [], []
+        for user_data in page:
+            if "tags" not in user_data and "tasks" not in user_data:
+                continue  # 移行済み
+            writes += legacy_writes(tag_manager, user_data, now)
+            cleanup.append(
+                Write(
+                    "update",
+                    "users",
+                    str(user_data["user_id"]),
+                    {"tags": firestore.DELETE_FIELD, "tasks": firestore.DELETE_FIELD},
+                )
+            )
+
+        stats["migrated_users"] += len(cleanup)
+        stats["writes"] += len(writes)
+        if not dry_run and cleanup:
+            if await db_manager.batch(writes):
+                if not keep_legacy:
+                    await db_manager.batch(cleanup)
+            else:
+                stats["failed_pages"] += 1
+                logging.error(ERROR + f"Failed to migrate page ending at {cursor}")
+
+        logging.info(
+            INFO
+            + f"Migrated {blue(stats['migrated_users'])} / {blue(stats['users'])} users"
+        )
+        if len(page) < page_size:
+            break
+
+    if not dry_run and not stats["failed_pages"]:
+        stats["threads"] = await tag_manager.rebuild_thread_index()
+        await tag_manager.mark_schema()
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Move tags and tasks out of user documents"
+    )
+    parser.add_argument("--page-size", type=int, default=200)
+    parser.add_argument(
+        "--keep-legacy",
+        action="store_true",
+        help="keep the old tags/tasks fields in user documents",
+    )
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    tag_manager = TagManager()
+    stats = asyncio.run(
+        migrate(tag_manager, args.page_size, args.keep_legacy, args.dry_run)
+    )
+    print(json.dumps(stats, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,12 +2,20 @@
 
 import asyncio
 import datetime
+import heapq
+import itertools
+import logging
+import os
+import time
 from dataclasses import dataclass
 
 import discord
 
+import utils
 from db_manager import Tag
-
+from metrics import Metrics
+from tag_table import TagTable
+from utils import INFO, ERROR, TagRecord, blue, green
 
 channel_schema = dict[discord.Guild, discord.TextChannel | discord.Thread | None]
 
@@ -22,87 +30,380 @@ class Notification:
     target_tags: list[Tag]
 
 
+JST = datetime.timezone(datetime.timedelta(hours=9))
+
+
+class NotificationScheduler:
+    """
+    期限順の通知スケジューラー
+    - digest: ギルドごとの通知頻度(時間)で、JSTの0時を起点にタグの一覧を送る
+    - deadline: スレッドの期限のREMIND_BEFORE前にリマインドを送る
+    次に実行するものだけをheapで管理し、それまではsleepする
+    """
+
+    DEFAULT_FREQ = 24  # 通知頻度(時間)のデフォルト値
+    REMIND_BEFORE = datetime.timedelta(
+        hours=float(os.getenv("MEMBER_TAGGER_REMIND_BEFORE_HOURS", "24"))
+    )
+
+    def __init__(self, handler: "NotificationHandler"):
+        self.handler = handler
+        self.client = handler.client
+        self.freqs: dict[int, int] = {}  # {guild_id: 通知頻度(時間)}
+        self._heap: list[tuple[float, int, str, tuple]] = []
+        # 再スケジュールされた古いエントリはheapに残したまま、ここと一致しないものを捨てる
+        self._scheduled: dict[tuple[str, tuple], float] = {}
+        self._seq = itertools.count()
+        self._wake = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def __len__(self) -> int:
+        return len(self._scheduled)
+
+    def _push(self, fire_at: float, kind: str, key: tuple):
+        self._scheduled[(kind, key)] = fire_at
+        heapq.heappush(self._heap, (fire_at, next(self._seq), kind, key))
+        self._wake.set()
+
+    @staticmethod
+    def next_digest_at(freq: int, now: datetime.datetime | None = None) -> float:
+        """JSTの0時からfreq時間刻みで、nowより後の最初の時刻"""
+        now = now or datetime.datetime.now(JST)
+        midnight = datetime.datetime.combine(now.date(), datetime.time(0), JST)
+        period = datetime.timedelta(hours=freq)
+        return (midnight + period * ((now - midnight) // period + 1)).timestamp()
+
+    def schedule_digest(self, guild_id: int, freq: int | None = None):
+        if freq is not None:
+            self.freqs[guild_id] = freq
+        freq = self.freqs.get(guild_id, self.DEFAULT_FREQ)
+        self._push(self.next_digest_at(freq), "digest", (guild_id,))
+
+    def schedule_deadline(
+        self, guild_id: int | str, thread_id: int | str, deadline: datetime.datetime
+    ):
+        if not deadline:
+            return
+        if deadline.tzinfo is None:
+            # FirestoreはnaiveなdatetimeをUTCとして保存するため、再起動後(restore)と同じ時刻になるようUTCとして扱う
+            deadline = deadline.replace(tzinfo=datetime.timezone.utc)
+        if deadline.timestamp() <= time.time():
+            return
+        remind_at = max((deadline - self.REMIND_BEFORE).timestamp(), time.time())
+        self._push(remind_at, "deadline", (int(guild_id), int(thread_id)))
+
+    def schedule_tag(self, tag: Tag):
+        self.schedule_deadline(tag.guild_id, tag.thread_id, tag.deadline)
+
+    @staticmethod
+    def reminded(index: dict) -> bool:
+        """スレッドのインデックスの期限のリマインドを、既に送ったか"""
+        reminded, deadline = index.get("reminded"), index.get("deadline")
+        return (
+            reminded is not None
+            and deadline is not None
+            and utils.comparable(reminded) == utils.comparable(deadline)
+        )
+
+    async def restore(self):
+        """
+        通知頻度の設定(1回の読み込み)と、期限が未来のスレッド(インデックスへの範囲クエリ)からキューを復元する
+        usersコレクションの全件読み込みは行わない
+        リマインドを送り済みのスレッドは、再起動のたびに送り直さないよう除く
+        """
+        tag_manager = self.client.tag_manager
+        freqs = await tag_manager.get_notify_freqs()
+        self.freqs = {int(guild_id): int(freq) for guild_id, freq in freqs.items()}
+        for guild in self.client.guilds:
+            self.schedule_digest(guild.id)
+
+        now = datetime.datetime.now(datetime.timezone.utc)
+        for index in await tag_manager.get_upcoming_deadlines(now):
+            if index.get("user_ids") and not self.reminded(index):
+                self.schedule_deadline(
+                    index["guild_id"], index["thread_id"], index["deadline"]
+                )
+
+        logging.info(INFO + f"Notification queue restored: {blue(len(self))} entries")
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while True:
+            self._wake.clear()
+            timeout = self._heap[0][0] - time.time() if self._heap else None
+            if timeout is None or timeout > 0:
+                # 次の予定時刻まで、または新しい予定が追加されるまで待機
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            try:
+                await self.dispatch(self._pop_due())
+            except Exception as e:
+                logging.error(ERROR + f"Notification failed: {e}")
+
+    def _pop_due(self) -> list[tuple[str, tuple]]:
+        now = time.time()
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            fire_at, _, kind, key = heapq.heappop(self._heap)
+            if self._scheduled.get((kind, key)) != fire_at:
+                continue
+            del self._scheduled[(kind, key)]
+            due.append((kind, key))
+        return due
+
+    async def dispatch(self, due: list[tuple[str, tuple]]):
+        digest_guild_ids = [key[0] for kind, key in due if kind == "digest"]
+        deadlines = [key for kind, key in due if kind == "deadline"]
+
+        # 次回のダイジェストを予約してから送る
+        for guild_id in digest_guild_ids:
+            self.schedule_digest(guild_id)
+        # 同じ時刻に来たギルドはまとめて送り、ユーザーデータの読み込みを1回で済ませる
+        if digest_guild_ids:
+            with Metrics().span("notify:digest"):
+                await self.handler.send_digest(digest_guild_ids)
+
+        for guild_id, thread_id in deadlines:
+            with Metrics().span("notify:reminder"):
+                await self.handler.send_reminder(guild_id, thread_id)
+
+
 class NotificationHandler:
+    # 同時に送信するギルド(チャンネル)の数
+    CONCURRENCY = int(os.getenv("MEMBER_TAGGER_NOTIFY_CONCURRENCY", "8"))
+    MAX_RETRIES = 3
+
     def __init__(self, client: discord.Client):
         self.client = client
+        self.scheduler = NotificationScheduler(self)
+        self.last_dispatch_stats: dict[str, float | int] = {}
+        # グローバルなレート制限を受けた場合、この時刻まで全てのチャンネルの送信を止める
+        self._resume_at = 0.0
 
-    async def format_db_data(
-        self,
-        data: list[dict[discord.User, dict[str, list[tuple[str | datetime.datetime]]]]],
-        notification_data: Notification | None = None,
-    ):
+    async def dispatch(
+        self, outbox: dict[discord.abc.Messageable, list[discord.Embed]]
+    ) -> dict[str, float | int]:
+        """
+        チャンネルごとのembedを、最大CONCURRENCY件のチャンネルへ並行して送る
+        同じチャンネルへの送信は順番通りに行い、失敗したチャンネルは他の送信を止めない
+        """
+        semaphore = asyncio.Semaphore(self.CONCURRENCY)
+        latencies: list[float] = []
+        failures = 0
+
+        async def _send_channel(channel, embeds: list[discord.Embed]):
+            nonlocal failures
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    for embed in embeds:
+                        await self._send_with_retry(channel, embed)
+                except Exception as e:
+                    failures += 1
+                    logging.error(ERROR + f"Notification to {channel} failed: {e}")
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(
+            *[_send_channel(channel, embeds) for channel, embeds in outbox.items()]
+        )
+        elapsed = time.perf_counter() - start
+
+        messages = sum(len(embeds) for embeds in outbox.values())
+        stats = {
+            "channels": len(outbox),
+            "messages": messages,
+            "failures": failures,
+            "elapsed_sec": elapsed,
+            "throughput_per_sec": messages / elapsed if elapsed else 0.0,
+            "latency_p50_sec": utils.percentile(latencies, 50),
+            "latency_p95_sec": utils.percentile(latencies, 95),
+            "latency_max_sec": max(latencies, default=0.0),
+        }
+        self.last_dispatch_stats = stats
+        if outbox:
+            logging.info(
+                INFO
+                + f"Dispatched {green(messages)} messages to {green(len(outbox))} channels "
+                + f"in {blue(round(elapsed, 2))}s "
+                + f"(p95 {blue(round(stats['latency_p95_sec'], 2))}s, failures {failures})"
+            )
+        return stats
+
+    async def _send_with_retry(self, channel, embed: discord.Embed):
+        # discord.py自身もレート制限を待つが、待ち時間が長い場合や再試行を使い切った場合はここで待つ
+        # 全ての送信を止めるのはグローバルなレート制限の場合だけで、
+        # ルートごとの429や5xxは、このチャンネルの送信だけを待たせる(他のチャンネルは送り続ける)
+        for attempt in range(self.MAX_RETRIES + 1):
+            wait = self._resume_at - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            try:
+                return await channel.send(embed=embed)
+            except discord.RateLimited as e:
+                # グローバルなレート制限では送出されない (ルートごとの制限)
+                retry_after, is_global = e.retry_after, False
+            except discord.HTTPException as e:
+                if e.status != 429 and e.status < 500:
+                    raise
+                retry_after = self._retry_after(e, attempt)
+                is_global = self._is_global(e)
+
+            if attempt == self.MAX_RETRIES:
+                raise RuntimeError(f"Gave up after {attempt + 1} attempts")
+            if is_global:
+                self._resume_at = max(self._resume_at, time.monotonic() + retry_after)
+            else:
+                await asyncio.sleep(retry_after)
+
+    @staticmethod
+    def _retry_after(error: discord.HTTPException, attempt: int) -> float:
+        headers = getattr(error.response, "headers", None) or {}
+        for header in ("Retry-After", "X-RateLimit-Reset-After"):
+            if header in headers:
+                return float(headers[header])
+        return 2**attempt  # ヘッダーが無い場合(5xxなど)は指数バックオフ
+
+    @staticmethod
+    def _is_global(error: discord.HTTPException) -> bool:
+        # HTTPExceptionは本文のglobalを保持しないため、レスポンスのヘッダーで判定する
+        if error.status != 429:
+            return False
+        headers = getattr(error.response, "headers", None) or {}
+        return (
+            str(headers.get("X-RateLimit-Global", "")).lower() == "true"
+            or headers.get("X-RateLimit-Scope") == "global"
+        )
+
+    def format_tag_table(
+        self, table: TagTable, guilds: list[discord.Guild]
+    ) -> dict[discord.Guild, list[TagRecord]]:
         """
-        data such as [{user: {guild_id(str): [(thread_id(str), deadline(datetime.datetime)) ...], ...}, ...]
-        formatted_data such as [{guild: [Tag, Tag, ...], ...}, ...]
+        通知するギルドのタグを、タグのテーブルから {guild: [TagRecord, TagRecord, ...], ...} の形で取得する
+        ギルドのタグは期限順に取得し、ユーザーごとにまとめる (ユーザーは期限が早いタグを持つ順)
+        件数が多いため、1行ごとのTagは作らず、IDと期限だけのTagRecordにする
         """
-        formatted_data = []
-
-        for user_data in data:
-            for user, threads in user_data.items():
-                for guild_id, thread_data in threads.items():
-                    guild = self.client.get_guild(
-                        int(guild_id)
-                    )  # 存在の確認のための変換
-                    if not guild:
-                        continue
-
-                    guild_data = {guild: []}
-                    for thread_id, deadline in thread_data:
-                        thread = guild.get_thread(
-                            int(thread_id)
-                        )  # 存在の確認のための変換
-                        if not thread:
-                            continue
-
-                        tag = Tag(
-                            client=self.client,
-                            guild_id=guild_id,
-                            thread_id=thread_id,
-                            deadline=deadline,
-                            users=[user],
-                        )
-                        guild_data[guild].append(tag)
-
-                    formatted_data.append(guild_data)
+        formatted_data: dict[discord.Guild, list[TagRecord]] = {}
+        for guild in guilds:
+            tags_by_user: dict[int, list[TagRecord]] = {}
+            for tag in table.guild_records(guild.id):
+                # 存在しないスレッド・ユーザーのタグは除外
+                thread = guild.get_thread(tag.thread_id)
+                user = self.client.get_user(tag.user_id)
+                if not thread or not user:
+                    continue
+                # IDはdiscordのオブジェクトのintを共有する (レコードごとにintを持たない)
+                tag.user_id, tag.guild_id, tag.thread_id = user.id, guild.id, thread.id
+                tags_by_user.setdefault(tag.user_id, []).append(tag)
 
+            formatted_data[guild] = [
+                tag for user_tags in tags_by_user.values() for tag in user_tags
+            ]
         return formatted_data
 
     async def send_notification(self, notification_data: Notification):
-        # 全ユーザーを取得 -> ユーザーごとにスレッドを取得(全ユーザーの全タグを取得) -> データを整形
-        all_users = notification_data.client.tag_manager.get_all_users()
-        result = []
+        # 全タグのテーブルを取得(古い場合はtagsコレクションを1回読んで作り直す) -> 通知するギルドの分だけ整形
+        tag_manager = notification_data.client.tag_manager
+        table = await tag_manager.get_tag_table()
+        formatted_data = self.format_tag_table(
+            table, list(notification_data.send_to_ch)
+        )
 
-        for user in all_users:
-            user_obj = notification_data.client.get_user(user["user_id"])
-
-            if not user_obj:
+        # guildごとに通知を送る。ユーザーごとのタグをembed_managerに渡して、embedを作成してもらう
+        outbox: dict[discord.abc.Messageable, list[discord.Embed]] = {}
+        for guild, guild_tags in formatted_data.items():
+            # 通知先のチャンネルを取得
+            channel = notification_data.send_to_ch.get(guild)
+            if not channel:
                 continue
 
-            threads = notification_data.client.tag_manager.get_threads_by_user(
-                [user_obj]
+            # TagRecordはユーザーの順に並んでいるため、続いている範囲ごとに分ける
+            for _, tags in itertools.groupby(guild_tags, key=lambda tag: tag.user_id):
+                tags = list(tags)
+                result = {
+                    "notification": tags,
+                    "result": {
+                        "notification": tags,
+                        "client": notification_data.client,
+                    },
+                }  # 超冗長だけど他の処理に合わせるためにこうしています
+                # 通知が多い場合は、上限に収まるように複数のembedに分ける
+                embeds = notification_data.client.embed_manager.get_embeds(result)
+                outbox.setdefault(channel, []).extend(embeds)
+
+        await self.dispatch(outbox)
+
+        return formatted_data  # 通知したデータを返す
+
+    async def send_digest(self, guild_ids: list[int]):
+        """guild_idsのギルドの通知チャンネルに、タグの一覧を送る"""
+        notify_channels = await self.client.tag_manager.get_notify_channels()
+        send_to_ch = {}
+
+        for guild_id in guild_ids:
+            guild = self.client.get_guild(guild_id)
+            notify_ch_id = notify_channels.get(str(guild_id))
+            notify_ch = (
+                guild.get_channel(notify_ch_id) if guild and notify_ch_id else None
             )
-            result.append({user_obj: threads})
 
-        # データを整形
-        formatted_data = await self.format_db_data(result)
+            if not notify_ch:
+                continue
 
-        # guildごとに通知を送る。ギルドごとにデータを丸ごとembed_managerに渡して、embedを作成してもらう
-        for guild_data in formatted_data:
-            tags = guild_data[list(guild_data.keys())[0]]
+            send_to_ch[guild] = notify_ch
 
-            result = {
-                "notification": tags,
-                "result": {"notification": tags},
-            }  # 超冗長だけど他の処理に合わせるためにこうしています
-            embed = notification_data.client.embed_manager.get_embed(result)
+        if not send_to_ch:
+            return
 
-            # 通知先のチャンネルを取得
-            channel = (
-                notification_data.send_to_ch[list(guild_data.keys())[0]]
-                if list(guild_data.keys())[0] in notification_data.send_to_ch
-                else None
+        await self.send_notification(
+            Notification(
+                client=self.client,
+                interaction=None,
+                send_to_ch=send_to_ch,
+                message=None,  # 未実装
+                target_tags=[],
             )
+        )
+        logging.info(INFO + f"Notification sent to {green(len(send_to_ch))} guilds.")
 
-            await channel.send(embed=embed) if channel else None
+    async def send_reminder(self, guild_id: int, thread_id: int):
+        """期限が近いスレッドにタグ付けされているユーザーへのリマインドを送る"""
+        tag_manager = self.client.tag_manager
+        # 予約後にタグが解除されている場合もあるため、送信前にインデックスで確認する
+        index = await tag_manager.get_thread_index(guild_id, thread_id)
+        if not index or not index.get("user_ids") or not index.get("deadline"):
+            return
+        # 送り済みの場合と、予約後に期限が延びてまだ送る時刻でない場合は送らない
+        if self.scheduler.reminded(index):
+            return
+        deadline = index["deadline"]
+        if (deadline - self.scheduler.REMIND_BEFORE).timestamp() > time.time():
+            self.scheduler.schedule_deadline(guild_id, thread_id, deadline)
+            return
 
-        return formatted_data  # 通知したデータを返す
+        guild = self.client.get_guild(guild_id)
+        thread = guild.get_thread(thread_id) if guild else None
+        notify_ch_id = await tag_manager.get_notify_channel(guild_id)
+        channel = guild.get_channel(notify_ch_id) if guild and notify_ch_id else None
+        if not thread or not channel:
+            return
+
+        users = [self.client.get_user(user_id) for user_id in index["user_ids"]]
+        tag = Tag(
+            client=self.client,
+            guild_id=guild_id,
+            thread_id=thread_id,
+            users=[user for user in users if user],
+            deadline=deadline,
+        )
+        await self._send_with_retry(
+            channel, self.client.embed_manager.get_embed({"reminder": tag})
+        )
+        await tag_manager.mark_reminded(guild_id, thread_id, deadline)
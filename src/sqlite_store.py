@@ -0,0 +1,393 @@
+# sqlite_store.py:
+
+import datetime
+import json
+import operator
+import sqlite3
+import threading
+import uuid
+
+from google.api_core.exceptions import Aborted, NotFound
+
+from utils import comparable, match_filter, merge_fields, update_fields
+
+"""
+firestore.Clientのうち、DBManagerが使う部分をSQLiteで実装したストレージ
+DBManager(db=SQLiteClient(path))、または環境変数 MEMBER_TAGGER_STORAGE=sqlite で使う
+
+ドキュメントはJSONとして保存する。tags/thread_indexは専用のテーブルに置き、
+検索に使うフィールドを列として持たせてインデックスを張る(それ以外のコレクションはdocumentsテーブル)
+WALモードで開き、読み込みはスレッドごとの接続で並行して行う。書き込みはロックで直列化する
+スナップショットリスナー(on_snapshot)には対応しない
+"""
+
+
+class SQLiteDocumentSnapshot:
+    def __init__(self, reference: "SQLiteDocumentReference", data: dict | None):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+
+    @property
+    def exists(self) -> bool:
+        return self._data is not None
+
+    def to_dict(self) -> dict | None:
+        return self._data
+
+
+class SQLiteDocumentReference:
+    def __init__(self, client: "SQLiteClient", collection: str, document: str):
+        self._client = client
+        self.collection_name = collection
+        self.id = document
+
+    def get(
+        self, transaction: "SQLiteTransaction | None" = None
+    ) -> SQLiteDocumentSnapshot:
+        snapshot = self._client.get_all([self])[0]
+        if transaction is not None:
+            transaction._reads[(self.collection_name, self.id)] = snapshot.to_dict()
+        return snapshot
+
+    def set(self, data: dict, merge: bool = False):
+        self._client._write([("merge" if merge else "set", self, data)])
+
+    def update(self, data: dict):
+        self._client._write([("update", self, data)])
+
+    def delete(self):
+        self._client._write([("delete", self, None)])
+
+
+class SQLiteCollectionReference:
+
+    def __init__(
+        self,
+        client: "SQLiteClient",
+        name: str,
+        limit: int | None = None,
+        filters: tuple = (),
+        order_by: str | None = None,
+        start_after: dict | None = None,
+        direction: str = "ASCENDING",
+    ):
+        self._client = client
+        self.name = name
+        self._limit = limit
+        self._filters = filters
+        self._order_by = order_by
+        self._start_after = start_after
+        self._direction = direction
+
+    def document(self, document: str | None = None) -> SQLiteDocumentReference:
+        return SQLiteDocumentReference(
+            self._client, self.name, document or uuid.uuid4().hex[:20]
+        )
+
+    def add(self, data: dict, document_id: str | None = None, timeout=None):
+        ref = self.document(document_id)
+        ref.set(data)
+        return None, ref
+
+    def on_snapshot(self, callback):
+        raise NotImplementedError("SQLite storage does not support listeners")
+
+    def _query(self, **kwargs) -> "SQLiteCollectionReference":
+        params = {
+            "limit": self._limit,
+            "filters": self._filters,
+            "order_by": self._order_by,
+            "start_after": self._start_after,
+            "direction": self._direction,
+        }
+        params.update(kwargs)
+        return SQLiteCollectionReference(self._client, self.name, **params)
+
+    def where(self, filter) -> "SQLiteCollectionReference":
+        return self._query(filters=self._filters + (filter,))
+
+    def order_by(
+        self, field: str, direction: str = "ASCENDING"
+    ) -> "SQLiteCollectionReference":
+        return self._query(order_by=field, direction=direction)
+
+    def start_after(self, document_fields: dict) -> "SQLiteCollectionReference":
+        return self._query(start_after=document_fields)
+
+    def select(self, field_paths: list[str]) -> "SQLiteCollectionReference":
+        return self
+
+    def limit(self, count: int) -> "SQLiteCollectionReference":
+        return self._query(limit=count)
+
+    def stream(self):
+        yield from self.get()
+
+    def get(self) -> list[SQLiteDocumentSnapshot]:
+        return self._client._query(self)
+
+
+class SQLiteWriteBatch:
+    def __init__(self, client: "SQLiteClient"):
+        self._client = client
+        self._writes: list[tuple[str, SQLiteDocumentReference, dict | None]] = []
+        # firestoreのWriteBatchと同じ属性 (スナップショットリスナーが無いため、コミット時刻は記録しない)
+        self.commit_time = None
+
+    def set(self, ref: SQLiteDocumentReference, data: dict, merge: bool = False):
+        self._writes.append(("merge" if merge else "set", ref, data))
+
+    def update(self, ref: SQLiteDocumentReference, data: dict):
+        self._writes.append(("update", ref, data))
+
+    def delete(self, ref: SQLiteDocumentReference):
+        self._writes.append(("delete", ref, None))
+
+    def commit(self):
+        # 1回のトランザクションで、全ての書き込みをアトミックに適用する
+        self._client._write(self._writes)
+        self._writes = []
+
+
+class SQLiteTransaction(SQLiteWriteBatch):
+    """
+    firestore.transactionalから使えるトランザクション
+    読んだドキュメントが、書き込み用のロックを取った時点で変更されていた場合はAbortedを送出する
+    """
+
+    def __init__(self, client: "SQLiteClient", max_attempts: int = 5):
+        super().__init__(client)
+        self._max_attempts = max_attempts
+        self._read_only = False
+        self._id = None
+        self._reads: dict[tuple[str, str], dict | None] = {}
+
+    def _clean_up(self):
+        self._writes = []
+        self._reads = {}
+        self._id = None
+
+    def _begin(self, retry_id=None):
+        self._id = uuid.uuid4().hex
+
+    def _rollback(self):
+        self._clean_up()
+
+    def _commit(self):
+        self._client._write(self._writes, expected=self._reads)
+        self._clean_up()
+
+
+class SQLiteClient:
+    # 専用のテーブルに置くコレクションと、列として持たせるフィールド
+    INDEXED_COLLECTIONS = {
+        "tags": ("user_id", "guild_id", "thread_id", "deadline"),
+        "thread_index": ("guild_id", "thread_id", "deadline"),
+    }
+    INDEXES = {
+        "tags": (("guild_id", "thread_id"), ("user_id",), ("deadline",)),
+        "thread_index": (("deadline",),),
+    }
+    # SQLに変換できる条件 (それ以外の条件は読み込んだ後にメモリ上で評価する)
+    SQL_OPERATORS = ("==", "!=", "<", "<=", ">", ">=", "in")
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self._create_tables()
+
+    def collection(self, name: str) -> SQLiteCollectionReference:
+        return SQLiteCollectionReference(self, name)
+
+    def batch(self) -> SQLiteWriteBatch:
+        return SQLiteWriteBatch(self)
+
+    def transaction(self, max_attempts: int = 5) -> SQLiteTransaction:
+        return SQLiteTransaction(self, max_attempts)
+
+    def get_all(self, references: list[SQLiteDocumentReference]):
+        conn = self._connection()
+        return [
+            SQLiteDocumentSnapshot(ref, self._read(conn, ref)) for ref in references
+        ]
+
+    ########## internal ##########
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _create_tables(self):
+        conn = self._connection()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS documents ("
+            "collection TEXT NOT NULL, document TEXT NOT NULL, data TEXT NOT NULL, "
+            "PRIMARY KEY (collection, document)) WITHOUT ROWID"
+        )
+        for table, fields in self.INDEXED_COLLECTIONS.items():
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} ("
+                f"document TEXT PRIMARY KEY, data TEXT NOT NULL, {', '.join(fields)})"
+            )
+            for columns in self.INDEXES[table]:
+                conn.execute(
+                    f"CREATE INDEX IF NOT EXISTS {table}_{'_'.join(columns)} "
+                    f"ON {table} ({', '.join(columns)})"
+                )
+
+    def _scope(self, collection: str) -> tuple[str, list[str], list]:
+        """(テーブル名, WHERE句の条件, パラメータ)"""
+        if collection in self.INDEXED_COLLECTIONS:
+            return collection, [], []
+        return "documents", ["collection = ?"], [collection]
+
+    def _read(self, conn: sqlite3.Connection, ref: SQLiteDocumentReference):
+        table, conditions, params = self._scope(ref.collection_name)
+        row = conn.execute(
+            f"SELECT data FROM {table} WHERE {' AND '.join(conditions + ['document = ?'])}",
+            params + [ref.id],
+        ).fetchone()
+        return _decode(row[0]) if row else None
+
+    def _write(
+        self,
+        writes: list[tuple[str, SQLiteDocumentReference, dict | None]],
+        expected: dict[tuple[str, str], dict | None] | None = None,
+    ):
+        """expected: {(collection, document): data} 書き込む前に、この内容のままであることを確認する"""
+        with self._write_lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for (collection, document), data in (expected or {}).items():
+                    ref = SQLiteDocumentReference(self, collection, document)
+                    if self._read(conn, ref) != data:
+                        raise Aborted(f"Transaction aborted: {collection}/{document}")
+                for op, ref, data in writes:
+                    self._apply(conn, op, ref, data)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+    def _apply(self, conn: sqlite3.Connection, op: str, ref, data: dict | None):
+        table, conditions, params = self._scope(ref.collection_name)
+        if op == "delete":
+            conn.execute(
+                f"DELETE FROM {table} WHERE {' AND '.join(conditions + ['document = ?'])}",
+                params + [ref.id],
+            )
+            return
+
+        current = self._read(conn, ref)
+        if op == "update":
+            if current is None:
+                raise NotFound(f"No document to update: {ref.collection_name}/{ref.id}")
+            data = update_fields(current, data)
+        else:
+            data = merge_fields((current or {}) if op == "merge" else {}, data)
+
+        if table == "documents":
+            conn.execute(
+                "INSERT OR REPLACE INTO documents (collection, document, data) "
+                "VALUES (?, ?, ?)",
+                [ref.collection_name, ref.id, _encode(data)],
+            )
+        else:
+            fields = self.INDEXED_COLLECTIONS[table]
+            conn.execute(
+                f"INSERT OR REPLACE INTO {table} (document, data, {', '.join(fields)}) "
+                f"VALUES ({', '.join('?' * (len(fields) + 2))})",
+                [ref.id, _encode(data)] + [comparable(data.get(f)) for f in fields],
+            )
+
+    def _query(self, query: SQLiteCollectionReference) -> list[SQLiteDocumentSnapshot]:
+        table, conditions, params = self._scope(query.name)
+        columns = self.INDEXED_COLLECTIONS.get(table, ())
+
+        # インデックスのある列への条件はSQLで、それ以外は読み込んだ後に評価する
+        rest = []
+        for field_filter in query._filters:
+            field, op, value = (
+                field_filter.field_path,
+                field_filter.op_string,
+                field_filter.value,
+            )
+            if field not in columns or op not in self.SQL_OPERATORS:
+                rest.append((field, op, value))
+            elif op == "in":
+                conditions.append(f"{field} IN ({', '.join('?' * len(value))})")
+                params.extend(comparable(v) for v in value)
+            else:
+                conditions.append(f"{field} {'=' if op == '==' else op} ?")
+                params.append(comparable(value))
+
+        order_by = query._order_by
+        descending = query._direction == "DESCENDING"
+        sql = f"SELECT document, data FROM {table}"
+        if order_by in columns:
+            # Firestoreと同じく、order_byのフィールドを持たないドキュメントは除外される
+            conditions.append(f"{order_by} IS NOT NULL")
+            if query._start_after is not None:
+                conditions.append(f"{order_by} {'<' if descending else '>'} ?")
+                params.append(comparable(query._start_after[order_by]))
+        if conditions:
+            sql += f" WHERE {' AND '.join(conditions)}"
+        if order_by in columns:
+            sql += (
+                f" ORDER BY {order_by} DESC, document DESC"
+                if descending
+                else f" ORDER BY {order_by}, document"
+            )
+            if not rest and query._limit is not None:
+                sql += " LIMIT ?"
+                params.append(query._limit)
+
+        docs = [
+            (document, _decode(data))
+            for document, data in self._connection().execute(sql, params)
+        ]
+        docs = [d for d in docs if all(match_filter(d[1], *f) for f in rest)]
+        if order_by and order_by not in columns:
+            docs = sorted(
+                (d for d in docs if order_by in d[1]),
+                key=lambda d: comparable(d[1][order_by]),
+                reverse=descending,
+            )
+            if query._start_after is not None:
+                cursor = comparable(query._start_after[order_by])
+                after = operator.lt if descending else operator.gt
+                docs = [d for d in docs if after(comparable(d[1][order_by]), cursor)]
+        if query._limit is not None:
+            docs = docs[: query._limit]
+        return [
+            SQLiteDocumentSnapshot(query.document(document), data)
+            for document, data in docs
+        ]
+
+
+def _encode(data: dict) -> str:
+    return json.dumps(data, default=_encode_value, ensure_ascii=False)
+
+
+def _encode_value(value):
+    if isinstance(value, datetime.datetime):
+        return {"$datetime": value.isoformat()}
+    raise TypeError(f"Unsupported value type. (type: {type(value).__name__})")
+
+
+def _decode(text: str) -> dict:
+    return json.loads(text, object_hook=_decode_value)
+
+
+def _decode_value(value: dict):
+    if value.keys() == {"$datetime"}:
+        return datetime.datetime.fromisoformat(value["$datetime"])
+    return value
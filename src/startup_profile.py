@@ -0,0 +1,98 @@
+# startup_profile.py:
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+"""
+起動時のimportにかかる時間の計測
+新しいプロセスでmoduleをimportし、python -X importtimeの出力をモジュール・パッケージごとに集計する
+(計測するプロセスは、すでにimport済みのモジュールの影響を受けないよう毎回新しく起動する)
+
+実行例: python main.py --profile-startup
+        python startup_profile.py main --top 30
+"""
+
+# 起動時には読み込まず、最初に使う時に読み込むパッケージ (読み込まれていれば遅延が効いていない)
+DEFERRED_MODULES = (
+    "firebase_admin",
+    "google.cloud.firestore_v1",
+    "google.api_core.exceptions",
+    "requests",
+    "sqlite_store",
+)
+
+
+def parse_importtime(stderr: str) -> list[dict]:
+    """-X importtimeの出力を [{name, depth, self_ms, cumulative_ms}, ...] (読み込み順) にする"""
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        modules.append(
+            {
+                "name": name.strip(),
+                "depth": (len(name) - len(name.lstrip()) - 1) // 2,
+                "self_ms": int(self_us) / 1000,
+                "cumulative_ms": int(cumulative_us) / 1000,
+            }
+        )
+    return modules
+
+
+def profile_imports(module: str = "main", top: int = 20) -> dict:
+    """moduleのimportにかかる時間を、新しいプロセスで計測する"""
+    code = (
+        f"import sys, json; import {module}; "
+        f"print(json.dumps([m for m in {list(DEFERRED_MODULES)!r} if m in sys.modules]))"
+    )
+    start = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    wall_sec = time.perf_counter() - start
+    if process.returncode != 0:
+        raise RuntimeError(f"Failed to import {module}: {process.stderr[-1000:]}")
+
+    modules = parse_importtime(process.stderr)
+    # 自身の時間(self)はモジュールごとに重複しないため、そのまま足し合わせられる
+    packages: dict[str, float] = {}
+    for entry in modules:
+        package = entry["name"].split(".")[0]
+        packages[package] = packages.get(package, 0.0) + entry["self_ms"]
+    total_ms = next(
+        (m["cumulative_ms"] for m in modules if m["name"] == module and not m["depth"]),
+        0.0,
+    )
+    loaded = json.loads(process.stdout.strip().splitlines()[-1])
+
+    return {
+        "module": module,
+        "wall_sec": wall_sec,  # インタープリターの起動を含む
+        "import_ms": total_ms,
+        "module_count": len(modules),
+        "packages": dict(sorted(packages.items(), key=lambda p: p[1], reverse=True)),
+        "slowest": sorted(modules, key=lambda m: m["cumulative_ms"], reverse=True)[
+            :top
+        ],
+        "deferred": {name: name not in loaded for name in DEFERRED_MODULES},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Profile import cost of a module")
+    parser.add_argument("module", nargs="?", default="main")
+    parser.add_argument("--top", type=int, default=20)
+    args = parser.parse_args()
+    print(json.dumps(profile_imports(args.module, args.top), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,298 @@
+# tag_table.py:
+
+import bisect
+import datetime
+import importlib.util
+import math
+import time
+from array import array
+from typing import Iterable
+
+from utils import LazyModule, TagRecord
+
+"""
+全タグ (user_id, guild_id, thread_id, deadline) を列ごとのarrayで持つ、メモリ上のテーブル
+1行は32バイト(+インデックス1つにつき8バイト)で、数百万件のタグも1プロセスに収まる
+
+検索は並べ替えのインデックス(行番号の列)の二分探索で行う
+- guild: (guild_id, deadline)  ギルドのタグ(期限順)、ギルドの期限が近いタグ
+- user: (user_id, deadline)  ユーザーのタグ(期限順)
+- thread: (guild_id, thread_id, user_id)  スレッドのユーザー、行の検索
+- deadline: (deadline,)  全ギルドの期限が近いタグ
+インデックスはbuildでまとめて作る (全件の並べ替えのため、イベントループの外(executor)で呼ぶ)
+作成後の追加は挿入位置を二分探索してインデックスに差し込み、削除は行に印を付けるだけにする
+(書き込みのたびに並べ替えない。削除した行はTTLで作り直すまで残り、検索の結果からは除く)
+NumPyがインストールされている場合は、インデックスの作成(全件の並べ替え)にNumPyを使う (無くても動く)
+作成したインデックスはどちらの場合もarrayで持つため、検索と差し込みの処理は同じになる
+"""
+
+# NumPyは任意 (importに時間がかかるため、インデックスを作る時まで読み込まない)
+HAS_NUMPY = importlib.util.find_spec("numpy") is not None
+numpy = LazyModule("numpy")
+
+DTYPES = {"Q": "uint64", "d": "float64"}
+
+
+# 期限の無いタグ(deadline=None)は無限大として持つ (期限順で最後になり、期限の範囲の検索には含まれない)
+def to_epoch(deadline: datetime.datetime | float | None) -> float:
+    if deadline is None:
+        return math.inf
+    return deadline.timestamp() if isinstance(deadline, datetime.datetime) else deadline
+
+
+def from_epoch(deadline: float) -> datetime.datetime | None:
+    return (
+        datetime.datetime.fromtimestamp(deadline, tz=datetime.timezone.utc)
+        if math.isfinite(deadline)
+        else None
+    )
+
+
+class SortIndex:
+    """columnsの辞書順に並べた行番号 (order)。先頭の列からの一致と、続く列の範囲で検索する"""
+
+    def __init__(self, columns: tuple[array, ...], use_numpy: bool = HAS_NUMPY):
+        self.columns = columns
+        self.order = array("Q")
+        if use_numpy and len(columns[0]):
+            arrays = [
+                numpy.frombuffer(column, dtype=DTYPES[column.typecode])
+                for column in columns
+            ]
+            # lexsortは最後のキーが最優先
+            self.order.frombytes(
+                numpy.lexsort(arrays[::-1]).astype(numpy.uint64).tobytes()
+            )
+        else:
+            self.order.extend(
+                sorted(
+                    range(len(columns[0])),
+                    key=lambda row: tuple(column[row] for column in columns),
+                )
+            )
+
+    def __len__(self) -> int:
+        return len(self.order)
+
+    def insert(self, row: int):
+        """rowを並び順の位置に差し込む (同じ値の行の後ろ)。位置は二分探索で求め、並べ替えはしない"""
+        position = self.range(*(column[row] for column in self.columns))[1]
+        self.order.insert(position, row)
+
+    def _search(self, position: int, value, start: int, stop: int, side: str) -> int:
+        # 先頭からposition-1列目までが等しい範囲では、position列目は並んでいる
+        search = bisect.bisect_left if side == "left" else bisect.bisect_right
+        return search(
+            self.order, value, start, stop, key=self.columns[position].__getitem__
+        )
+
+    def range(self, *prefix, lo=None, hi=None) -> tuple[int, int]:
+        """先頭の列がprefixに一致し、次の列がlo以上hi未満の範囲 (orderの位置)"""
+        start, stop = 0, len(self.order)
+        for position, value in enumerate(prefix):
+            start, stop = (
+                self._search(position, value, start, stop, "left"),
+                self._search(position, value, start, stop, "right"),
+            )
+        if lo is not None:
+            start = self._search(len(prefix), lo, start, stop, "left")
+        if hi is not None:
+            stop = self._search(len(prefix), hi, start, stop, "left")
+        return start, stop
+
+    def rows(self, *prefix, lo=None, hi=None) -> Iterable[int]:
+        start, stop = self.range(*prefix, lo=lo, hi=hi)
+        return self.order[start:stop].tolist()
+
+
+class TagTable:
+    INDEXES = {
+        "guild": ("guild_ids", "deadlines"),
+        "user": ("user_ids", "deadlines"),
+        "thread": ("guild_ids", "thread_ids", "user_ids"),
+        "deadline": ("deadlines",),
+    }
+
+    def __init__(self, use_numpy: bool = HAS_NUMPY):
+        self.use_numpy = use_numpy
+        self.user_ids = array("Q")
+        self.guild_ids = array("Q")
+        self.thread_ids = array("Q")
+        self.deadlines = array("d")  # UNIX時間
+        # 削除した行は0 (インデックスには残し、検索の結果から除く)
+        self.alive = bytearray()
+        self.dead = 0
+        self.loaded_at = time.monotonic()
+        self._indexes: dict[str, SortIndex] = {}
+
+    @classmethod
+    def build(cls, tag_docs: Iterable[dict], use_numpy: bool = HAS_NUMPY) -> "TagTable":
+        """from_tag_docsで作り、全てのインデックスも作る (時間がかかるため、executorで呼ぶ)"""
+        table = cls.from_tag_docs(tag_docs, use_numpy)
+        for name in cls.INDEXES:
+            table.index(name)
+        return table
+
+    @classmethod
+    def from_tag_docs(
+        cls, tag_docs: Iterable[dict], use_numpy: bool = HAS_NUMPY
+    ) -> "TagTable":
+        """tagsコレクションのドキュメント ({user_id, guild_id, thread_id, deadline}) から作る"""
+        table = cls(use_numpy)
+        for tag_doc in tag_docs:
+            table._append(
+                tag_doc["user_id"],
+                tag_doc["guild_id"],
+                tag_doc["thread_id"],
+                tag_doc["deadline"],
+            )
+        return table
+
+    def __len__(self) -> int:
+        return len(self.alive) - self.dead
+
+    def age(self) -> float:
+        return time.monotonic() - self.loaded_at
+
+    def nbytes(self) -> int:
+        """列とインデックスのバイト数"""
+        size = sum(
+            column.itemsize * len(column)
+            for column in (
+                self.user_ids,
+                self.guild_ids,
+                self.thread_ids,
+                self.deadlines,
+            )
+        )
+        size += len(self.alive)
+        for index in self._indexes.values():
+            size += index.order.itemsize * len(index.order)
+        return size
+
+    def _append(self, user_id, guild_id, thread_id, deadline) -> int:
+        self.user_ids.append(int(user_id))
+        self.guild_ids.append(int(guild_id))
+        self.thread_ids.append(int(thread_id))
+        self.deadlines.append(to_epoch(deadline))
+        self.alive.append(1)
+        return len(self.alive) - 1
+
+    def _kill(self, row: int):
+        self.alive[row] = 0
+        self.dead += 1
+
+    def index(self, name: str) -> SortIndex:
+        # buildで作っていない場合は、最初に使う時に作る
+        if name not in self._indexes:
+            self._indexes[name] = SortIndex(
+                tuple(getattr(self, column) for column in self.INDEXES[name]),
+                self.use_numpy,
+            )
+        return self._indexes[name]
+
+    def _rows(self, name: str, *prefix, lo=None, hi=None) -> list[int]:
+        # 削除した行を除いた、インデックスの範囲の行番号
+        alive = self.alive
+        rows = self.index(name).rows(*prefix, lo=lo, hi=hi)
+        return [row for row in rows if alive[row]] if self.dead else rows
+
+    ########## 書き込み (このプロセスからのタグの追加・削除を反映する) ##########
+
+    def find(self, guild_id: int, thread_id: int, user_id: int) -> int | None:
+        rows = self._rows("thread", int(guild_id), int(thread_id), int(user_id))
+        return rows[0] if rows else None
+
+    def upsert(
+        self, rows: Iterable[tuple[int, int | str, int | str, datetime.datetime]]
+    ):
+        """rows: [(user_id, guild_id, thread_id, deadline), ...] 既にあるタグは期限を書き換える"""
+        for user_id, guild_id, thread_id, deadline in rows:
+            row = self.find(guild_id, thread_id, user_id)
+            if row is not None:
+                if self.deadlines[row] == to_epoch(deadline):
+                    continue
+                # 期限が変わった行は、削除して追加し直す (インデックス内の位置が変わるため)
+                self._kill(row)
+            row = self._append(user_id, guild_id, thread_id, deadline)
+            for index in self._indexes.values():
+                index.insert(row)
+
+    def delete(self, rows: Iterable[tuple[int, int | str, int | str]]):
+        """rows: [(user_id, guild_id, thread_id), ...]"""
+        for user_id, guild_id, thread_id in rows:
+            row = self.find(guild_id, thread_id, user_id)
+            if row is not None:
+                self._kill(row)
+
+    ########## 検索 ##########
+
+    def record(self, row: int) -> TagRecord:
+        return TagRecord(
+            self.user_ids[row],
+            self.guild_ids[row],
+            self.thread_ids[row],
+            self.deadlines[row],
+        )
+
+    def guild_records(
+        self,
+        guild_id: int,
+        after: datetime.datetime | None = None,
+        before: datetime.datetime | None = None,
+    ) -> list[TagRecord]:
+        """ギルドのタグ (期限順)。after・beforeを渡した場合は、期限がafter以上before未満のもの"""
+        rows = self._rows(
+            "guild",
+            int(guild_id),
+            lo=None if after is None else to_epoch(after),
+            hi=None if before is None else to_epoch(before),
+        )
+        return [self.record(row) for row in rows]
+
+    def due(
+        self, after: datetime.datetime, before: datetime.datetime
+    ) -> list[TagRecord]:
+        """全ギルドの、期限がafter以上before未満のタグ (期限順)"""
+        rows = self._rows("deadline", lo=to_epoch(after), hi=to_epoch(before))
+        return [self.record(row) for row in rows]
+
+    def guild_tags(
+        self, guild_id: int | str
+    ) -> list[tuple[int, str, datetime.datetime | None]]:
+        """TagManager.get_guild_tagsと同じ形 [(user_id, thread_id, deadline), ...] (期限順)"""
+        return [
+            (record.user_id, str(record.thread_id), from_epoch(record.deadline))
+            for record in self.guild_records(int(guild_id))
+        ]
+
+    def thread_user_ids(self, guild_id: int | str, thread_id: int | str) -> list[int]:
+        rows = self._rows("thread", int(guild_id), int(thread_id))
+        return [self.user_ids[row] for row in rows]
+
+    def thread_deadlines(
+        self, guild_id: int | str, thread_id: int | str
+    ) -> dict[int, datetime.datetime | None]:
+        """スレッドのタグの {user_id: deadline}"""
+        rows = self._rows("thread", int(guild_id), int(thread_id))
+        return {self.user_ids[row]: from_epoch(self.deadlines[row]) for row in rows}
+
+    def threads_by_users(
+        self, user_ids: Iterable[int] | None = None
+    ) -> dict[int, dict[str, list[tuple[str, datetime.datetime]]]]:
+        """
+        TagManager.get_threads_by_usersと同じ形 {user_id: {guild_id: [(thread_id, deadline), ...]}} (期限順)
+        user_idsを渡さない場合は全ユーザー
+        """
+        if user_ids is None:
+            rows_by_user = [self._rows("user")]
+        else:
+            rows_by_user = [self._rows("user", int(user_id)) for user_id in user_ids]
+
+        threads_by_user = {}
+        for rows in rows_by_user:
+            for row in rows:
+                threads_by_user.setdefault(self.user_ids[row], {}).setdefault(
+                    str(self.guild_ids[row]), []
+                ).append((str(self.thread_ids[row]), from_epoch(self.deadlines[row])))
+        return threads_by_user
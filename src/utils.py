@@ -1,12 +1,17 @@
 # utils.py:
 
 import datetime
+import hashlib
+import importlib
+import math
 
+import copy
 import discord
 from dataclasses import dataclass
 from colorama import Fore, Style
 
 import uuid
+from typing import Iterable
 
 
 class Singleton(type):
@@ -18,10 +23,141 @@ class Singleton(type):
         return cls._instances[cls]
 
 
+class LazyModule:
+    """
+    属性に初めてアクセスした時にimportするモジュール
+    Firestore関連など、importに時間がかかり、起動時には使わないパッケージに使う
+    """
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr: str):
+        return getattr(self.load(), attr)
+
+
+# DELETE_FIELD/ArrayUnion/ArrayRemove (google.cloud.firestore_v1の読み込みに時間がかかるため遅延させる)
+transforms = LazyModule("google.cloud.firestore_v1.transforms")
+
+
 def generate_id():
     return str(uuid.uuid4())
 
 
+def generate_task_id(created_at: datetime.datetime | None = None) -> str:
+    """
+    作成日時の順に並ぶタスクID (作成日時(ナノ秒)の16進数 + ランダムな8桁)
+    IDの辞書順がそのまま作成順になるため、IDだけで並べ替え・ページングができる
+    """
+    if created_at is None:
+        created_at = datetime.datetime.now(datetime.timezone.utc)
+    created_ns = int(created_at.timestamp()) * 10**9 + created_at.microsecond * 1000
+    return f"{created_ns:016x}{uuid.uuid4().hex[:8]}"
+
+
+def member_digest(member_ids: set[int]) -> str:
+    """メンバーIDの集合のダイジェスト (メンバー構成が変わったかの判定に使う)"""
+    digest = hashlib.blake2b(digest_size=16)
+    for member_id in sorted(member_ids):
+        digest.update(member_id.to_bytes(8, "little"))
+    return digest.hexdigest()
+
+
+def percentile(values: list[float], percent: float) -> float:
+    """最近傍法によるパーセンタイル (valuesが空の場合は0)"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def comparable(value):
+    """比較用の値。naiveとawareのdatetimeが混ざっていても比較できるようにする"""
+    if isinstance(value, datetime.datetime):
+        return value.timestamp()
+    return value
+
+
+def deadline_key(deadline: datetime.datetime | None) -> float:
+    """期限順に並べるためのキー。期限の無いタグ(None)は最後にする (TagTableと同じ順)"""
+    return math.inf if deadline is None else comparable(deadline)
+
+
+def latest_deadline(
+    deadlines: Iterable[datetime.datetime | None],
+) -> datetime.datetime | None:
+    """スレッドの期限 (タグの期限のうち最も遅いもの。期限の無いタグは除く)"""
+    return max((d for d in deadlines if d is not None), key=comparable, default=None)
+
+
+FILTER_OPERATORS = {
+    "==": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+    "<": lambda a, b: a < b,
+    "<=": lambda a, b: a <= b,
+    ">": lambda a, b: a > b,
+    ">=": lambda a, b: a >= b,
+    "in": lambda a, b: a in b,
+    "array_contains": lambda a, b: b in (a or []),
+}
+
+
+def match_filter(data: dict, field: str, op: str, value) -> bool:
+    """Firestoreのクエリ条件(field, op, value)をメモリ上のドキュメントに適用する"""
+    if field not in data:
+        return False
+    if op not in ("in", "array_contains"):
+        value = comparable(value)
+    elif op == "in":
+        value = [comparable(v) for v in value]
+    try:
+        return FILTER_OPERATORS[op](comparable(data[field]), value)
+    except TypeError:
+        return False
+
+
+def merge_fields(current: dict, data: dict) -> dict:
+    """set(merge=True)と同じ規則で、dataをcurrentに再帰的に書き込む"""
+    for key, value in data.items():
+        if isinstance(value, dict) and isinstance(current.get(key), dict):
+            merge_fields(current[key], value)
+        else:
+            assign_field(current, key, value)
+    return current
+
+
+def update_fields(current: dict, data: dict) -> dict:
+    """updateと同じ規則で書き込む。dataのキーはフィールドパス(ドット区切り)として扱う"""
+    for field_path, value in data.items():
+        *parents, leaf = field_path.split(".")
+        target = current
+        for key in parents:
+            target = target.setdefault(key, {})
+        assign_field(target, leaf, value)
+    return current
+
+
+def assign_field(target: dict, key: str, value):
+    # DELETE_FIELD/ArrayUnion/ArrayRemoveはサーバー側で適用される変換として扱う
+    if value is transforms.DELETE_FIELD:
+        target.pop(key, None)
+    elif isinstance(value, transforms.ArrayUnion):
+        values = list(target.get(key) or [])
+        values.extend(v for v in value.values if v not in values)
+        target[key] = values
+    elif isinstance(value, transforms.ArrayRemove):
+        target[key] = [v for v in target.get(key) or [] if v not in value.values]
+    else:
+        target[key] = copy.deepcopy(value)
+
+
 # logging constants
 INFO = f"{Fore.BLUE}[INFO]{Style.RESET_ALL}: "
 ERROR = f"{Fore.RED}[ERROR]{Style.RESET_ALL}: "
@@ -77,6 +213,57 @@ class Task:
     content: str = None
 
 
+@dataclass(slots=True)
+class TagRecord:
+    """
+    1ユーザー・1スレッドのタグ (IDと期限(UNIX時間、期限が無い場合は無限大)だけを持つ、Tagの省メモリ版)
+    通知の一覧など件数の多いデータに使い、clientやdiscordのオブジェクトは表示する時にresolve_*で取得する
+    """
+
+    user_id: int
+    guild_id: int
+    thread_id: int
+    deadline: float
+
+    @classmethod
+    def from_row(
+        cls,
+        user_id: int | str,
+        guild_id: int | str,
+        thread_id: int | str,
+        deadline: datetime.datetime | None,
+    ) -> "TagRecord":
+        return cls(
+            int(user_id),
+            int(guild_id),
+            int(thread_id),
+            math.inf if deadline is None else deadline.timestamp(),
+        )
+
+    @property
+    def deadline_at(self) -> datetime.datetime | None:
+        if not math.isfinite(self.deadline):
+            return None
+        return datetime.datetime.fromtimestamp(self.deadline, tz=datetime.timezone.utc)
+
+    def resolve_user(self, client: discord.Client) -> discord.User | None:
+        return client.get_user(self.user_id)
+
+    def resolve_thread(self, client: discord.Client) -> discord.Thread | None:
+        guild = client.get_guild(self.guild_id)
+        return guild.get_thread(self.thread_id) if guild else None
+
+    def resolve(self, client: discord.Client) -> Tag:
+        user = self.resolve_user(client)
+        return Tag(
+            client=client,
+            guild_id=self.guild_id,
+            thread_id=self.thread_id,
+            users=[user] if user else [],
+            deadline=self.deadline_at,
+        )
+
+
 class CommandsTranslator(discord.app_commands.Translator):
     async def translate(
         self,
@@ -1,190 +1,230 @@
 # view_manager.py:
 
 import datetime
+from dataclasses import replace
 
 import discord
+from discord.ui import DynamicItem
 
 from db_manager import TagManager
 from embed_manager import EmbedManager
+from metrics import Metrics, respond
 from utils import Tag, Task
+from view_state import StateStore, ViewState, template
 
 """
-classらの引数にあるextraは、
+ビューの部品(セレクトメニュー・ボタン)は、操作途中の状態をViewState(IDのみ)としてcustom_idに持つ
+部品はDynamicItemとして、操作のたびにcustom_idから作り直される
+(送信したViewのオブジェクトを保持しないため、開いているビューの数によらずメモリは一定で、再起動後も操作を続けられる)
+
+embed_managerに渡すextrasは、
 extras = {
     (mode: str): (data: any)
     ...
 }
-のような形式でデータが入っており、関数はそれを参照して処理を行う
+のような形式で、応答を作る時にViewStateのIDから一時的に組み立てる
 """
 
 tag_manager = TagManager()
 embed_manager = EmbedManager()
+metrics = Metrics()
+# custom_idに収まらない状態 (get_threads_by_userで選択したユーザーのIDの一覧)
+state_store = StateStore()
+
+
+def tag_of(state: ViewState, client: discord.Client, **fields) -> Tag:
+    """ViewStateのIDから、embed_manager・tag_managerに渡すTagを組み立てる"""
+    return Tag(
+        client=client,
+        guild_id=state.guild_id or None,
+        thread_id=state.thread_id or None,
+        **fields,
+    )
 
 
-class ThreadsSelect(discord.ui.ChannelSelect):
-    def __init__(self, extras: dict[str, Tag] | None = None):
-        super().__init__(
-            placeholder="スレッドを選択してください",
-            min_values=1,
-            max_values=1,
-            channel_types=[
-                discord.ChannelType.public_thread,
-                discord.ChannelType.private_thread,
-            ],
-        )
-        self.extras = extras
+class View(discord.ui.View):
+    """部品を並べるだけのView (状態は部品のcustom_idにあるため、Viewは状態を持たない)"""
 
-    async def callback(self, interaction: discord.Interaction):
-        selected_threads = interaction.data["values"]
+    def __init__(self, *items: discord.ui.Item):
+        super().__init__(timeout=None)
+        for item in items:
+            self.add_item(item)
 
-        if "tag" in list(self.extras.keys()):
-            self.extras["tag"].thread_id = selected_threads[0]
-            await interaction.response.edit_message(
-                view=TagView2(extras=self.extras),
-                embed=embed_manager.get_embed(self.extras),
-            )
 
-        elif "untag" in list(self.extras.keys()):
-            self.extras["untag"].thread_id = selected_threads[0]
-            # 現在タグ付けされているユーザーを表示するための処理
-            tagged_user_ids = tag_manager.get_users_by_thread(self.extras["untag"])
-            self.extras["untag_tagged_user_ids"] = tagged_user_ids
-            await interaction.response.edit_message(
-                view=UntagView2(extras=self.extras),
-                embed=embed_manager.get_embed(self.extras),
+class Modal(discord.ui.Modal):
+    """コールバックの処理時間・DBの呼び出しを、modal:<クラス名>として計測するModal"""
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        metrics.track(f"modal:{type(self).__name__}", interaction)
+        return True
+
+    async def on_error(self, interaction, error):
+        if metrics.current():
+            metrics.current().failed = True
+        await super().on_error(interaction, error)
+
+
+class StateItem:
+    """
+    ViewStateをcustom_idに持つ部品の共通処理 (DynamicItemと組み合わせて使う)
+    処理時間・DBの呼び出しは、view:<モード>:<クラス名>として計測する
+    """
+
+    state: ViewState
+
+    @classmethod
+    async def from_custom_id(
+        cls, interaction: discord.Interaction, item: discord.ui.Item, match
+    ):
+        return cls(ViewState.decode(match["state"]))
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        # ユーザーに紐づく状態(タスクなど)は、本人以外は操作できない
+        # (Discordの「インタラクションに失敗しました」だけにならないよう、本人にだけ理由を伝える)
+        if self.state.user_id and interaction.user.id != self.state.user_id:
+            await respond(interaction).send_message(
+                embed=embed_manager.get_embed({"not_owner": None}), ephemeral=True
             )
+            return False
+        metrics.track(f"view:{self.state.mode}:{type(self).__name__}", interaction)
+        return True
 
-        elif "get_users_by_thread" in list(self.extras.keys()):
-            thread = self.extras["get_users_by_thread"].client.get_channel(
-                int(selected_threads[0])
+    async def callback(self, interaction: discord.Interaction):
+        try:
+            await self.respond(interaction)
+        except Exception:
+            if metrics.current():
+                metrics.current().failed = True
+            raise
+
+    async def respond(self, interaction: discord.Interaction):
+        raise NotImplementedError
+
+
+class ThreadsSelect(
+    StateItem, DynamicItem[discord.ui.ChannelSelect], template=template("threads")
+):
+    def __init__(self, state: ViewState):
+        self.state = state
+        super().__init__(
+            discord.ui.ChannelSelect(
+                custom_id=state.custom_id("threads"),
+                placeholder="スレッドを選択してください",
+                min_values=1,
+                max_values=1,
+                channel_types=[
+                    discord.ChannelType.public_thread,
+                    discord.ChannelType.private_thread,
+                ],
             )
-            self.extras["get_users_by_thread"].thread_id = thread.id
-            self.extras["get_users_by_thread"].guild_id = thread.guild.id
-            users = tag_manager.get_users_by_thread(self.extras["get_users_by_thread"])
+        )
 
-            self.extras["result"] = {
-                "get_users_by_thread": {"thread": thread, "users": users}
-            }
+    async def respond(self, interaction: discord.Interaction):
+        thread_id = int(interaction.data["values"][0])
+        state = replace(self.state, thread_id=thread_id)
+        client = interaction.client
 
-            await interaction.response.edit_message(
-                view=None, embed=embed_manager.get_embed(self.extras)
+        if state.mode == "tag":
+            await respond(interaction).edit_message(
+                view=TagView2(state),
+                embed=embed_manager.get_embed({"tag": tag_of(state, client)}),
             )
 
+        elif state.mode == "untag":
+            tag = tag_of(state, client)
+            # 現在タグ付けされているユーザーを表示するための処理
+            tagged_user_ids = await tag_manager.get_users_by_thread(tag)
+            await respond(interaction).edit_message(
+                view=UntagView2(state),
+                embed=embed_manager.get_embed(
+                    {"untag": tag, "untag_tagged_user_ids": tagged_user_ids}
+                ),
+            )
+
+        elif state.mode == "get_users_by_thread":
+            thread = client.get_channel(thread_id)
+            state = replace(state, guild_id=thread.guild.id, page=0)
+            message = await result_message(interaction, state)
+            await respond(interaction).edit_message(**{"view": None, **message})
+
 
-class NotifyChannelSelect(discord.ui.ChannelSelect):
-    def __init__(self, extras: dict[str, Tag] | None = None):
+class NotifyChannelSelect(
+    StateItem, DynamicItem[discord.ui.ChannelSelect], template=template("channel")
+):
+    def __init__(self, state: ViewState):
+        self.state = state
         super().__init__(
-            placeholder="通知するチャンネルを選択してください",
-            min_values=1,
-            max_values=1,
-            channel_types=[discord.ChannelType.text],
+            discord.ui.ChannelSelect(
+                custom_id=state.custom_id("channel"),
+                placeholder="通知するチャンネルを選択してください",
+                min_values=1,
+                max_values=1,
+                channel_types=[discord.ChannelType.text],
+            )
         )
-        self.extras = extras
 
-    async def callback(self, interaction: discord.Interaction):
-        selected_channel = interaction.data["values"]
+    async def respond(self, interaction: discord.Interaction):
+        channel_id = int(interaction.data["values"][0])
 
-        if "notify" in list(self.extras.keys()):
-            self.extras["notify"].thread_id = selected_channel[
-                0
-            ]  # thread_idだけど、例外的にchannel_idを挿入
+        if self.state.mode == "notify":
+            client = interaction.client
             guild = interaction.guild
-            selected_channel = guild.get_channel(int(selected_channel[0]))
-            self.extras["notify"].client.tag_manager.add_notify_channel(
-                {guild: selected_channel}
-            )
-            await interaction.response.edit_message(
-                view=None, embed=embed_manager.get_embed(self.extras)
+            selected_channel = guild.get_channel(channel_id)
+            await tag_manager.add_notify_channel({guild: selected_channel})
+            client.notification_handler.scheduler.schedule_digest(guild.id)
+            # thread_idだけど、例外的にchannel_idを挿入
+            tag = tag_of(self.state, client, thread_id=channel_id)
+            await respond(interaction).edit_message(
+                view=None, embed=embed_manager.get_embed({"notify": tag})
             )
 
 
-class MemberSelect(discord.ui.UserSelect):
-    def __init__(self, extras: dict[str, Tag] | None = None):
+class MemberSelect(
+    StateItem, DynamicItem[discord.ui.UserSelect], template=template("members")
+):
+    def __init__(self, state: ViewState):
+        self.state = state
         super().__init__(
-            placeholder="ユーザーを選択してください",
-            min_values=1,
-            max_values=25,
+            discord.ui.UserSelect(
+                custom_id=state.custom_id("members"),
+                placeholder="ユーザーを選択してください",
+                min_values=1,
+                max_values=25,
+            )
         )
-        self.extras = extras
 
-    async def callback(self, interaction: discord.Interaction):
-        selected_user_ids = interaction.data["values"]
-
-        if "tag" in list(self.extras.keys()):
-            user_ids = selected_user_ids
-            users = [
-                self.extras["tag"].client.get_user(int(user_id)) for user_id in user_ids
-            ]
-            self.extras["tag"].users = users
-            await interaction.response.send_modal(
-                DeadlineInputModal(extras=self.extras)
+    async def respond(self, interaction: discord.Interaction):
+        selected_user_ids = [int(user_id) for user_id in interaction.data["values"]]
+        client = interaction.client
+
+        if self.state.mode == "tag":
+            await respond(interaction).send_modal(
+                DeadlineInputModal(self.state, selected_user_ids)
             )
 
-        elif "untag" in list(self.extras.keys()):
-            user_ids = selected_user_ids
-            users = [
-                self.extras["untag"].client.get_user(int(user_id))
-                for user_id in user_ids
-            ]  # オブジェクトに変換
-            users = [user for user in users if not user.bot]  # botを除外
-            self.extras["untag"].users = users
-            tag_manager.remove_tag(self.extras["untag"])
-            await interaction.response.edit_message(
-                view=None, embed=embed_manager.get_embed(self.extras)
+        elif self.state.mode == "untag":
+            users = [client.get_user(user_id) for user_id in selected_user_ids]
+            users = [user for user in users if user and not user.bot]  # botを除外
+            tag = tag_of(self.state, client, users=users)
+            await tag_manager.remove_tag(tag)
+            await respond(interaction).edit_message(
+                view=None, embed=embed_manager.get_embed({"untag": tag})
             )
 
-        elif "get_threads_by_user" in list(self.extras.keys()):
-            selected_users = [
-                self.extras["get_threads_by_user"].client.get_user(int(user_id))
-                for user_id in selected_user_ids
-            ]
-            selected_users = [
-                user for user in selected_users if not user.bot
-            ]  # botを除外
-            self.extras["get_threads_by_user"].users = selected_users
-            result = {"get_threads_by_user": []}
-            for user in selected_users:
-                thread_infos = tag_manager.get_threads_by_user([user])
-                current_guild = interaction.guild
-                # interactionのguild以外のguild配下のスレッドを除外する
-                for guild_id in list(thread_infos.keys()):
-                    if int(guild_id) != current_guild.id:
-                        del thread_infos[guild_id]
-
-                if str(current_guild.id) not in list(thread_infos.keys()):
-                    continue
-
-                # tupleで返ってきたデータをdictに変換
-                dicted_threads = []
-                for thread_data in thread_infos[str(current_guild.id)]:
-                    thread_id, deadline = thread_data
-                    thread = self.extras["get_threads_by_user"].client.get_channel(
-                        int(thread_id)
-                    )
-                    dicted_threads.append({"thread": thread, "deadline": deadline})
-
-                result["get_threads_by_user"].append(
-                    {"user": user, "threads": dicted_threads}
-                )
+        elif self.state.mode == "get_threads_by_user":
+            # 選択したユーザーの一覧はcustom_idに収まらないため、state_storeに保存する
+            ref = state_store.put(tuple(selected_user_ids))
+            state = replace(self.state, guild_id=interaction.guild.id, page=0, ref=ref)
+            message = await result_message(interaction, state)
+            await respond(interaction).edit_message(**{"view": None, **message})
 
-            self.extras["result"] = result
-            await interaction.response.edit_message(
-                view=None, embed=embed_manager.get_embed(self.extras)
-            )
+        elif self.state.mode == "add_task":
+            await respond(interaction).send_modal(TaskContentInputModal(self.state))
 
-        elif "add_task" in list(self.extras.keys()):
-            user_ids = selected_user_ids
-            users = [
-                self.extras["add_task"].client.get_user(int(user_id))
-                for user_id in user_ids
-            ]
-            self.extras["add_task"].users = users
-            await interaction.response.send_modal(
-                TaskContentInputModal(extras=self.extras)
-            )
 
+class DeadlineInputModal(Modal):
+    """モーダルは再起動後に送信できないため、状態はこのオブジェクトに持つ"""
 
-class DeadlineInputModal(discord.ui.Modal):
     raw_deadline = discord.ui.TextInput(
         placeholder="例: 3 (3日後)",
         label="期限",
@@ -193,37 +233,69 @@ class DeadlineInputModal(discord.ui.Modal):
         max_length=3900,
     )
 
-    def __init__(self, extras: dict[str, Tag] | None = None):
+    def __init__(self, state: ViewState, user_ids: list[int] | None = None):
         super().__init__(title="3/3 期限の入力")
-        self.extras = extras
+        self.state = state
+        self.user_ids = tuple(user_ids or ())
 
     async def on_submit(self, interaction: discord.Interaction):
         deadline = self.raw_deadline.value
+        client = interaction.client
 
-        if "tag" in list(self.extras.keys()):
-            now = datetime.datetime.now()
+        if self.state.mode == "tag":
+            now = datetime.datetime.now(datetime.timezone.utc)
             deadline = now + datetime.timedelta(days=int(deadline))
-            self.extras["tag"].deadline = deadline
-            self.extras["tag"].users = [
-                user for user in self.extras["tag"].users if not user.bot
-            ]  # botを除外
-            tag_manager.add_tag(self.extras["tag"])
-
-            await interaction.response.edit_message(
-                view=None, embed=embed_manager.get_embed(self.extras)
+            users = [client.get_user(user_id) for user_id in self.user_ids]
+            users = [user for user in users if user and not user.bot]  # botを除外
+            tag = tag_of(self.state, client, users=users, deadline=deadline)
+            await tag_manager.add_tag(tag)
+            # 期限のリマインドを予約
+            client.notification_handler.scheduler.schedule_tag(tag)
+
+            await respond(interaction).edit_message(
+                view=None, embed=embed_manager.get_embed({"tag": tag})
             )
 
         # 今のところ未使用
-        elif "add_task" in list(self.extras.keys()):
-            now = datetime.datetime.now()
+        elif self.state.mode == "add_task":
+            now = datetime.datetime.now(datetime.timezone.utc)
             deadline = now + datetime.timedelta(days=int(deadline))
-            self.extras["add_task"].deadline = deadline
-            await interaction.response.send_message(
-                view=None, embed=embed_manager.get_embed(self.extras)
+            await respond(interaction).send_message(
+                embed=embed_manager.get_embed({"add_task": Task(client=client)})
             )
 
 
-class TaskContentInputModal(discord.ui.Modal):
+class NotifyFreqInputModal(Modal):
+    raw_freq = discord.ui.TextInput(
+        placeholder="例: 12 (12時間ごと)",
+        label="通知頻度(時間)",
+        style=discord.TextStyle.short,
+        min_length=1,
+        max_length=3,
+    )
+
+    def __init__(self):
+        super().__init__(title="通知頻度の入力")
+
+    async def on_submit(self, interaction: discord.Interaction):
+        freq = self.raw_freq.value
+        client = interaction.client
+
+        # 1時間から1週間の範囲に収める
+        freq = min(max(int(freq), 1), 168) if freq.isdigit() else None
+        if freq:
+            await tag_manager.set_notify_freq(interaction.guild, freq)
+            client.notification_handler.scheduler.schedule_digest(
+                interaction.guild.id, freq
+            )
+
+        extras = {"notify_freq": Tag(client=client), "notify_freq_hours": freq}
+        await respond(interaction).send_message(
+            ephemeral=True, embed=embed_manager.get_embed(extras)
+        )
+
+
+class TaskContentInputModal(Modal):
     raw_content = discord.ui.TextInput(
         placeholder="タスクの内容を入力してください",
         label="内容",
@@ -232,279 +304,433 @@ class TaskContentInputModal(discord.ui.Modal):
         max_length=3900,
     )
 
-    def __init__(self, extras: dict[str, Task] | None = None):
+    def __init__(self, state: ViewState):
         super().__init__(title="あなたに紐づけるタスクの内容の入力")
-        self.extras = extras
+        self.state = state
 
     async def on_submit(self, interaction: discord.Interaction):
         content = str(self.raw_content.value)
 
-        if "add_task" in list(self.extras.keys()):
-            self.extras["add_task"].content = content
+        if self.state.mode == "add_task":
+            task = Task(client=interaction.client, user=interaction.user)
+            task.content = content
 
-            tag_manager.add_task(self.extras["add_task"])
-            await interaction.response.send_message(
-                ephemeral=True, embed=embed_manager.get_embed(self.extras)
+            await tag_manager.add_task(task)
+            await respond(interaction).send_message(
+                ephemeral=True, embed=embed_manager.get_embed({"add_task": task})
             )
 
 
-class TaskSelect(discord.ui.Select):
-    def __init__(self, extras: dict[str, Task | list[Task]] | None = None):
-        self.extras = extras
-        current_page = self.extras["result"]["current_page"]
-        tasks_per_page = 25
-        start_index = (current_page - 1) * tasks_per_page
-        end_index = start_index + tasks_per_page
-        # ページング処理
-        tasks = list(self.extras["result"]["delete_task"].items())[
-            start_index:end_index
-        ]
-
-        if not tasks:
-            # データが存在しない場合は最後尾のデータを表示
-            total_tasks = len(self.extras["result"]["delete_task"])
-            last_page = (total_tasks - 1) // tasks_per_page + 1
-            start_index = (last_page - 1) * tasks_per_page
-            end_index = start_index + tasks_per_page
-            tasks = list(self.extras["result"]["delete_task"].items())[
-                start_index:end_index
-            ]
-
-        select_options = []
-        user = self.extras["delete_task"].user
-        for task in tasks:
-            option = discord.SelectOption(
-                label=task[1],
-                value=task[0],
+async def result_pages(
+    interaction: discord.Interaction, state: ViewState
+) -> list[discord.Embed] | None:
+    """
+    結果を表示するモードのページを、ViewStateから取得し直して作る
+    state_storeの状態が期限切れ・再起動で失われている場合はNone
+    """
+    client = interaction.client
+
+    if state.mode == "get_all":
+        # ギルドごとのタグ一覧を1件読むだけで、このギルドのタグを全て取得する
+        guild_id = str(state.guild_id)
+        threads_by_user: dict[int, list[tuple[str, datetime.datetime]]] = {}
+        for user_id, thread_id, deadline in await tag_manager.get_guild_tags(guild_id):
+            threads_by_user.setdefault(user_id, []).append((thread_id, deadline))
+
+        result = []
+        for user_id, threads in threads_by_user.items():
+            user_obj = client.get_user(user_id)
+            if not user_obj:
+                continue
+
+            result.append({user_obj: {guild_id: threads}})
+
+        extras = {
+            "get_all": Tag(client=client),
+            "result": {"get_all": result, "interaction": interaction},
+        }
+
+    elif state.mode == "get_users_by_thread":
+        tag = tag_of(state, client)
+        users = await tag_manager.get_users_by_thread(tag)
+        thread = client.get_channel(state.thread_id)
+        extras = {
+            "get_users_by_thread": tag,
+            "result": {"get_users_by_thread": {"thread": thread, "users": users}},
+        }
+
+    elif state.mode == "get_threads_by_user":
+        user_ids = state_store.get(state.ref)
+        if user_ids is None:
+            return None
+
+        selected_users = [client.get_user(user_id) for user_id in user_ids]
+        selected_users = [
+            user for user in selected_users if user and not user.bot
+        ]  # botを除外
+        result = {"get_threads_by_user": []}
+        # 選択されたユーザーのドキュメントは1回のRPCでまとめて取得する
+        threads_by_user = await tag_manager.get_threads_by_users(selected_users)
+        current_guild_id = str(state.guild_id)
+        for user in selected_users:
+            # interactionのguild以外のguild配下のスレッドは表示しない
+            thread_infos = threads_by_user.get(user.id, {})
+            if current_guild_id not in thread_infos:
+                continue
+
+            # tupleで返ってきたデータをdictに変換
+            dicted_threads = []
+            for thread_id, deadline in thread_infos[current_guild_id]:
+                thread = client.get_channel(int(thread_id))
+                dicted_threads.append({"thread": thread, "deadline": deadline})
+
+            result["get_threads_by_user"].append(
+                {"user": user, "threads": dicted_threads}
             )
-            select_options.append(option)
 
-        values_len = len(select_options) if len(select_options) < 25 else 25
+        extras = {
+            "get_threads_by_user": Tag(client=client, users=selected_users),
+            "result": result,
+        }
+
+    else:
+        raise ValueError(f"Invalid mode. (mode: {state.mode})")
+
+    return embed_manager.get_embeds(extras)
+
+
+async def result_message(interaction: discord.Interaction, state: ViewState) -> dict:
+    """
+    結果のstate.pageページ目を表示するメッセージ (send_message・edit_messageの引数)
+    上限を超える場合は複数のページに分け、ボタンで切り替えて表示する
+    """
+    pages = await result_pages(interaction, state)
+    if pages is None:
+        return {"embed": embed_manager.get_embed({"expired": None})}
+
+    page = state.page % len(pages)
+    message = {"embed": pages[page]}
+    if len(pages) > 1:
+        message["view"] = EmbedPageView(replace(state, page=page))
+    return message
+
+
+async def task_page_message(interaction: discord.Interaction, state: ViewState) -> dict:
+    """
+    state.cursorの次から、表示するページのタスクだけを取得したメッセージ
+    cursor: ページの開始位置(前のページの最後のtask_id。1ページ目は空)
+    """
+    task = Task(client=interaction.client, user=interaction.user)
+    tasks, next_cursor = await tag_manager.get_task_page(
+        task, start_after=state.cursor or None
+    )
+    # 表示中にタスクが削除され、ページが空になった場合は1ページ目に戻る
+    if not tasks and state.cursor:
+        state = replace(state, page=1, cursor="")
+        tasks, next_cursor = await tag_manager.get_task_page(task)
+    return task_message(interaction, state, tasks, next_cursor)
+
+
+def task_message(
+    interaction: discord.Interaction,
+    state: ViewState,
+    tasks: dict[str, str],
+    next_cursor: str | None,
+) -> dict:
+    extras = {
+        "delete_task": Task(client=interaction.client, user=interaction.user),
+        "result": {"delete_task": tasks, "current_page": state.page},
+    }
+    message = {"embed": embed_manager.get_embed(extras)}
+    # 選択肢の無いセレクトメニューは送れない
+    if tasks:
+        message["view"] = DeleteTaskView(
+            state,
+            tasks,
+            next_cursor,
+            placeholder=f"{interaction.user}のタスクを選択してください",
+        )
+    return message
 
+
+class TaskSelect(StateItem, DynamicItem[discord.ui.Select], template=template("tasks")):
+    def __init__(
+        self,
+        state: ViewState,
+        options: list[discord.SelectOption],
+        placeholder: str | None = None,
+    ):
+        self.state = state
         super().__init__(
-            placeholder=f"{user}のタスクを選択してください",
-            min_values=1,
-            max_values=values_len,
-            options=select_options if len(select_options) < 25 else select_options[:25],
+            discord.ui.Select(
+                custom_id=state.custom_id("tasks"),
+                placeholder=placeholder,
+                min_values=1,
+                max_values=len(options),
+                options=options,
+            )
         )
 
-        self.extras = extras
+    @classmethod
+    async def from_custom_id(
+        cls, interaction: discord.Interaction, item: discord.ui.Select, match
+    ):
+        # 選択肢は、送信済みのメッセージのものをそのまま使う
+        return cls(ViewState.decode(match["state"]), item.options, item.placeholder)
 
-    async def callback(self, interaction: discord.Interaction):
+    async def respond(self, interaction: discord.Interaction):
         selected_task_ids = interaction.data["values"]
 
-        if "delete_task" in list(self.extras.keys()):
+        if self.state.mode == "delete_task":
+            task = Task(client=interaction.client, user=interaction.user)
             for task_id in selected_task_ids:
-                self.extras["delete_task"].task_id = task_id
-                tag_manager.delete_task(self.extras["delete_task"])
+                task.task_id = task_id
+                await tag_manager.delete_task(task)
 
-            self.extras["result"] = {"delete_task": "done"}
-
-            await interaction.response.edit_message(
-                view=None, embed=embed_manager.get_embed(self.extras)
+            extras = {"delete_task": task, "result": {"delete_task": "done"}}
+            await respond(interaction).edit_message(
+                view=None, embed=embed_manager.get_embed(extras)
             )
 
 
 class ConfimButton(discord.ui.Button):
-    def __init__(self, extras: dict[str, Tag] | None = None):
+
+    def __init__(self):
         super().__init__(
             label="OK",
             style=discord.ButtonStyle.primary,
         )
-        self.extras = extras
 
     async def callback(self, interaction: discord.Interaction):
         pass
 
 
-class CancelButton(discord.ui.Button):
-    def __init__(self, extras: dict[str, Tag] | None = None):
+class CancelButton(
+    StateItem, DynamicItem[discord.ui.Button], template=template("cancel")
+):
+    def __init__(self, state: ViewState):
+        self.state = state
         super().__init__(
-            label="キャンセル",
-            style=discord.ButtonStyle.secondary,
+            discord.ui.Button(
+                custom_id=state.custom_id("cancel"),
+                label="キャンセル",
+                style=discord.ButtonStyle.secondary,
+            )
         )
-        self.extras = extras
 
-    async def callback(self, interaction: discord.Interaction):
-        self.extras = {"cancel": None}
-        await interaction.response.edit_message(
-            view=None, embed=embed_manager.get_embed(self.extras)
+    async def respond(self, interaction: discord.Interaction):
+        await respond(interaction).edit_message(
+            view=None, embed=embed_manager.get_embed({"cancel": None})
         )
 
 
 # これはdelete_taskのviewで、taskが25個以上ある場合に次のページを表示するためのボタン
-class NextPageButton(discord.ui.Button):
-    def __init__(self, extras: dict[str, Tag | Task] | None = None):
+class NextPageButton(
+    StateItem, DynamicItem[discord.ui.Button], template=template("next")
+):
+    """state: 次のページ (cursorは次のページの開始位置)"""
+
+    def __init__(self, state: ViewState):
+        self.state = state
         super().__init__(
-            label="次のページ",
-            style=discord.ButtonStyle.primary,
+            discord.ui.Button(
+                custom_id=state.custom_id("next"),
+                label="次のページ",
+                style=discord.ButtonStyle.primary,
+            )
         )
-        self.extras = extras
 
-    async def callback(self, interaction: discord.Interaction):
-        self.extras["result"]["current_page"] += 1
-
-        # ページが25ページを超える場合は25ページ目に戻す
-        if self.extras["result"]["current_page"] > 25:
-            self.extras["result"]["current_page"] = 25
-        # pageを超えるcurrent_pageが指定された場合はpageに戻す
-        elif self.extras["result"]["current_page"] > self.extras["result"]["page"]:
-            self.extras["result"]["current_page"] = self.extras["result"]["page"]
-
-        view = (
-            DeleteTaskViewNext
-            if self.extras["result"]["current_page"] != self.extras["result"]["page"]
-            else DeleteTaskViewOnly
-        )
+    async def respond(self, interaction: discord.Interaction):
+        message = await task_page_message(interaction, self.state)
+        await respond(interaction).edit_message(**{"view": None, **message})
 
-        await interaction.response.edit_message(
-            view=view(extras=self.extras), embed=embed_manager.get_embed(self.extras)
-        )
 
+class PreviousPageButton(
+    StateItem, DynamicItem[discord.ui.Button], template=template("prev")
+):
+    """state: 前のページ (cursorは表示中のページの最初のtask_id。その前のタスクを取得する)"""
 
-class PreviousPageButton(discord.ui.Button):
-    def __init__(self, extras: dict[str, Tag | Task] | None = None):
+    def __init__(self, state: ViewState):
+        self.state = state
         super().__init__(
-            label="前のページ",
-            style=discord.ButtonStyle.primary,
+            discord.ui.Button(
+                custom_id=state.custom_id("prev"),
+                label="前のページ",
+                style=discord.ButtonStyle.primary,
+            )
         )
-        self.extras = extras
 
-    async def callback(self, interaction: discord.Interaction):
-        self.extras["result"]["current_page"] -= 1
+    async def respond(self, interaction: discord.Interaction):
+        task = Task(client=interaction.client, user=interaction.user)
+        tasks, start_after = await tag_manager.get_previous_task_page(
+            task, end_before=self.state.cursor
+        )
+        if not tasks:
+            message = await task_page_message(
+                interaction, replace(self.state, page=1, cursor="")
+            )
+        else:
+            state = replace(
+                self.state,
+                page=max(self.state.page, 2) if start_after else 1,
+                cursor=start_after or "",
+            )
+            message = task_message(interaction, state, tasks, list(tasks)[-1])
+        await respond(interaction).edit_message(**{"view": None, **message})
 
-        if self.extras["result"]["current_page"] < 1:
-            self.extras["result"]["current_page"] = 1
 
-        view = (
-            DeleteTaskViewAll
-            if self.extras["result"]["current_page"] != 1
-            else DeleteTaskViewPrev
-        )
+# 上限を超えて複数のembedに分けた結果を、1ページずつ表示するためのボタン
+class EmbedPageButton(
+    StateItem,
+    DynamicItem[discord.ui.Button],
+    template=template("page", r"(?P<step>[+-]1):"),
+):
+    """state: 表示中のページ (結果は押された時に取得し直す)"""
 
-        await interaction.response.edit_message(
-            view=view(extras=self.extras), embed=embed_manager.get_embed(self.extras)
+    def __init__(self, state: ViewState, step: int):
+        self.state = state
+        self.step = step
+        super().__init__(
+            discord.ui.Button(
+                custom_id=state.custom_id(f"page:{step:+d}"),
+                label="前のページ" if step < 0 else "次のページ",
+                style=discord.ButtonStyle.primary,
+            )
         )
 
+    @classmethod
+    async def from_custom_id(
+        cls, interaction: discord.Interaction, item: discord.ui.Button, match
+    ):
+        return cls(ViewState.decode(match["state"]), int(match["step"]))
+
+    async def respond(self, interaction: discord.Interaction):
+        state = replace(self.state, page=self.state.page + self.step)
+        message = await result_message(interaction, state)
+        await respond(interaction).edit_message(**{"view": None, **message})
+
 
 class LinkButton(discord.ui.Button):
-    def __init__(self, extras: dict[str, str] | None = None):
-        """extras excpects {'invite': (invite_link: str)}"""
+
+    def __init__(self, url: str):
         super().__init__(
             label="招待リンク",
             style=discord.ButtonStyle.primary,
-            url=extras["invite"],
+            url=url,
         )
-        self.extras = extras
 
-    async def callback(self, interaction: discord.Interaction):
-        await interaction.response.edit_message(
-            view=None, embed=embed_manager.get_embed(self.extras)
-        )
+
+# 再起動後もcustom_idから部品を作り直せるよう、起動時にclient.add_dynamic_itemsで登録する
+DYNAMIC_ITEMS = (
+    ThreadsSelect,
+    NotifyChannelSelect,
+    MemberSelect,
+    TaskSelect,
+    CancelButton,
+    NextPageButton,
+    PreviousPageButton,
+    EmbedPageButton,
+)
 
 
 ########## tag ##########
-class TagView1(discord.ui.View):
-    def __init__(self, extras: dict[str, Tag] | None = None):
-        super().__init__()
-        self.add_item(ThreadsSelect(extras=extras))
-        self.add_item(CancelButton(extras=extras))
+class TagView1(View):
 
+    def __init__(self, state: ViewState):
+        super().__init__(ThreadsSelect(state), CancelButton(state))
 
-class TagView2(discord.ui.View):
-    def __init__(self, extras: dict[str, Tag] | None = None):
-        super().__init__()
-        self.add_item(MemberSelect(extras=extras))
-        self.add_item(CancelButton(extras=extras))
+
+class TagView2(View):
+
+    def __init__(self, state: ViewState):
+        super().__init__(MemberSelect(state), CancelButton(state))
 
 
 ########## untag ##########
-class UntagView1(discord.ui.View):
-    def __init__(self, extras: dict[str, Tag] | None = None):
-        super().__init__()
-        self.add_item(ThreadsSelect(extras=extras))
-        self.add_item(CancelButton(extras=extras))
+class UntagView1(View):
+
+    def __init__(self, state: ViewState):
+        super().__init__(ThreadsSelect(state), CancelButton(state))
 
 
-class UntagView2(discord.ui.View):
-    def __init__(self, extras: dict[str, Tag] | None = None):
-        super().__init__()
-        self.add_item(MemberSelect(extras=extras))
-        self.add_item(CancelButton(extras=extras))
+class UntagView2(View):
+
+    def __init__(self, state: ViewState):
+        super().__init__(MemberSelect(state), CancelButton(state))
 
 
 ########## get_threads_by_user ##########
-class GetThreadsView1(discord.ui.View):
-    def __init__(self, extras: dict[str, Tag] | None = None):
-        super().__init__()
-        self.add_item(MemberSelect(extras=extras))
-        self.add_item(CancelButton(extras=extras))
+class GetThreadsView1(View):
 
+    def __init__(self, state: ViewState):
+        super().__init__(MemberSelect(state), CancelButton(state))
 
-########## get_users_by_thread ##########
-class GetUsersView1(discord.ui.View):
-    def __init__(self, extras: dict[str, Tag] | None = None):
-        super().__init__()
-        self.add_item(ThreadsSelect(extras=extras))
-        self.add_item(CancelButton(extras=extras))
 
+########## get_users_by_thread ##########
+class GetUsersView1(View):
 
-########## delete_task ##########
-class DeleteTaskViewAll(discord.ui.View):
-    def __init__(self, extras: dict[str, Tag] | None = None):
-        super().__init__()
-        self.add_item(TaskSelect(extras=extras))
-        self.add_item(PreviousPageButton(extras=extras))
-        self.add_item(NextPageButton(extras=extras))
-        self.add_item(CancelButton(extras=extras))
+    def __init__(self, state: ViewState):
+        super().__init__(ThreadsSelect(state), CancelButton(state))
 
 
-class DeleteTaskViewPrev(discord.ui.View):
-    def __init__(self, extras: dict[str, Tag] | None = None):
-        super().__init__()
-        self.add_item(TaskSelect(extras=extras))
-        self.add_item(PreviousPageButton(extras=extras))
-        self.add_item(CancelButton(extras=extras))
+########## delete_task ##########
+class DeleteTaskView(View):
+    """表示中のページのタスクと、前後のページがある場合はページを移動するボタン"""
+
+    def __init__(
+        self,
+        state: ViewState,
+        tasks: dict[str, str],
+        next_cursor: str | None,
+        placeholder: str,
+    ):
+        options = [
+            # ラベルは100文字まで
+            discord.SelectOption(label=content[:100], value=task_id)
+            for task_id, content in tasks.items()
+        ]
+        items = [TaskSelect(state, options, placeholder=placeholder)]
+        if state.cursor:
+            items.append(
+                PreviousPageButton(
+                    replace(state, page=state.page - 1, cursor=next(iter(tasks)))
+                )
+            )
+        if next_cursor is not None:
+            items.append(
+                NextPageButton(replace(state, page=state.page + 1, cursor=next_cursor))
+            )
+        items.append(CancelButton(state))
+        super().__init__(*items)
 
 
-class DeleteTaskViewNext(discord.ui.View):
-    def __init__(self, extras: dict[str, Tag] | None = None):
-        super().__init__()
-        self.add_item(TaskSelect(extras=extras))
-        self.add_item(NextPageButton(extras=extras))
-        self.add_item(CancelButton(extras=extras))
+########## get_tasks_by_user ##########
+class GetTasksView1(View):
 
+    def __init__(self, state: ViewState):
+        super().__init__(MemberSelect(state), CancelButton(state))
 
-class DeleteTaskViewOnly(discord.ui.View):
-    def __init__(self, extras: dict[str, Tag] | None = None):
-        super().__init__()
-        self.add_item(TaskSelect(extras=extras))
-        self.add_item(CancelButton(extras=extras))
 
+########## pages ##########
+class EmbedPageView(View):
 
-########## get_tasks_by_user ##########
-class GetTasksView1(discord.ui.View):
-    def __init__(self, extras: dict[str, Tag] | None = None):
-        super().__init__()
-        self.add_item(MemberSelect(extras=extras))
-        self.add_item(CancelButton(extras=extras))
+    def __init__(self, state: ViewState):
+        super().__init__(EmbedPageButton(state, -1), EmbedPageButton(state, 1))
 
 
 ########## invite ##########
 
 
-class InviteView1(discord.ui.View):
-    def __init__(self, extras: dict[str, Tag] | None = None):
-        super().__init__()
-        self.add_item(LinkButton(extras=extras))
-        self.add_item(CancelButton(extras=extras))
+class InviteView1(View):
+
+    def __init__(self, state: ViewState, url: str):
+        super().__init__(LinkButton(url), CancelButton(state))
 
 
 ########## notify ##########
 
 
-class NotifyView1(discord.ui.View):
-    def __init__(self, extras: dict[str, Tag] | None = None):
-        super().__init__()
-        self.add_item(NotifyChannelSelect(extras=extras))
-        self.add_item(CancelButton(extras=extras))
+class NotifyView1(View):
+
+    def __init__(self, state: ViewState):
+        super().__init__(NotifyChannelSelect(state), CancelButton(state))
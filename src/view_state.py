@@ -0,0 +1,129 @@
+# view_state.py:
+
+import secrets
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+"""
+ビューの操作途中の状態を、IDだけのViewStateとしてcustom_idに埋め込む
+(コンポーネントの操作時はcustom_idから状態を復元するため、開いているビューの数だけメモリを使わず、再起動後も操作を続けられる)
+
+custom_id: mt:<部品>:<ViewState.encode()> (Discordの上限は100文字)
+ViewState.encode(): <モード>.<guild_id>.<thread_id>.<user_id>.<page>.<cursor>.<ref>
+  IDは36進数、0と空文字は空欄にする
+custom_idに収まらない状態(選択したユーザーの一覧など)はStateStoreに保存し、そのキーをrefに入れる
+"""
+
+CUSTOM_ID_LIMIT = 100
+PREFIX = "mt"
+
+# モードは一文字のコードで表す (送信済みのメッセージを読めなくなるため、順番を変えず末尾に追加する)
+MODES = (
+    "tag",
+    "untag",
+    "get_threads_by_user",
+    "get_users_by_thread",
+    "get_all",
+    "delete_task",
+    "notify",
+    "invite",
+    "add_task",
+    "get_tasks",
+)
+MODE_CODES = {mode: format(i, "x") for i, mode in enumerate(MODES)}
+CODE_MODES = {code: mode for mode, code in MODE_CODES.items()}
+
+
+def to_base36(value: int) -> str:
+    if not value:
+        return ""
+    digits = []
+    while value:
+        value, digit = divmod(value, 36)
+        digits.append("0123456789abcdefghijklmnopqrstuvwxyz"[digit])
+    return "".join(reversed(digits))
+
+
+def from_base36(value: str) -> int:
+    return int(value, 36) if value else 0
+
+
+@dataclass(slots=True, frozen=True)
+class ViewState:
+    """ビューの状態 (IDとページング位置のみ。Discordのオブジェクトやクライアントは持たない)"""
+
+    mode: str
+    guild_id: int = 0
+    thread_id: int = 0
+    user_id: int = 0
+    page: int = 0
+    cursor: str = ""  # タスクのページングの位置 (task_id)
+    ref: str = ""  # StateStoreのキー
+
+    def encode(self) -> str:
+        return ".".join(
+            (
+                MODE_CODES[self.mode],
+                to_base36(self.guild_id),
+                to_base36(self.thread_id),
+                to_base36(self.user_id),
+                to_base36(self.page),
+                self.cursor,
+                self.ref,
+            )
+        )
+
+    @classmethod
+    def decode(cls, data: str) -> "ViewState":
+        mode, guild_id, thread_id, user_id, page, cursor, ref = data.split(".")
+        return cls(
+            mode=CODE_MODES[mode],
+            guild_id=from_base36(guild_id),
+            thread_id=from_base36(thread_id),
+            user_id=from_base36(user_id),
+            page=from_base36(page),
+            cursor=cursor,
+            ref=ref,
+        )
+
+    def custom_id(self, item: str) -> str:
+        custom_id = f"{PREFIX}:{item}:{self.encode()}"
+        if len(custom_id) > CUSTOM_ID_LIMIT:
+            raise ValueError(f"custom_id is too long. ({len(custom_id)}: {custom_id})")
+        return custom_id
+
+
+def template(item: str, extra: str = "") -> str:
+    """部品のcustom_idに一致する正規表現 (stateに状態、extraに部品ごとの値が入る)"""
+    return rf"{PREFIX}:{item}:{extra}(?P<state>[0-9a-z]*(?:\.[0-9A-Za-z_-]*){{6}})$"
+
+
+class StateStore:
+    """
+    custom_idに収まらない状態を短いキーで保持する、件数の上限とTTL付きのストア
+    期限切れ・再起動後はNoneを返すため、呼び出し側は「もう一度コマンドを実行」を案内する
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 15 * 60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict[str, tuple[float, tuple]] = OrderedDict()
+
+    def put(self, value: tuple) -> str:
+        key = secrets.token_urlsafe(6)
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+        return key
+
+    def get(self, key: str) -> tuple | None:
+        entry = self._data.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            self._data.pop(key, None)
+            return None
+        self._data.move_to_end(key)
+        return entry[1]
+
+    def __len__(self) -> int:
+        return len(self._data)